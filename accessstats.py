@@ -0,0 +1,281 @@
+"""
+Incremental statistics of the web access log.
+
+Builds per-endpoint, per-client and per-status request counts and per-minute request and error
+rates from gunicorn-access.log for the /stats page. The aggregates are kept in a compact JSON
+file ('statspath') together with a checkpoint of the log file's inode, the byte offset up to
+which it has been read and a checksum of its first bytes. Each update parses only the complete
+lines appended since the checkpoint, at most MAXREAD bytes at a time so a page never waits on a
+large backlog, and then saves the aggregates and the new checkpoint.
+
+A changed inode means the log was rotated: the rest of the old file is read from its rotated
+backup (gunicorn-access.log.1 ...) if it can be found, and the new file is read from the start.
+A file shorter than the checkpoint, or whose first bytes no longer match, was truncated in place
+(copytruncate) and is read again from the start. The gunicorn workers share the file under an
+flock, so whichever worker serves the page brings the statistics up to date for all of them.
+"""
+
+import os
+import re
+import json
+import zlib
+import fcntl
+from datetime import datetime
+from threading import Lock
+from time import time
+from app_control import settings
+from logmanager import logger
+from logreader import rotatedfiles
+
+MAXREAD = 8 * 1048576
+"""The most bytes of log parsed by one update"""
+HEADBYTES = 256
+"""Length of the start of the log file checksummed to detect it being truncated and rewritten,
+shorter while less than this has been read"""
+MAXKEYS = 1000
+"""Distinct endpoints or clients kept, later ones are counted under 'other'"""
+MINUTES = 1440
+"""Minutes of request rate history kept"""
+ACCESSLINE = re.compile(rb'^(\S*) \S+ \S+ \[([^\]]+)\] "(?:\S+ (\S+)[^"]*|[^"]*)" (\d{3}) (\S+)')
+"""
+Client, time, path, status and size from a gunicorn (combined format) access log line. The client
+is empty when gunicorn is bound to a UNIX socket (as behind nginx), such lines are counted under '-'
+"""
+
+
+def emptystats():
+    """Return the aggregates of a log with nothing read from it yet"""
+    return {'inode': None, 'offset': 0, 'head': None, 'lines': 0, 'unparsed': 0, 'first': None, 'last': None,
+            'endpoints': {}, 'clients': {}, 'statuses': {}, 'minutes': {}}
+
+
+def headchecksum(file, length):
+    """Return [length, checksum] of the first length bytes of an open binary file"""
+    file.seek(0)
+    head = file.read(length)
+    return [len(head), zlib.crc32(head)]
+
+
+def timestring(when):
+    """Return a unix time as a local date and time string, None for None"""
+    if when is None:
+        return None
+    return datetime.fromtimestamp(when).strftime('%d/%m/%Y %H:%M:%S')
+
+
+def counter(table, key):
+    """Return the counters of key in an aggregate table, folding new keys into 'other' once the table is full"""
+    if key not in table and len(table) >= MAXKEYS:
+        key = 'other'
+    return table.setdefault(key, [0, 0, 0])
+
+
+class AccessStats:
+    """
+    The access log aggregates and their checkpoint.
+
+    Parameters:
+        logpath (callable): Returns the path of the access log.
+        statspath (callable): Returns the path of the aggregates file.
+    """
+
+    def __init__(self, logpath, statspath):
+        self.logpath = logpath
+        self.statspath = statspath
+        self.stats = emptystats()
+        self.stamp = None
+        """(mtime, size) of the aggregates file when it was last loaded or saved by this process"""
+        self.lock = Lock()
+        self.timestamps = (None, None)
+        """The last access log time string parsed and its unix time, lines in the same second share it"""
+
+    def load(self):
+        """Reload the aggregates if another process has saved them since this one last did"""
+        try:
+            stat = os.stat(self.statspath())
+        except FileNotFoundError:
+            return
+        if (stat.st_mtime_ns, stat.st_size) == self.stamp:
+            return
+        try:
+            with open(self.statspath(), 'r', encoding='utf-8') as file:
+                self.stats = json.load(file)
+        except ValueError:
+            logger.warning('Stats: %s is damaged, rebuilding the access statistics', self.statspath())
+            self.stats = emptystats()
+        self.stamp = (stat.st_mtime_ns, stat.st_size)
+
+    def save(self):
+        """Write the aggregates and checkpoint, replacing the file in one rename"""
+        temporary = self.statspath() + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as file:
+            json.dump(self.stats, file, separators=(',', ':'))
+        os.replace(temporary, self.statspath())
+        stat = os.stat(self.statspath())
+        self.stamp = (stat.st_mtime_ns, stat.st_size)
+
+    def update(self):
+        """
+        Parses whatever has been appended to the access log since the checkpoint.
+
+        Returns:
+            int: The number of bytes of the live log still to be parsed.
+        """
+        os.makedirs(os.path.dirname(self.statspath()) or '.', exist_ok=True)
+        with self.lock, open(self.statspath() + '.lock', 'a', encoding='utf-8') as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            self.load()
+            stats = self.stats
+            path = self.logpath()
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                return 0
+            changed = False
+            if stats['inode'] != stat.st_ino:
+                if stats['inode'] is not None:
+                    self.readrotated(stats['inode'], stats['offset'])
+                stats['inode'], stats['offset'], stats['head'] = stat.st_ino, 0, None
+                changed = True
+            with open(path, 'rb') as file:
+                if stats['offset'] and (stat.st_size < stats['offset'] or
+                                        headchecksum(file, stats['head'][0]) != stats['head']):
+                    logger.info('Stats: %s was truncated, reading it from the start', path)
+                    stats['offset'], stats['head'] = 0, None
+                    changed = True
+                if self.readfrom(file, MAXREAD):
+                    changed = True
+                if stats['head'] is None or stats['head'][0] < min(HEADBYTES, stats['offset']):
+                    stats['head'] = headchecksum(file, min(HEADBYTES, stats['offset']))
+                    changed = True
+            if changed:
+                self.save()
+            return max(0, stat.st_size - stats['offset'])
+
+    def readrotated(self, inode, offset):
+        """Finish reading the file that was the live log before it was rotated, if it can be found"""
+        for candidate in rotatedfiles(self.logpath())[1:]:
+            try:
+                if os.stat(candidate).st_ino != inode:
+                    continue
+                with open(candidate, 'rb') as file:
+                    self.stats['offset'] = offset
+                    while self.readfrom(file, MAXREAD):
+                        pass
+                return
+            except FileNotFoundError:
+                continue
+        logger.warning('Stats: the rotated access log was not found, lines after offset %s are not counted', offset)
+
+    def readfrom(self, file, budget):
+        """Parse the complete lines of an open log file from the checkpoint offset, return the bytes read"""
+        file.seek(self.stats['offset'])
+        data = file.read(budget)
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            return 0
+        for line in data[:end].splitlines():
+            self.addline(line)
+        self.stats['offset'] += end
+        self.trimminutes()
+        return end
+
+    def parsetime(self, text):
+        """Return the unix time of an access log time string such as 17/Oct/2026:06:31:00 +0000"""
+        if text != self.timestamps[0]:
+            self.timestamps = (text, datetime.strptime(text.decode('ascii'), '%d/%b/%Y:%H:%M:%S %z').timestamp())
+        return self.timestamps[1]
+
+    def addline(self, line):
+        """Add one access log line to the aggregates"""
+        stats = self.stats
+        match = ACCESSLINE.match(line)
+        if not match:
+            stats['unparsed'] += 1
+            return
+        client, when, path, status, size = match.groups()
+        try:
+            when = self.parsetime(when)
+        except ValueError:
+            stats['unparsed'] += 1
+            return
+        error = 1 if status >= b'400' else 0
+        size = int(size) if size.isdigit() else 0
+        endpoint = path.split(b'?', 1)[0].decode('utf-8', 'replace') if path else '-'
+        counts = counter(stats['endpoints'], endpoint)
+        counts[0] += 1
+        counts[1] += error
+        counts[2] += size
+        counts = counter(stats['clients'], client.decode('ascii', 'replace') or '-')
+        counts[0] += 1
+        counts[1] += error
+        counts[2] += size
+        status = status.decode('ascii')
+        stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+        minute = stats['minutes'].setdefault(str(int(when // 60)), [0, 0])
+        minute[0] += 1
+        minute[1] += error
+        stats['lines'] += 1
+        if stats['first'] is None:
+            stats['first'] = when
+        stats['last'] = when
+
+    def trimminutes(self):
+        """Drop the per-minute counts older than MINUTES minutes before the newest"""
+        minutes = self.stats['minutes']
+        if len(minutes) > MINUTES:
+            oldest = max(int(minute) for minute in minutes) - MINUTES
+            for minute in [minute for minute in minutes if int(minute) <= oldest]:
+                del minutes[minute]
+
+    def report(self, top=25):
+        """
+        Brings the aggregates up to date and summarises them.
+
+        Parameters:
+            top (int): The number of endpoints and clients listed, busiest first.
+
+        Returns:
+            dict: The totals, the time of the first and last request, the endpoints and clients with their requests, errors (status 400
+            and above), error rate and bytes, the count of each status, the requests and errors of
+            each of the last 60 minutes and 24 hours, and the bytes of log still to be parsed.
+        """
+        behind = self.update()
+        with self.lock:
+            stats = self.stats
+            now = int(time() // 60)
+            minutes = {int(minute): counts for minute, counts in stats['minutes'].items()}
+            return {'lines': stats['lines'], 'unparsed': stats['unparsed'], 'first': stats['first'],
+                    'last': stats['last'], 'from': timestring(stats['first']), 'to': timestring(stats['last']),
+                    'behind': behind,
+                    'endpoints': self.ranked(stats['endpoints'], 'endpoint', top),
+                    'clients': self.ranked(stats['clients'], 'client', top),
+                    'statuses': dict(sorted(stats['statuses'].items())),
+                    'minutes': self.series(minutes, now - 59, now, 1),
+                    'hours': self.series(minutes, now - now % 60 - 23 * 60, now, 60)}
+
+    @staticmethod
+    def ranked(table, name, top):
+        """Return the top entries of an aggregate table by request count"""
+        entries = sorted(table.items(), key=lambda item: item[1][0], reverse=True)[:top]
+        return [{name: key, 'requests': counts[0], 'errors': counts[1],
+                 'errorrate': round(100 * counts[1] / counts[0], 1) if counts[0] else 0.0, 'bytes': counts[2]}
+                for key, counts in entries]
+
+    @staticmethod
+    def series(minutes, start, end, width):
+        """Return the requests and errors of each width minute bucket from minute start to end"""
+        result = []
+        for bucket in range(start, end + 1, width):
+            requests = errors = 0
+            for minute in range(bucket, bucket + width):
+                counts = minutes.get(minute)
+                if counts:
+                    requests += counts[0]
+                    errors += counts[1]
+            result.append({'time': bucket * 60, 'label': datetime.fromtimestamp(bucket * 60).strftime('%H:%M'),
+                           'requests': requests, 'errors': errors})
+        return result
+
+
+accessstats = AccessStats(lambda: settings['gunicornpath'] + 'gunicorn-access.log', lambda: settings['statspath'])
@@ -5,101 +5,163 @@ A Flask-based web application for monitoring and controlling valves through a RE
 This module serves as the main entry point and is designed to be run by Gunicorn.
 
 Features:
-- Web interface for valve status monitoring
+- Web interface for valve status monitoring, updated live from a Server-Sent Events stream
 - REST API for programmatic valve control with API key authentication
 - System monitoring (CPU temperature, thread listing)
-- Log viewing (application logs, Gunicorn logs, system logs)
+- Prometheus metrics (request and GPIO latency, command outcomes, CPU temperature, threads)
+- Log viewing (application logs, Gunicorn logs, system logs) with level, time range and text filters
+- Access statistics per endpoint, client and status with request and error rates, from the access log
 
 The application exposes endpoints for valve control, system status, and log viewing.
 """
 
 
-import subprocess
-from threading import enumerate as enumerate_threads
-from flask import Flask, render_template, jsonify, request
+import json
+import logging
+from time import perf_counter, time
+from concurrent.futures import TimeoutError as CommandTimeout
+from flask import Flask, render_template, jsonify, request, Response, g
 from logmanager import  logger
-from valvecontrol import httpstatus, valvestatus, parsecontrol
-from app_control import settings, VERSION
+from journalreader import readjournal, PRIORITIES
+from valvehistory import transitions, stateat, parsewhen
+from valvecontrol import httpstatus, valvestatus, parsecontrol, parsebatch, parsetimed, listtimers, driftstatus, \
+    parsesequence, listsequences, healthstatus, statesnapshot, waitforchange, statechanges, valvetable, \
+    metricstext, telemetryhistory
+from executor import ExecutorBusy
+from app_control import settings, pinsettings, releasesettings, VERSION
+import metrics
+from webcommon import read_log_from_file, read_cpu_temperature, statuspagetag, statusbodies, THREADROWS, withthreads, \
+    apimessage, batchoperations
+from settingswatcher import watcher
+from accessstats import accessstats
 
 logger.info('Starting Valve Controller web app version %s', VERSION)
 logger.info('Api-Key = %s', settings['api-key'])
 app = Flask(__name__)
+watcher.start()
 
 
-def read_log_from_file(file_path):
+@app.before_request
+def starttimer():
     """
-    Reads and returns the reversed content of a log file.
+    Record the start time of the request for the latency metrics, and pin the settings snapshot
+    the request uses throughout (g.settings, and every settings lookup made while it runs) so a
+    reload part way through does not affect it.
+    """
+    g.requeststart = perf_counter()
+    g.settings = pinsettings()
+
+
+@app.after_request
+def recordlatency(response):
+    """Record the time taken by the request in the latency histogram for its route"""
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.requestlatency.observe(perf_counter() - g.requeststart, route, request.method)
+    return response
+
 
-    This function opens the specified file in read mode with UTF-8 encoding, reads its
-    contents into a list of lines, reverses the order of the lines, and returns the
-    reversed list.
+@app.teardown_request
+def unpinsettings(_error):
+    """Release the settings snapshot pinned for the request"""
+    releasesettings()
 
-    Args:
-        file_path (str): The path to the file to be read.
+
+def apikeyerror():
+    """
+    Checks the Api-Key header of the current request against the key in the settings.
 
     Returns:
-        list: A list of strings representing the lines of the file, in reversed order.
+        tuple: None if the key is present and correct, otherwise a (message, 401) response
+        tuple that the route can return directly.
     """
-    with open(file_path, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-    return list(reversed(lines))
+    if 'Api-Key' in request.headers.keys():  # check api key exists
+        if request.headers['Api-Key'] == g.settings['api-key']:  # check for correct API key
+            return None
+        logger.warning('API: access attempt using an invalid token')
+        return 'access token(s) unuthorised', 401
+    logger.warning('API: access attempt without a token')
+    return 'access token(s) incorrect', 401
 
 
-def read_cpu_temperature():
+def busyresponse(error):
     """
-    Reads the CPU temperature from a file specified in the application settings.
+    Builds the response sent when the hardware executor cannot take or finish a command.
 
-    This function opens the file path defined in the settings, reads the CPU
-    temperature data in millidegrees Celsius, converts it to degrees Celsius, and
-    rounds the resulting value to one decimal place before returning it.
-
-    Raises:
-        FileNotFoundError: If the file path specified in the settings does not
-            exist.
-        IOError: If there is an error reading the file.
-        ValueError: If the temperature file content cannot be converted to a float.
+    Parameters:
+        error (Exception): ExecutorBusy if the command queue was full, otherwise a timeout.
 
     Returns:
-        float: The CPU temperature in degrees Celsius, rounded to one decimal place.
+        tuple: A (message, 503, headers) response tuple asking the client to retry.
     """
-    with open(settings['cputemp'], 'r', encoding='utf-8') as f:
-        log = f.readline()
-    return round(float(log) / 1000, 1)
+    if isinstance(error, ExecutorBusy):
+        logger.warning('API: hardware command queue full, request refused')
+        metrics.commands.inc('busy')
+        return 'controller busy, please retry', 503, {'Retry-After': '1'}
+    logger.warning('API: hardware command timed out')
+    metrics.commands.inc('timeout')
+    return 'controller did not respond in time', 503, {'Retry-After': '1'}
 
 
-def threadlister():
-    """
-    Generates a list of threads currently running in the application.
+def notmodified(etag, weak=False):
+    """Return a 304 response if the request's If-None-Match matches etag (weak comparison), otherwise None"""
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers={'ETag': ('W/"%s"' if weak else '"%s"') % etag,
+                                             'Cache-Control': 'no-cache'})
+    return None
 
-    This function retrieves all active threads in the process, collecting their
-    names and native thread IDs, and returns the result as a list. Each thread's
-    information is represented as a sublist containing the thread's name and ID.
 
-    Returns:
-        list: A list of sublists where each sublist contains a thread's name
-            and native thread ID.
+def statusresponse(code=200, fresh=False, entry=None):
     """
-    appthreads = []
-    for appthread in enumerate_threads():
-        appthreads.append([appthread.name, appthread.native_id])
-    return appthreads
+    Return the JSON valve status with the ETag of its state version, from the shared entry.
+
+    Parameters:
+        code (int): The HTTP status code.
+        fresh (bool): Take a new state snapshot, used straight after a command.
+        entry (StatusEntry): An entry already fetched by the caller.
+    """
+    if entry is None:
+        entry = statusbodies.get(fresh)
+    response = Response(entry.body, status=code, mimetype='application/json')
+    response.set_etag(entry.etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+indexcache = (None, None)
+"""The last rendered status page as (etag, html), the thread rows left out (see withthreads)"""
 
 
 @app.route('/')
 def index():
     """
     Define a route for the root URL that renders the 'index.html' template with various
-    context values including CPU temperature, valve states, application version, and
-    running threads.
+    context values including CPU temperature, valve states, the result of the last
+    hardware reconciliation, application version, and running threads.
+
+    The page carries an ETag (see statuspagetag) so a browser revalidating with
+    If-None-Match gets a 304 with nothing rendered, and the rendered page is cached and
+    served to every client until the tag changes, with this worker's threads filled in.
 
     Returns
     -------
     flask.Response
-        The HTTP response object containing the rendered HTML template.
+        The HTTP response object containing the rendered HTML template, or a 304 response.
     """
-    cputemperature = read_cpu_temperature()
-    return render_template('index.html', valves=httpstatus(), cputemperature=cputemperature,
-                           version=VERSION, threads=threadlister())
+    global indexcache
+    etag, state, cputemperature = statuspagetag()
+    unchanged = notmodified(etag, weak=True)
+    if unchanged:
+        return unchanged
+    cachedtag, html = indexcache
+    if cachedtag != etag:
+        html = render_template('index.html', valves=httpstatus(state), cputemperature=cputemperature,
+                               drift=driftstatus(), version=VERSION, threadrows=THREADROWS)
+        indexcache = (etag, html)
+    html = withthreads(html, lambda threads: render_template('threads.html', threads=threads))
+    response = Response(html, mimetype='text/html')
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 
 @app.route('/api', methods=['POST'])
@@ -111,7 +173,11 @@ def api():
     of the request for an API key and validates it. If the key is valid, it
     processes the request to execute a command on the given item via the
     `parsecontrol` function. The response about the item's status is then
-    returned in JSON format. In case of incorrect or missing API key, or
+    returned in JSON format. A message with a 'delay' and/or 'duration' (milliseconds) is a
+    timed valve command run by `parsetimed`, e.g. {'item': 'valve3', 'command': 'open',
+    'duration': 250}, and returns the scheduled timers along with the status. A stored sequence
+    is started with {'item': 'sequence', 'command': name}, returning its run id, and a run is
+    queried or aborted with {'item': 'runN', 'command': 'status' or 'abort'}. In case of incorrect or missing API key, or
     if the request contains malformed JSON, appropriate HTTP error
     responses are returned.
 
@@ -125,24 +191,264 @@ def api():
         of the requested command in JSON format along with a
         201 status code.
         str: Returns an error message with a 401 status code
-        in cases of unauthorized access or JSON parsing errors.
+        in cases of unauthorized access or JSON parsing errors, or with
+        a 503 status code when the hardware command queue is full.
     """
     try:
-        logger.debug('API headers: %s', request.headers)
-        logger.debug('API request: %s', request.json)
-        if 'Api-Key' in request.headers.keys():  # check api key exists
-            if request.headers['Api-Key'] == settings['api-key']:  # check for correct API key
-                item = request.json['item']
-                command = request.json['command']
-                parsecontrol(item, command)
-                return jsonify(valvestatus()), 201
-            logger.warning('API: access attempt using an invalid token')
-            return 'access token(s) unuthorised', 401
-        logger.warning('API: access attempt without a token')
-        return 'access token(s) incorrect', 401
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('API headers: %s', request.headers)
+            logger.debug('API request: %s', request.get_data(as_text=True))
+        keyerror = apikeyerror()
+        if keyerror:
+            return keyerror
+        message = apimessage(request.get_json(silent=True))
+        if message is None:
+            return "badly formed json message", 401
+        item, command = message
+        if item == 'sequence' or item[:3] == 'run':
+            result = parsesequence(item, command)
+            if 'error' in result:
+                return jsonify({'error': result['error'], 'status': valvestatus()}), 409
+            return jsonify({'run': result['run'], 'status': valvestatus()}), 201
+        if item == 'status':
+            return statusresponse(201)
+        if 'delay' in request.json or 'duration' in request.json:
+            result = parsetimed(item, command, request.json.get('delay', 0), request.json.get('duration', 0))
+            if 'error' in result:
+                return jsonify({'error': result['error'], 'status': valvestatus()}), 409
+            return jsonify({'timers': result['timers'], 'status': valvestatus()}), 201
+        parsecontrol(item, command)
+        return statusresponse(201, fresh=True)
+    except (ExecutorBusy, CommandTimeout) as error:
+        return busyresponse(error)
     except KeyError:
         logger.warning('API: Badly formed json message')
+        metrics.commands.inc('bad_json')
+        return "badly formed json message", 401
+
+
+@app.route('/api/batch', methods=['POST'])
+def apibatch():
+    """
+    Handles API POST requests that apply an ordered list of valve operations in one call.
+
+    The body is either a JSON list of {"item": ..., "command": ...} operations or an object
+    with that list under "operations". The whole list is checked against the valve interlocks
+    before any valve is moved and is then applied all-or-nothing, so a single request replaces
+    a series of /api calls and returns one status snapshot.
+
+    Returns:
+        Response: The status of all valves in JSON format with a 201 status code when the batch
+        was applied, or a JSON object containing the rejection reason and the unchanged valve
+        status with a 409 status code.
+        str: An error message with a 401 status code for a missing or invalid API key or a
+        badly formed JSON message, or a 503 status code if the controller is too busy.
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('API batch headers: %s', request.headers)
+    keyerror = apikeyerror()
+    if keyerror:
+        return keyerror
+    operations = batchoperations(request.get_json(silent=True))
+    if operations is None:
         return "badly formed json message", 401
+    try:
+        error = parsebatch(operations)
+    except (ExecutorBusy, CommandTimeout) as busy:
+        return busyresponse(busy)
+    if error:
+        return jsonify({'error': error, 'status': valvestatus()}), 409
+    return jsonify(valvestatus()), 201
+
+
+@app.route('/api/telemetry', methods=['GET'])
+def apitelemetry():
+    """
+    Returns the telemetry history sampled by the process that owns the GPIO (CPU temperature,
+    throttle flags, load average and thread count) downsampled into min/max/avg buckets.
+
+    Query parameters:
+        buckets: The number of buckets, default 60.
+        since: Only samples from the last this many seconds, default all the samples kept.
+
+    Returns:
+        Response: The telemetry in JSON format or 401 without a valid Api-Key.
+    """
+    keyerror = apikeyerror()
+    if keyerror:
+        return keyerror
+    since = request.args.get('since', type=float)
+    try:
+        return jsonify(telemetryhistory(max(1, request.args.get('buckets', 60, type=int)),
+                                        None if since is None else time() - since))
+    except (ExecutorBusy, CommandTimeout, RuntimeError):
+        return 'telemetry unavailable, the GPIO owner did not answer', 503
+
+
+@app.route('/api/status', methods=['GET'])
+def apistatus():
+    """
+    Returns the JSON valve status with an ETag of the state version, so a client polling with
+    If-None-Match gets a 304 with no body until a valve changes.
+
+    Returns:
+        Response: The valve status in JSON format, 304 if unchanged or 401 without a valid Api-Key.
+    """
+    keyerror = apikeyerror()
+    if keyerror:
+        return keyerror
+    entry = statusbodies.get()
+    unchanged = notmodified(entry.etag)
+    if unchanged:
+        return unchanged
+    return statusresponse(entry=entry)
+
+
+@app.route('/api/sequences', methods=['GET'])
+def apisequences():
+    """
+    Lists the stored sequences with their number of compiled stages, the sequences rejected
+    when the settings were loaded and why, and the progress of the recent runs.
+
+    Returns:
+        Response: The sequences in JSON format, 401 without a valid Api-Key or 503 if the
+        controller is busy.
+    """
+    keyerror = apikeyerror()
+    if keyerror:
+        return keyerror
+    try:
+        return jsonify(listsequences())
+    except (ExecutorBusy, CommandTimeout) as error:
+        return busyresponse(error)
+
+
+@app.route('/api/timers', methods=['GET'])
+def apitimers():
+    """
+    Lists the pending timed valve actions, soonest first, followed by the recently finished ones
+    with the timing error each achieved (error_ms, the time between its due time and when it ran).
+
+    Returns:
+        Response: The timers in JSON format, 401 without a valid Api-Key or 503 if the
+        controller is busy.
+    """
+    keyerror = apikeyerror()
+    if keyerror:
+        return keyerror
+    try:
+        return jsonify(listtimers())
+    except (ExecutorBusy, CommandTimeout) as error:
+        return busyresponse(error)
+
+
+@app.route('/api/history', methods=['GET'])
+def apihistory():
+    """
+    Answers queries about past valve states from the valve history journal.
+
+    With an 'at' query parameter the state of every valve at that time is returned. Otherwise
+    the transitions between 'start' and 'end' are returned, optionally only for the valve
+    given by 'valve' and limited to 'limit' records. Times are seconds since the epoch or local
+    times in the form YYYY-MM-DDTHH:MM[:SS].
+
+    Returns:
+        Response: JSON, {"at": time, "valves": {id: state}} for a state query or a list of
+        transitions {"time", "timestamp", "valve", "old", "new", "source"}, with a 200 status code.
+        str: An error message with a 401 status code for a missing or invalid API key or a
+        400 status code for an unrecognised time.
+    """
+    keyerror = apikeyerror()
+    if keyerror:
+        return keyerror
+    if 'at' in request.args:
+        when = parsewhen(request.args.get('at'))
+        if when is None:
+            return 'unrecognised time', 400
+        return jsonify({'at': when, 'valves': stateat(when, valvetable.ids)})
+    start = parsewhen(request.args.get('start'))
+    end = parsewhen(request.args.get('end'))
+    if (request.args.get('start') and start is None) or (request.args.get('end') and end is None):
+        return 'unrecognised time', 400
+    return jsonify(transitions(request.args.get('valve', type=int), start, end,
+                               request.args.get('limit', 10000, type=int)))
+
+
+def statusevents(keepalive=15):
+    """
+    Generator for the Server-Sent Events valve status stream.
+
+    The first event is a 'snapshot' holding the state of every valve, after that a 'change'
+    event holding only the valves that changed is sent each time the valve state changes. A
+    comment line is sent after keepalive seconds without a change so proxies keep the
+    connection open.
+
+    Parameters:
+        keepalive (float): Seconds to wait for a change before sending a keep-alive comment.
+
+    Yields:
+        str: Server-Sent Events formatted messages.
+    """
+    version, state = statesnapshot()
+    yield 'event: snapshot\ndata: %s\n\n' % json.dumps({'version': version,
+                                                         'valves': statechanges(None, state)})
+    while True:
+        newversion, newstate = waitforchange(version, keepalive)
+        if newversion == version:
+            yield ': keepalive\n\n'
+            continue
+        yield 'event: change\ndata: %s\n\n' % json.dumps({'version': newversion,
+                                                           'valves': statechanges(state, newstate)})
+        version, state = newversion, newstate
+
+
+@app.route('/stream')
+def stream():
+    """
+    Streams valve state changes to the client as Server-Sent Events.
+
+    Clients receive a snapshot of every valve when they connect and then a small event for each
+    transition, so they do not need to poll the status page or the API.
+
+    Returns:
+        flask.Response: A text/event-stream response that stays open until the client disconnects.
+    """
+    return Response(statusevents(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/healthz')
+def healthz():
+    """
+    Health and readiness check for load balancers and monitors.
+
+    Answered from the shared state in memory: no template, sysfs read or GPIO access, so it can
+    be polled often. See valvecontrol.healthstatus for the fields.
+
+    Returns:
+        Response: The health in JSON format, with a 200 status code when ready or 503 when not.
+    """
+    health = healthstatus()
+    response = jsonify(health)
+    response.status_code = 200 if health['ready'] else 503
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+@app.route('/metrics')
+def showmetrics():
+    """
+    Serves the controller metrics in the Prometheus text exposition format.
+
+    Includes per-route request latency histograms, GPIO call timing, counts of each valve
+    command outcome, CPU temperature, active thread count and the log queue depth. The counters
+    and histograms are summed over every gunicorn worker by the GPIO owner, which also reads the
+    gauges, so the result does not depend on which worker serves the request.
+
+    Returns:
+        flask.Response: The metrics as text/plain.
+    """
+    return Response(metricstext(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/pylog')
@@ -159,8 +465,8 @@ def showplogs():
         including logs, log title, CPU temperature, and version.
     """
     cputemperature = read_cpu_temperature()
-    logs = read_log_from_file(settings['logfilepath'])
-    return render_template('logs.html', rows=logs, log='Valve-Control log',
+    logs, older = read_log_from_file(g.settings['logfilepath'], request.args)
+    return render_template('logs.html', rows=logs, log='Valve-Control log', older=older, filters=True,
                            cputemperature=cputemperature, version=VERSION)
 
 
@@ -177,8 +483,8 @@ def showgalogs():
         str: The rendered HTML content for the logs page.
     """
     cputemperature = read_cpu_temperature()
-    logs = read_log_from_file(settings['gunicornpath'] + 'gunicorn-access.log')
-    return render_template('logs.html', rows=logs, log='Gunicorn Access Log',
+    logs, older = read_log_from_file(g.settings['gunicornpath'] + 'gunicorn-access.log', request.args)
+    return render_template('logs.html', rows=logs, log='Gunicorn Access Log', older=older, filters=True,
                            cputemperature=cputemperature, version=VERSION)
 
 
@@ -196,32 +502,66 @@ def showgelogs():
         information.
     """
     cputemperature = read_cpu_temperature()
-    logs = read_log_from_file(settings['gunicornpath'] + 'gunicorn-error.log')
-    return render_template('logs.html', rows=logs, log='Gunicorn Error Log',
+    logs, older = read_log_from_file(g.settings['gunicornpath'] + 'gunicorn-error.log', request.args)
+    return render_template('logs.html', rows=logs, log='Gunicorn Error Log', older=older, filters=True,
                            cputemperature=cputemperature, version=VERSION)
 
 
+@app.route('/stats')
+def showstats():
+    """
+    Shows the website access statistics: requests, errors and bytes per endpoint and per client,
+    the count of each response status, and the request and error rates over the last hour and day.
+
+    The statistics are brought up to date from the lines added to the Gunicorn access log since
+    they were last saved (see accessstats), so the page does not read the whole log.
+
+    Returns:
+        str: The rendered HTML page.
+    """
+    cputemperature = read_cpu_temperature()
+    return render_template('stats.html', stats=accessstats.report(), cputemperature=cputemperature,
+                           version=VERSION)
+
+
+@app.route('/api/stats', methods=['GET'])
+def apistats():
+    """
+    Returns the website access statistics shown by /stats in JSON format.
+
+    Query parameters:
+        top: The number of endpoints and clients listed, default 25.
+
+    Returns:
+        Response: The statistics in JSON format or 401 without a valid Api-Key.
+    """
+    keyerror = apikeyerror()
+    if keyerror:
+        return keyerror
+    return jsonify(accessstats.report(max(1, request.args.get('top', 25, type=int))))
+
+
 @app.route('/syslog')
 def showslogs():
     """
-    Handles the '/syslog' route to display system log entries in reverse order along
+    Handles the '/syslog' route to display system log entries, newest first, along
     with CPU temperature.
 
-    Creates a Flask route that retrieves the latest system logs, reverses their
-    order, and renders them to an HTML template. Additionally, it retrieves and
-    displays the CPU temperature and a version parameter.
+    The entries come from the journal reader, which runs journalctl without a shell,
+    with a timeout, and shares a short-lived cache between concurrent requests. A page
+    holds 'journallines' entries, the journal cursor of the next older page is taken from
+    the 'before' query parameter and the entries can be filtered by systemd unit ('unit')
+    and minimum priority ('priority').
 
     Returns:
         str: Rendered HTML page showing system logs, CPU temperature, and a version
         identifier.
     """
     cputemperature = read_cpu_temperature()
-    log = subprocess.Popen('/bin/journalctl -n 200', shell=True,
-                           stdout=subprocess.PIPE).stdout.read().decode(encoding='utf-8')
-    logs = log.split('\n')
-    logs.reverse()
-    return render_template('logs.html', rows=logs, log='System Log', cputemperature=cputemperature,
-                           version=VERSION)
+    logs, older = readjournal(g.settings['journallines'], request.args.get('before'),
+                              request.args.get('unit'), request.args.get('priority'))
+    return render_template('logs.html', rows=logs, log='System Log', older=older, priorities=PRIORITIES,
+                           cputemperature=cputemperature, version=VERSION)
 
 
 
@@ -1,10 +1,20 @@
 """
 Settings module, reads the settings from a settings.json file. If it does not exist or a new setting
 has appeared it will creat from the defaults in the initialise function.
+
+The settings are held as an immutable snapshot that is replaced as a whole when the file is
+reloaded (see reloadsettings and settingswatcher), so a reader never sees half of an update.
+**settings** always reads from the latest snapshot, except while a web request is running: the
+request pins the snapshot it started with (pinsettings), and every lookup made for it, in the
+routes and in the modules they call, reads the pinned snapshot until the request ends.
 """
+import os
 import random
 import json
+from collections.abc import Mapping
+from contextvars import ContextVar
 from datetime import datetime
+from types import MappingProxyType
 
 VERSION = '2.1.6'
 
@@ -17,7 +27,56 @@ def initialise():
                  'logappname': 'Valve-Controller-Py',
                  'loglevel': 'INFO',
                  'gunicornpath': './logs/',
-                 'cputemp': '/sys/class/thermal/thermal_zone0/temp'}
+                 'cputemp': '/sys/class/thermal/thermal_zone0/temp',
+                 'reconcileinterval': 60,
+                 'loglines': 500,
+                 'maxloglines': 5000,
+                 'journallines': 200,
+                 'journaltimeout': 5,
+                 'journalcachetime': 10,
+                 'logqueuesize': 10000,
+                 'historypath': './logs/valvehistory.bin',
+                 'commandqueuesize': 64,
+                 'commandtimeout': 5,
+                 'sharedstatepath': '/dev/shm/valvecontroller.state',
+                 'ownersocket': '/tmp/valvecontroller-owner.sock',
+                 'asyncworkers': 8,
+                 'gpiobackend': 'lgpio',
+                 'gpiolatency': 0.0,
+                 'gpiochip': 0,
+                 'timerspin': 0.001,
+                 'sequences': {},
+                 'temperaturebucket': 1.0,
+                 'throttlepath': '/sys/devices/platform/soc/soc:firmware/get_throttled',
+                 'telemetryinterval': 5,
+                 'telemetrysamples': 17280,
+                 'statuswindow': 0.05,
+                 'socketport': 0,
+                 'socketaddress': '0.0.0.0',
+                 'socketpath': '',
+                 'settingspoll': 2,
+                 'statspath': './logs/accessstats.json',
+                 'watchdoginterval': 1.0,
+                 'watchdogtimeout': 5.0,
+                 'readypinmode': 'steady',
+                 'gatewaycontrollers': [],
+                 'gatewaytimeout': 2.0,
+                 'gatewaycommandtimeout': 10.0,
+                 'gatewaycache': 1.0,
+                 'gatewayconnections': 4,
+                 'valves': [{'id': 1, 'gpio': 23, 'description': '4He pipette input', 'excluded': 2},
+                            {'id': 2, 'gpio': 17, 'description': '4He pipette output', 'excluded': 1},
+                            {'id': 3, 'gpio': 13, 'description': '3He pipette output', 'excluded': 4},
+                            {'id': 4, 'gpio': 19, 'description': '3He pipette input', 'excluded': 3},
+                            {'id': 5, 'gpio': 18, 'description': 'port 1', 'excluded': 10},
+                            {'id': 6, 'gpio': 27, 'description': 'ion pump', 'excluded': 0},
+                            {'id': 7, 'gpio': 9, 'description': 'gas analyser', 'excluded': 0},
+                            {'id': 8, 'gpio': 24, 'description': 'gallery A', 'excluded': 0},
+                            {'id': 10, 'gpio': 22, 'description': 'laser cell', 'excluded': 5},
+                            {'id': 11, 'gpio': 11, 'description': 'getter', 'excluded': 0},
+                            {'id': 12, 'gpio': 21, 'description': 'buffer tank', 'excluded': 0},
+                            {'id': 13, 'gpio': 26, 'description': 'turbo pump', 'excluded': 0}],
+                 'exclusiongroups': []}
     return isettings
 
 
@@ -27,11 +86,61 @@ def generate_api_key(key_len):
     return ''.join(random.choice(allowed_characters) for _ in range(key_len))
 
 
-def writesettings():
+class LiveSettings(Mapping):
+    """
+    Read-only view of the settings that looks every value up in the snapshot pinned by the running
+    request, or in the latest snapshot outside a request
+    """
+
+    def __getitem__(self, key):
+        return currentsettings()[key]
+
+    def __iter__(self):
+        return iter(currentsettings())
+
+    def __len__(self):
+        return len(currentsettings())
+
+    def __repr__(self):
+        return 'LiveSettings(%r)' % dict(currentsettings())
+
+
+def currentsettings():
+    """Return the snapshot pinned by the running request, or else the latest one; a snapshot never changes once published"""
+    values = pinned.get()
+    return snapshot if values is None else values
+
+
+def pinsettings():
+    """
+    Pins the latest snapshot for the request running in this thread (Flask) or task (aiohttp),
+    until releasesettings is called.
+
+    Returns:
+        Mapping: The pinned snapshot.
+    """
+    pinned.set(snapshot)
+    return snapshot
+
+
+def releasesettings():
+    """Stop pinning a snapshot for the request that has ended, later lookups read the latest snapshot"""
+    pinned.set(None)
+
+
+def publish(values):
+    """Make a new snapshot of the settings values the current one"""
+    global snapshot
+    snapshot = MappingProxyType(values)
+
+
+def writesettings(values=None):
     """Write settings to json file"""
-    settings['LastSave'] = datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+    values = dict(snapshot if values is None else values)
+    values['LastSave'] = datetime.now().strftime('%d/%m/%Y %H:%M:%S')
     with open('settings.json', 'w', encoding='utf-8') as outfile:
-        json.dump(settings, outfile, indent=4, sort_keys=True)
+        json.dump(values, outfile, indent=4, sort_keys=True)
+    return values
 
 
 def readsettings():
@@ -45,23 +154,77 @@ def readsettings():
         return {}
 
 
-def loadsettings():
-    """Replace the default settings with thsoe from the json files"""
-    global settings
+def mergesettings(fsettings, report=True):
+    """
+    Fill in the default settings from those read from the json file.
+
+    Returns:
+        tuple: (settings dict, True if any setting was missing from the file and the default used)
+    """
+    values = initialise()
     settingschanged = False
-    fsettings = readsettings()
-    for item in settings.keys():
+    for item in values.keys():
         try:
-            settings[item] = fsettings[item]
+            values[item] = fsettings[item]
         except KeyError:
-            print('settings[%s] Not found in json file using default' % item)
+            if report:
+                print('settings[%s] Not found in json file using default' % item)
             settingschanged = True
-    if settings['api-key'] == 'change-me':
-        settings['api-key'] = generate_api_key(30)
+    return values, settingschanged
+
+
+def settingsstamp():
+    """Return (modification time, size) of the settings file, None if it does not exist"""
+    try:
+        stat = os.stat('settings.json')
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def loadsettings():
+    """Replace the default settings with thsoe from the json files"""
+    values, settingschanged = mergesettings(readsettings())
+    if values['api-key'] == 'change-me':
+        values['api-key'] = generate_api_key(30)
         settingschanged = True
     if settingschanged:
-        writesettings()
+        values = writesettings(values)
+    publish(values)
+
+
+def reloadsettings(check=None):
+    """
+    Reads the settings file again and publishes it as the new snapshot. Settings missing from the
+    file take their defaults, the file is not rewritten.
+
+    Parameters:
+        check (callable): check(new) is given the new settings before they are published and
+            returns a reason to refuse them, or None to accept them.
+
+    Returns:
+        tuple: (old snapshot, new snapshot), the same snapshot twice if nothing changed.
+
+    Raises:
+        ValueError: If the file cannot be parsed or check refused the new settings, the current
+            snapshot is kept.
+    """
+    old = snapshot
+    values, _ = mergesettings(readsettings(), report=False)
+    if values['api-key'] == 'change-me':
+        values['api-key'] = old['api-key']
+    if values == dict(old):
+        return old, old
+    reason = check(MappingProxyType(values)) if check else None
+    if reason:
+        raise ValueError(reason)
+    publish(values)
+    return old, snapshot
 
 
-settings = initialise()
+snapshot = MappingProxyType(initialise())
+pinned = ContextVar('pinned', default=None)
+"""The snapshot pinned by the request running in the current context, None outside a request"""
+settings = LiveSettings()
+"""The current settings, read-only, every lookup sees the latest reloaded values"""
 loadsettings()
@@ -0,0 +1,468 @@
+"""
+Valve Controller asyncio web application
+
+An alternative to the gunicorn gthread deployment of app.py that serves the same routes from a
+single asyncio event loop using aiohttp. Idle and long-lived connections (such as the /stream
+Server-Sent Events clients) cost a coroutine rather than a thread, and blocking work (valve
+commands, log and journal reads) is handed to a small worker pool set by the 'asyncworkers'
+setting.
+
+Run it in place of gunicorn with:
+    python asyncapp.py --unix /tmp/gunicorn.sock
+or for testing:
+    python asyncapp.py --port 8080
+"""
+
+import os
+import json
+import asyncio
+import logging
+import argparse
+from functools import partial
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as CommandTimeout
+from threading import Thread
+from time import perf_counter, time
+from urllib.parse import urlencode
+from aiohttp import web
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from werkzeug.datastructures import MultiDict
+from webcommon import read_log_from_file, read_cpu_temperature, statuspagetag, statusbodies, THREADROWS, withthreads, \
+    apimessage, batchoperations
+from logmanager import logger
+from journalreader import readjournal, PRIORITIES
+from valvehistory import transitions, stateat, parsewhen
+from valvecontrol import httpstatus, valvestatus, parsecontrol, parsebatch, parsetimed, listtimers, driftstatus, \
+    parsesequence, listsequences, healthstatus, statesnapshot, waitforchange, statechanges, valvetable, metricstext, \
+    telemetryhistory
+from executor import ExecutorBusy
+from app_control import settings, pinsettings, releasesettings, VERSION
+import metrics
+from accessstats import accessstats
+from settingswatcher import watcher
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+ENDPOINTS = {'index': '/', 'showplogs': '/pylog', 'showgalogs': '/guaccesslog', 'showgelogs': '/guerrorlog',
+             'showslogs': '/syslog', 'showmetrics': '/metrics', 'stream': '/stream', 'showstats': '/stats'}
+"""URL of each page by the Flask endpoint name used in the templates"""
+ACCESSLOGFORMAT = '%a - - %t "%r" %s %b "%{Referer}i" "%{User-Agent}i"'
+"""The same layout as the gunicorn access log so the log views and statistics still work"""
+
+pool = ThreadPoolExecutor(settings['asyncworkers'], thread_name_prefix='async-worker')
+
+
+def url_for(endpoint, **values):
+    """Template helper matching flask.url_for for the endpoints used by the templates"""
+    if endpoint == 'static':
+        return '/static/' + values.pop('filename')
+    path = ENDPOINTS[endpoint]
+    if values:
+        path += '?' + urlencode(values)
+    return path
+
+
+templates = Environment(loader=FileSystemLoader(os.path.join(BASEDIR, 'templates')),
+                        autoescape=select_autoescape(['html']))
+templates.globals['url_for'] = url_for
+
+
+class TemplateRequest:
+    """The parts of the Flask request object that the templates use"""
+
+    def __init__(self, request, endpoint):
+        self.path = request.path
+        self.args = MultiDict(request.query.items())
+        self.endpoint = endpoint
+
+
+def render(request, endpoint, template, **context):
+    """Render a template to an HTML response"""
+    html = templates.get_template(template).render(request=TemplateRequest(request, endpoint), **context)
+    return web.Response(text=html, content_type='text/html')
+
+
+async def blocking(function, *args, **kwargs):
+    """Run a blocking function on the worker pool, in a copy of the caller's context, and return its result"""
+    return await asyncio.get_running_loop().run_in_executor(pool, partial(copy_context().run, function, *args,
+                                                                          **kwargs))
+
+
+def apikeyerror(request):
+    """Return a 401 response if the Api-Key header is missing or wrong, otherwise None"""
+    if 'Api-Key' in request.headers:
+        if request.headers['Api-Key'] == request['settings']['api-key']:
+            return None
+        logger.warning('API: access attempt using an invalid token')
+        return web.Response(text='access token(s) unuthorised', status=401)
+    logger.warning('API: access attempt without a token')
+    return web.Response(text='access token(s) incorrect', status=401)
+
+
+def busyresponse(error):
+    """Return the 503 response for a full command queue or a command timeout"""
+    if isinstance(error, ExecutorBusy):
+        logger.warning('API: hardware command queue full, request refused')
+        metrics.commands.inc('busy')
+        return web.Response(text='controller busy, please retry', status=503, headers={'Retry-After': '1'})
+    logger.warning('API: hardware command timed out')
+    metrics.commands.inc('timeout')
+    return web.Response(text='controller did not respond in time', status=503, headers={'Retry-After': '1'})
+
+
+@web.middleware
+async def recordlatency(request, handler):
+    """
+    Record the time taken by each request in the latency histogram for its route, and give the
+    request the settings snapshot it uses throughout (request['settings']). The snapshot is pinned
+    for the request's task, so every settings lookup made for it, including those in blocking
+    calls, reads the same snapshot.
+    """
+    start = perf_counter()
+    request['settings'] = pinsettings()
+    try:
+        return await handler(request)
+    finally:
+        releasesettings()
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else 'unmatched'
+        metrics.requestlatency.observe(perf_counter() - start, route, request.method)
+
+
+class StateBroadcaster:
+    """
+    Waits for valve state changes on one thread and wakes every /stream client.
+
+    A single thread blocks in waitforchange and publishes each new (version, state) snapshot to
+    the event loop, so any number of stream clients cost no threads at all.
+    """
+
+    def __init__(self):
+        self.snapshot = statesnapshot()
+        self.changed = None
+        self.loop = None
+
+    def start(self, loop):
+        """Start the waiting thread, publishing to the given event loop"""
+        self.loop = loop
+        self.changed = asyncio.Event()
+        Thread(target=self.watch, name='stream-broadcaster', daemon=True).start()
+
+    def stop(self):
+        """Stop publishing, the waiting thread ends at the next state change"""
+        self.loop = None
+
+    def watch(self):
+        """Thread loop that passes every state change to the event loop, until it is stopped or the loop closes"""
+        version = self.snapshot[0]
+        loop = self.loop
+        while self.loop is loop:
+            snapshot = waitforchange(version, 60)
+            if snapshot[0] != version and self.loop is loop:
+                version = snapshot[0]
+                try:
+                    loop.call_soon_threadsafe(self.publish, snapshot)
+                except RuntimeError:   # the event loop has closed
+                    return
+
+    def publish(self, snapshot):
+        """Record the new snapshot and wake every waiting client, runs on the event loop"""
+        self.snapshot = snapshot
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+broadcaster = StateBroadcaster()
+
+
+def notmodified(request, etag, weak=False):
+    """Return a 304 response if the request's If-None-Match matches etag (weak comparison), otherwise None"""
+    if any(value.value == etag for value in request.if_none_match or ()):
+        return web.Response(status=304, headers={'ETag': ('W/"%s"' if weak else '"%s"') % etag,
+                                                 'Cache-Control': 'no-cache'})
+    return None
+
+
+def statusresponse(status=200, fresh=False, entry=None):
+    """Return the JSON valve status with the ETag of its state version, see app.statusresponse"""
+    if entry is None:
+        entry = statusbodies.get(fresh)
+    return web.Response(body=entry.body, status=status, content_type='application/json',
+                        headers={'ETag': '"%s"' % entry.etag, 'Cache-Control': 'no-cache'})
+
+
+indexcache = (None, None)
+"""The last rendered status page as (etag, response text), the thread rows left out (see withthreads)"""
+
+
+async def index(request):
+    """The valve status page, with an ETag and a render cache, see app.index"""
+    global indexcache
+    etag, state, cputemperature = statuspagetag()
+    unchanged = notmodified(request, etag, weak=True)
+    if unchanged:
+        return unchanged
+    cachedtag, html = indexcache
+    if cachedtag != etag:
+        html = render(request, 'index', 'index.html', valves=httpstatus(state), cputemperature=cputemperature,
+                      drift=driftstatus(), version=VERSION, threadrows=THREADROWS).text
+        indexcache = (etag, html)
+    html = withthreads(html, lambda threads: templates.get_template('threads.html').render(threads=threads))
+    return web.Response(text=html, content_type='text/html',
+                        headers={'ETag': 'W/"%s"' % etag, 'Cache-Control': 'no-cache'})
+
+
+async def apitelemetry(request):
+    """The downsampled telemetry history, see app.apitelemetry"""
+    keyerror = apikeyerror(request)
+    if keyerror:
+        return keyerror
+    args = MultiDict(request.query.items())
+    since = args.get('since', type=float)
+    try:
+        return web.json_response(await blocking(telemetryhistory, max(1, args.get('buckets', 60, type=int)),
+                                                None if since is None else time() - since))
+    except (ExecutorBusy, CommandTimeout, RuntimeError):
+        return web.Response(text='telemetry unavailable, the GPIO owner did not answer', status=503)
+
+
+async def apistatus(request):
+    """The JSON valve status with an ETag of the state version, see app.apistatus"""
+    keyerror = apikeyerror(request)
+    if keyerror:
+        return keyerror
+    entry = statusbodies.get()
+    unchanged = notmodified(request, entry.etag)
+    if unchanged:
+        return unchanged
+    return statusresponse(entry=entry)
+
+
+async def api(request):
+    """Run a single {item, command} valve command, see app.api"""
+    try:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('API headers: %s', dict(request.headers))
+        keyerror = apikeyerror(request)
+        if keyerror:
+            return keyerror
+        message = await request.json()
+        parsed = apimessage(message)
+        if parsed is None:
+            return web.Response(text='badly formed json message', status=401)
+        item, command = parsed
+        if item == 'sequence' or item[:3] == 'run':
+            result = await blocking(parsesequence, item, command)
+            if 'error' in result:
+                return web.json_response({'error': result['error'], 'status': valvestatus()}, status=409)
+            return web.json_response({'run': result['run'], 'status': valvestatus()}, status=201)
+        if item == 'status':
+            return statusresponse(201)
+        if 'delay' in message or 'duration' in message:
+            result = await blocking(parsetimed, item, command, message.get('delay', 0),
+                                    message.get('duration', 0))
+            if 'error' in result:
+                return web.json_response({'error': result['error'], 'status': valvestatus()}, status=409)
+            return web.json_response({'timers': result['timers'], 'status': valvestatus()}, status=201)
+        await blocking(parsecontrol, item, command)
+        return statusresponse(201, fresh=True)
+    except (ExecutorBusy, CommandTimeout) as error:
+        return busyresponse(error)
+    except (KeyError, TypeError, ValueError):
+        logger.warning('API: Badly formed json message')
+        metrics.commands.inc('bad_json')
+        return web.Response(text='badly formed json message', status=401)
+
+
+async def apibatch(request):
+    """Apply an ordered list of valve operations all-or-nothing, see app.apibatch"""
+    keyerror = apikeyerror(request)
+    if keyerror:
+        return keyerror
+    try:
+        operations = batchoperations(await request.json())
+    except ValueError:
+        operations = batchoperations(None)
+    if operations is None:
+        return web.Response(text='badly formed json message', status=401)
+    try:
+        error = await blocking(parsebatch, operations)
+    except (ExecutorBusy, CommandTimeout) as busy:
+        return busyresponse(busy)
+    if error:
+        return web.json_response({'error': error, 'status': valvestatus()}, status=409)
+    return web.json_response(valvestatus(), status=201)
+
+
+async def apisequences(request):
+    """List the stored sequences and recent runs, see app.apisequences"""
+    keyerror = apikeyerror(request)
+    if keyerror:
+        return keyerror
+    try:
+        return web.json_response(await blocking(listsequences))
+    except (ExecutorBusy, CommandTimeout) as error:
+        return busyresponse(error)
+
+
+async def apitimers(request):
+    """List the pending and recently finished timed actions, see app.apitimers"""
+    keyerror = apikeyerror(request)
+    if keyerror:
+        return keyerror
+    try:
+        return web.json_response(await blocking(listtimers))
+    except (ExecutorBusy, CommandTimeout) as error:
+        return busyresponse(error)
+
+
+async def apihistory(request):
+    """Query the valve history journal, see app.apihistory"""
+    keyerror = apikeyerror(request)
+    if keyerror:
+        return keyerror
+    args = MultiDict(request.query.items())
+    if 'at' in args:
+        when = parsewhen(args.get('at'))
+        if when is None:
+            return web.Response(text='unrecognised time', status=400)
+        return web.json_response({'at': when, 'valves': await blocking(stateat, when, valvetable.ids)})
+    start = parsewhen(args.get('start'))
+    end = parsewhen(args.get('end'))
+    if (args.get('start') and start is None) or (args.get('end') and end is None):
+        return web.Response(text='unrecognised time', status=400)
+    return web.json_response(await blocking(transitions, args.get('valve', type=int), start, end,
+                                            args.get('limit', 10000, type=int)))
+
+
+async def stream(request, keepalive=15):
+    """Stream valve changes as Server-Sent Events, see app.statusevents"""
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache',
+                                           'X-Accel-Buffering': 'no'})
+    await response.prepare(request)
+    version, state = broadcaster.snapshot
+    try:
+        await response.write(('event: snapshot\ndata: %s\n\n' % json.dumps(
+            {'version': version, 'valves': statechanges(None, state)})).encode('utf-8'))
+        while True:
+            changed = broadcaster.changed
+            newversion, newstate = broadcaster.snapshot
+            if newversion != version:
+                await response.write(('event: change\ndata: %s\n\n' % json.dumps(
+                    {'version': newversion, 'valves': statechanges(state, newstate)})).encode('utf-8'))
+                version, state = newversion, newstate
+                continue
+            try:
+                await asyncio.wait_for(changed.wait(), keepalive)
+            except asyncio.TimeoutError:
+                await response.write(b': keepalive\n\n')
+    except ConnectionResetError:
+        pass
+    return response
+
+
+async def healthz(_request):
+    """The health and readiness check, see app.healthz"""
+    health = healthstatus()
+    return web.json_response(health, status=200 if health['ready'] else 503, headers={'Cache-Control': 'no-store'})
+
+
+async def showmetrics(_request):
+    """The Prometheus metrics, see app.showmetrics"""
+    return web.Response(body=(await blocking(metricstext)).encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+def logview(endpoint, title, file_path):
+    """Build a handler that shows one log file, see app.showplogs"""
+    async def handler(request):
+        cputemperature = read_cpu_temperature()
+        logs, older = await blocking(read_log_from_file, file_path(), MultiDict(request.query.items()))
+        return render(request, endpoint, 'logs.html', rows=logs, log=title, older=older, filters=True,
+                      cputemperature=cputemperature, version=VERSION)
+    return handler
+
+
+async def showslogs(request):
+    """The system journal, see app.showslogs"""
+    args = MultiDict(request.query.items())
+    cputemperature = read_cpu_temperature()
+    logs, older = await blocking(readjournal, settings['journallines'], args.get('before'),
+                                 args.get('unit'), args.get('priority'))
+    return render(request, 'showslogs', 'logs.html', rows=logs, log='System Log', older=older,
+                  priorities=PRIORITIES, cputemperature=cputemperature, version=VERSION)
+
+
+async def showstats(request):
+    """The website access statistics, see app.showstats"""
+    cputemperature = read_cpu_temperature()
+    stats = await blocking(accessstats.report)
+    return render(request, 'showstats', 'stats.html', stats=stats, cputemperature=cputemperature, version=VERSION)
+
+
+async def apistats(request):
+    """The website access statistics in JSON format, see app.apistats"""
+    keyerror = apikeyerror(request)
+    if keyerror:
+        return keyerror
+    top = MultiDict(request.query.items()).get('top', 25, type=int)
+    return web.json_response(await blocking(accessstats.report, max(1, top)))
+
+
+async def startbroadcaster(_app):
+    """Start the stream broadcaster once the event loop is running"""
+    broadcaster.start(asyncio.get_running_loop())
+
+
+async def stopbroadcaster(_app):
+    """Stop the stream broadcaster when the application shuts down"""
+    broadcaster.stop()
+
+
+app = web.Application(middlewares=[recordlatency])
+app.on_startup.append(startbroadcaster)
+app.on_cleanup.append(stopbroadcaster)
+app.router.add_get('/', index)
+app.router.add_post('/api', api)
+app.router.add_post('/api/batch', apibatch)
+app.router.add_get('/api/status', apistatus)
+app.router.add_get('/api/telemetry', apitelemetry)
+app.router.add_get('/api/sequences', apisequences)
+app.router.add_get('/api/timers', apitimers)
+app.router.add_get('/api/history', apihistory)
+app.router.add_get('/api/stats', apistats)
+app.router.add_get('/stream', stream)
+app.router.add_get('/healthz', healthz)
+app.router.add_get('/metrics', showmetrics)
+app.router.add_get('/pylog', logview('showplogs', 'Valve-Control log', lambda: settings['logfilepath']))
+app.router.add_get('/guaccesslog', logview('showgalogs', 'Gunicorn Access Log',
+                                           lambda: settings['gunicornpath'] + 'gunicorn-access.log'))
+app.router.add_get('/guerrorlog', logview('showgelogs', 'Gunicorn Error Log',
+                                          lambda: settings['gunicornpath'] + 'gunicorn-error.log'))
+app.router.add_get('/syslog', showslogs)
+app.router.add_get('/stats', showstats)
+app.router.add_static('/static', os.path.join(BASEDIR, 'static'))
+
+
+def main():
+    """Command line entry point, serves the application on a UNIX socket or TCP port"""
+    parser = argparse.ArgumentParser(description='Valve Controller asyncio web server')
+    parser.add_argument('--unix', help='UNIX socket path to listen on, e.g. /tmp/gunicorn.sock')
+    parser.add_argument('--host', default='127.0.0.1', help='TCP address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='TCP port to listen on')
+    arguments = parser.parse_args()
+    accesslog = logging.getLogger('aiohttp.access')
+    accesslog.setLevel(logging.INFO)
+    accesslog.addHandler(logging.FileHandler(settings['gunicornpath'] + 'gunicorn-access.log'))
+    logger.info('Starting Valve Controller asyncio server version %s', VERSION)
+    logger.info('Api-Key = %s', settings['api-key'])
+    watcher.start()
+    if arguments.unix:
+        os.umask(0o007)   # let nginx (www-data group) connect to the socket
+        web.run_app(app, path=arguments.unix, access_log=accesslog, access_log_format=ACCESSLOGFORMAT)
+    else:
+        web.run_app(app, host=arguments.host, port=arguments.port, access_log=accesslog,
+                    access_log_format=ACCESSLOGFORMAT)
+
+
+if __name__ == '__main__':
+    main()
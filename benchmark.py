@@ -0,0 +1,239 @@
+"""
+Load benchmark for the Valve Controller.
+
+Runs the Flask application in this process on the simulated GPIO backend (see gpiobackend),
+from a scratch directory holding its own settings.json, logs and shared state, so it can be run
+on any Linux machine without disturbing a live controller. Each scenario is driven by a number
+of concurrent client threads and the throughput and p50/p99 latency are reported. A run can be
+saved as a baseline and later runs compared with it; the exit status is 1 if any scenario
+returned errors or regressed by more than the tolerance.
+
+Usage:
+    python benchmark.py                                 run every scenario
+    python benchmark.py --save baseline.json            run and record the results
+    python benchmark.py --baseline baseline.json        run and fail on regressions
+    python benchmark.py --scenarios api-open,index --concurrency 32 --requests 5000 --latency 0.0001
+    python benchmark.py --url http://192.168.1.10:80 --apikey KEY    load test a running controller
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import http.client
+from datetime import datetime, timedelta
+from itertools import count
+from math import ceil
+from threading import Thread
+from time import perf_counter
+from urllib.parse import urlsplit
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+APIKEY = 'benchmark-key'
+VALVES = [1, 2, 3, 4, 5, 6, 7, 8, 10, 11, 12, 13]
+SCENARIOS = {
+    'api-open': ('POST', '/api', lambda i: {'item': 'valve%d' % VALVES[i % len(VALVES)], 'command': 'open'}),
+    'api-close': ('POST', '/api', lambda i: {'item': 'valve%d' % VALVES[i % len(VALVES)], 'command': 'close'}),
+    'api-closeall': ('POST', '/api', lambda i: {'item': 'closeallvalves', 'command': 1}),
+    'index': ('GET', '/', None),
+    'pylog': ('GET', '/pylog', None),
+    'guaccesslog': ('GET', '/guaccesslog', None),
+    'guerrorlog': ('GET', '/guerrorlog', None),
+}
+"""Scenario name: (method, path, function building the JSON body for request number i)"""
+
+
+def preparedirectory(workdir, latency, loglines):
+    """
+    Creates the scratch settings, log files and temperature file for an in-process run.
+
+    Parameters:
+        workdir (str): The scratch directory, becomes the working directory of the application.
+        latency (float): Simulated seconds per GPIO call.
+        loglines (int): Number of lines written to each sample log file.
+    """
+    logdir = os.path.join(workdir, 'logs')
+    os.makedirs(logdir, exist_ok=True)
+    with open(os.path.join(workdir, 'cputemp'), 'w', encoding='utf-8') as file:
+        file.write('45000\n')
+    settings = {'api-key': APIKEY, 'gpiobackend': 'simulated', 'gpiolatency': latency,
+                'cputemp': os.path.join(workdir, 'cputemp'), 'loglevel': 'WARNING',
+                'logfilepath': os.path.join(logdir, 'valvecontroller.log'), 'gunicornpath': logdir + '/',
+                'historypath': os.path.join(logdir, 'valvehistory.bin'),
+                'sharedstatepath': os.path.join(workdir, 'valvecontroller.state'),
+                'ownersocket': os.path.join(workdir, 'owner.sock')}
+    with open(os.path.join(workdir, 'settings.json'), 'w', encoding='utf-8') as file:
+        json.dump(settings, file, indent=4)
+    start = datetime(2025, 1, 1)
+    with open(settings['logfilepath'], 'w', encoding='utf-8') as pylog, \
+            open(os.path.join(logdir, 'gunicorn-access.log'), 'w', encoding='utf-8') as accesslog, \
+            open(os.path.join(logdir, 'gunicorn-error.log'), 'w', encoding='utf-8') as errorlog:
+        for line in range(loglines):
+            when = start + timedelta(seconds=line * 7)
+            pylog.write('%s,000, Valve-Controller-Py, INFO : Valve %d opened\n'
+                        % (when.strftime('%Y-%m-%d %H:%M:%S'), VALVES[line % len(VALVES)]))
+            accesslog.write('127.0.0.1 - - [%s +0000] "POST /api HTTP/1.0" 201 512 "-" "python-requests/2.31"\n'
+                            % when.strftime('%d/%b/%Y:%H:%M:%S'))
+            errorlog.write('[%s +0000] [%d] [INFO] Booting worker with pid: %d\n'
+                           % (when.strftime('%Y-%m-%d %H:%M:%S'), 1000 + line % 50, 1000 + line % 50))
+
+
+def localsender():
+    """Returns a function that sends one request to the application in this process, with its own test client"""
+    from app import app   # pylint: disable=import-outside-toplevel
+    client = app.test_client()
+    headers = {'Api-Key': APIKEY}
+
+    def send(method, path, body):
+        response = client.open(path, method=method, json=body, headers=headers)
+        response.get_data()
+        return response.status_code
+    return send
+
+
+def remotesender(url, apikey):
+    """Returns a function that sends one request over a keep-alive HTTP connection"""
+    parts = urlsplit(url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+    headers = {'Api-Key': apikey, 'Content-Type': 'application/json'}
+
+    def send(method, path, body):
+        connection.request(method, path, json.dumps(body) if body is not None else None, headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    return send
+
+
+def percentile(ordered, fraction):
+    """Nearest rank percentile of a sorted list"""
+    return ordered[max(0, min(len(ordered) - 1, ceil(fraction * len(ordered)) - 1))]
+
+
+def runscenario(sendermaker, scenario, requests, concurrency):
+    """
+    Drives one scenario with concurrent client threads.
+
+    Parameters:
+        sendermaker (callable): Returns a new send(method, path, body) function for each thread.
+        scenario (str): The scenario name, a key of SCENARIOS.
+        requests (int): The total number of requests to send.
+        concurrency (int): The number of client threads.
+
+    Returns:
+        dict: requests, errors, throughput (requests per second) and p50/p99/max latency (ms).
+    """
+    method, path, body = SCENARIOS[scenario]
+    numbers = count()
+    latencies = []
+    errors = []
+
+    def client():
+        send = sendermaker()
+        while True:
+            number = next(numbers)
+            if number >= requests:
+                return
+            start = perf_counter()
+            try:
+                status = send(method, path, body(number) if body else None)
+            except (OSError, http.client.HTTPException):
+                status = 599
+            latencies.append(perf_counter() - start)
+            if status >= 400:
+                errors.append(status)
+
+    threads = [Thread(target=client, name='benchmark-client-%d' % number) for number in range(concurrency)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+    latencies.sort()
+    return {'requests': requests, 'errors': len(errors), 'throughput': round(requests / elapsed, 1),
+            'p50': round(percentile(latencies, 0.50) * 1000, 3), 'p99': round(percentile(latencies, 0.99) * 1000, 3),
+            'max': round(latencies[-1] * 1000, 3)}
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Compares results with a baseline.
+
+    Returns:
+        list: A description of every scenario that returned errors, or whose p99 latency rose or
+        throughput fell by more than the tolerance fraction.
+    """
+    failures = []
+    for scenario, result in results.items():
+        if result['errors']:
+            failures.append('%s: %d requests failed' % (scenario, result['errors']))
+        base = baseline.get(scenario)
+        if base is None:
+            continue
+        if result['p99'] > base['p99'] * (1 + tolerance):
+            failures.append('%s: p99 %.3fms is above the baseline %.3fms' % (scenario, result['p99'], base['p99']))
+        if result['throughput'] < base['throughput'] * (1 - tolerance):
+            failures.append('%s: throughput %.1f/s is below the baseline %.1f/s'
+                            % (scenario, result['throughput'], base['throughput']))
+    return failures
+
+
+def main():
+    """Command line entry point, returns the exit status"""
+    parser = argparse.ArgumentParser(description='Valve Controller load benchmark')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma separated scenarios to run')
+    parser.add_argument('--requests', type=int, default=2000, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent client threads')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated seconds per GPIO call')
+    parser.add_argument('--loglines', type=int, default=50000, help='lines in each sample log file')
+    parser.add_argument('--url', help='benchmark a running controller instead, e.g. http://127.0.0.1:8080')
+    parser.add_argument('--apikey', default=APIKEY, help='the Api-Key of the controller given by --url')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed fractional regression')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    arguments = parser.parse_args()
+    save = os.path.abspath(arguments.save) if arguments.save else None
+    baselinefile = os.path.abspath(arguments.baseline) if arguments.baseline else None
+    scenarios = [name for name in arguments.scenarios.split(',') if name]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error('unknown scenario(s) %s, choose from %s' % (', '.join(unknown), ', '.join(SCENARIOS)))
+
+    if arguments.url:
+        def sendermaker():
+            return remotesender(arguments.url, arguments.apikey)
+    else:
+        workdir = tempfile.mkdtemp(prefix='valvebenchmark-')
+        preparedirectory(workdir, arguments.latency, arguments.loglines)
+        os.chdir(workdir)
+        sys.path.insert(0, BASEDIR)
+        sendermaker = localsender
+        sendermaker()   # start the application before the results table is printed
+
+    results = {}
+    print('%-14s %9s %7s %12s %10s %10s %10s' % ('scenario', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms', 'max ms'))
+    for scenario in scenarios:
+        runscenario(sendermaker, scenario, min(50, arguments.requests), arguments.concurrency)   # warm up
+        result = results[scenario] = runscenario(sendermaker, scenario, arguments.requests, arguments.concurrency)
+        print('%-14s %9d %7d %12.1f %10.3f %10.3f %10.3f' % (scenario, result['requests'], result['errors'],
+                                                             result['throughput'], result['p50'], result['p99'],
+                                                             result['max']))
+    if save:
+        with open(save, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=4)
+    baseline = {}
+    if baselinefile:
+        with open(baselinefile, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+    failures = regressions(results, baseline, arguments.tolerance)
+    for failure in failures:
+        print('REGRESSION ' + failure)
+    if not arguments.url:
+        print('application logs and valve history are in %s' % workdir)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+"""
+Single-owner hardware command executor.
+
+All changes to the valve outputs are run, one at a time and in arrival order, by one executor
+thread that owns the GPIO. Request threads submit a command and get a Future back, so interlock
+checks and pin writes can never interleave between threads and no lock is shared by the request
+threads. The queue is bounded; when it is full submit raises ExecutorBusy straight away so the
+caller can answer 503 instead of queueing without limit.
+"""
+
+from concurrent.futures import Future, TimeoutError as CommandTimeout
+from queue import Queue, Full
+from threading import Thread, current_thread
+from time import monotonic
+from logmanager import logger
+
+
+class ExecutorBusy(Exception):
+    """Raised by HardwareExecutor.submit when the command queue is full"""
+
+
+class HardwareExecutor:
+    """
+    Runs submitted functions on a single dedicated thread.
+
+    Parameters:
+        maxsize (int): The maximum number of commands waiting to run.
+        name (str): The name of the executor thread.
+    """
+
+    def __init__(self, maxsize, name='valve-executor'):
+        self.queue = Queue(maxsize)
+        self.thread = Thread(target=self.run, name=name, daemon=True)
+        self.lastsuccess = None
+        """monotonic() time at which the last command completed without an exception"""
+        self.completed = 0
+
+    def start(self):
+        """Start the executor thread"""
+        self.thread.start()
+
+    def onexecutor(self):
+        """Return True if called from the executor thread"""
+        return current_thread() is self.thread
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queues a function to run on the executor thread.
+
+        If called from the executor thread itself the function is run immediately, so commands
+        may submit further commands without deadlocking.
+
+        Returns:
+            Future: Resolves to the return value of the function, or its exception.
+
+        Raises:
+            ExecutorBusy: If the queue is full.
+        """
+        future = Future()
+        if self.onexecutor():
+            self.execute(future, function, args, kwargs)
+            return future
+        try:
+            self.queue.put_nowait((future, function, args, kwargs))
+        except Full:
+            raise ExecutorBusy('hardware command queue is full') from None
+        return future
+
+    def submitwait(self, function, *args, **kwargs):
+        """
+        Queues a function like submit, but waits for room in a full queue instead of raising
+        ExecutorBusy. Used for commands that must not be dropped, such as the close at the end
+        of a timed valve opening.
+
+        Returns:
+            Future: Resolves to the return value of the function, or its exception.
+        """
+        future = Future()
+        if self.onexecutor():
+            self.execute(future, function, args, kwargs)
+            return future
+        self.queue.put((future, function, args, kwargs))
+        return future
+
+    def call(self, function, *args, timeout=None, **kwargs):
+        """
+        Submit a function and wait up to timeout seconds for its result.
+
+        A command still waiting in the queue when the timeout expires is cancelled, so a caller
+        told that it timed out can retry without the command also running later. Only a command
+        that had already started when the timeout expired may still complete.
+
+        Raises:
+            ExecutorBusy: If the queue is full.
+            concurrent.futures.TimeoutError: If the command did not complete in time.
+        """
+        future = self.submit(function, *args, **kwargs)
+        try:
+            return future.result(timeout)
+        except CommandTimeout:
+            name = getattr(function, '__name__', function)
+            if future.cancel():
+                logger.warning('Hardware command %s cancelled, not started within %s seconds', name, timeout)
+            else:
+                logger.warning('Hardware command %s timed out after it started and may still complete', name)
+            raise
+
+    def execute(self, future, function, args, kwargs):
+        """Run one command and resolve its future"""
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = function(*args, **kwargs)
+        except Exception as error:  # the exception is passed back to the caller
+            future.set_exception(error)
+            logger.debug('Hardware command %s raised %s', getattr(function, '__name__', function), error)
+        else:
+            self.lastsuccess = monotonic()
+            self.completed += 1
+            future.set_result(result)
+
+    def run(self):
+        """Executor thread loop, runs queued commands for the life of the process"""
+        while True:
+            future, function, args, kwargs = self.queue.get()
+            self.execute(future, function, args, kwargs)
@@ -0,0 +1,328 @@
+"""
+Fleet gateway for several valve controllers.
+
+Serves one merged view of the valve status of every controller listed in the
+'gatewaycontrollers' setting, and fans valve commands out to them through the same /api contract
+the controllers themselves serve. Each entry of the setting is
+{"name": "line1", "url": "http://192.168.1.21", "api-key": "...", "timeout": 2.0}, the timeout
+(seconds, default 'gatewaytimeout') bounding every status request to that controller.
+
+The gateway keeps a pool of keep-alive connections to the controllers ('gatewayconnections' per
+controller) and fetches their status concurrently, so the merged view takes as long as the
+slowest controller that answers within its timeout rather than the sum of them all. Each status
+is cached for 'gatewaycache' seconds, fetched with If-None-Match so an unchanged controller sends
+a bodiless 304, and concurrent views share one fetch per controller. A controller that fails or
+times out is shown with its error and its last known status marked stale.
+
+Routes:
+    GET  /              merged status page
+    GET  /api/status    merged status in JSON format
+    POST /api           {"controller": name, list of names or "*", "item": ..., "command": ...}
+    POST /api/batch     {"controller": ..., "operations": [...]}
+    GET  /healthz       the gateway's own health and which controllers answered last time
+
+Usage:
+    python gateway.py --port 8090
+    python gateway.py --port 8090 --standins 3     run against 3 local simulated controllers
+"""
+
+import os
+import sys
+import json
+import atexit
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from time import monotonic, time, sleep
+from urllib.request import urlopen
+from aiohttp import web, ClientSession, ClientTimeout, ClientError, TCPConnector
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from app_control import settings, VERSION
+from logmanager import logger
+import settingswatcher
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+templates = Environment(loader=FileSystemLoader(os.path.join(BASEDIR, 'templates')),
+                        autoescape=select_autoescape(['html']))
+templates.globals['url_for'] = lambda endpoint, **values: '/static/' + values['filename']
+
+
+class Controller:
+    """
+    One controller behind the gateway and its cached status.
+
+    Parameters:
+        name (str): The name the controller is shown and addressed by.
+        url (str): Base URL of the controller, e.g. http://192.168.1.21.
+        apikey (str): The controller's Api-Key.
+        timeout (float): Seconds allowed for a status request.
+    """
+
+    def __init__(self, name, url, apikey, timeout):
+        self.name = name
+        self.url = url.rstrip('/')
+        self.apikey = apikey
+        self.timeout = timeout
+        self.valves = None
+        """The last status received, a list of {valve, status}"""
+        self.etag = None
+        self.updated = None
+        """time() the status was last confirmed"""
+        self.fetched = 0.0
+        """monotonic() time the last fetch finished, 0 to fetch again on the next view"""
+        self.error = None
+        self.latency = None
+        self.inflight = None
+        """The fetch in progress, shared by every view that needs it"""
+
+    async def fetch(self, session):
+        """Fetch the status, sending the ETag of the cached copy"""
+        start = monotonic()
+        headers = {'Api-Key': self.apikey}
+        if self.etag and self.valves is not None:
+            headers['If-None-Match'] = self.etag
+        try:
+            async with session.get(self.url + '/api/status', headers=headers,
+                                   timeout=ClientTimeout(total=self.timeout)) as response:
+                if response.status == 200:
+                    self.valves = await response.json()
+                    self.etag = response.headers.get('ETag')
+                elif response.status != 304:
+                    raise ClientError('HTTP %s' % response.status)
+            self.error = None
+            self.updated = time()
+        except (ClientError, asyncio.TimeoutError, ValueError) as error:
+            if self.error is None:
+                logger.warning('Gateway: status of %s failed: %s', self.name, error or 'timed out')
+            self.error = str(error) or 'timed out'
+        finally:
+            self.latency = monotonic() - start
+            self.fetched = monotonic()
+            self.inflight = None
+
+    async def current(self, session, maxage):
+        """Return the status, fetching it first if the cached copy is older than maxage seconds"""
+        if self.inflight is None and monotonic() - self.fetched >= maxage:
+            self.inflight = asyncio.ensure_future(self.fetch(session))
+        if self.inflight is not None:
+            await asyncio.shield(self.inflight)
+        return self.describe()
+
+    async def command(self, session, path, body, timeout):
+        """
+        Send a command to the controller.
+
+        Returns:
+            dict: The HTTP status code ('code') and the controller's reply ('result'), or the
+            error if the controller could not be reached in time.
+        """
+        try:
+            async with session.post(self.url + path, json=body, headers={'Api-Key': self.apikey},
+                                    timeout=ClientTimeout(total=timeout)) as response:
+                text = await response.text()
+                try:
+                    result = json.loads(text)
+                except ValueError:
+                    result = text
+                return {'code': response.status, 'result': result}
+        except (ClientError, asyncio.TimeoutError) as error:
+            logger.warning('Gateway: command to %s failed: %s', self.name, error or 'timed out')
+            return {'code': None, 'error': str(error) or 'timed out'}
+        finally:
+            self.fetched = 0.0
+
+    def describe(self):
+        """Return the controller and its cached status as a JSON serialisable dictionary"""
+        return {'url': self.url, 'ok': self.error is None and self.valves is not None, 'error': self.error,
+                'stale': self.error is not None and self.valves is not None, 'updated': self.updated,
+                'latency_ms': None if self.latency is None else round(self.latency * 1000, 3),
+                'valves': self.valves}
+
+
+def buildcontrollers(entries):
+    """Return {name: Controller} for the entries of the 'gatewaycontrollers' setting"""
+    return {entry['name']: Controller(entry['name'], entry['url'], entry.get('api-key', ''),
+                                      entry.get('timeout', settings['gatewaytimeout']))
+            for entry in entries}
+
+
+controllers = buildcontrollers(settings['gatewaycontrollers'])
+
+
+def reloadcontrollers(old, new):
+    """Settings listener, rebuilds the controller list when 'gatewaycontrollers' changes"""
+    global controllers
+    if old['gatewaycontrollers'] != new['gatewaycontrollers'] or old['gatewaytimeout'] != new['gatewaytimeout']:
+        controllers = buildcontrollers(new['gatewaycontrollers'])
+        logger.info('Gateway: %s controllers', len(controllers))
+
+
+settingswatcher.addlistener(reloadcontrollers)
+
+
+async def mergedstatus(session):
+    """Return the status of every controller, fetched concurrently, by controller name"""
+    current = list(controllers.values())
+    results = await asyncio.gather(*(controller.current(session, settings['gatewaycache']) for controller in current))
+    return {controller.name: result for controller, result in zip(current, results)}
+
+
+def apikeyerror(request):
+    """Return a 401 response if the Api-Key header is missing or wrong, otherwise None"""
+    if request.headers.get('Api-Key') == settings['api-key']:
+        return None
+    logger.warning('Gateway: access attempt without a valid token')
+    return web.Response(text='access token(s) incorrect', status=401)
+
+
+def targets(selection):
+    """Return the controllers named by a 'controller' field (a name, a list of names or '*'), None if any is unknown"""
+    if selection == '*':
+        return list(controllers.values())
+    names = selection if isinstance(selection, list) else [selection]
+    if not names or any(not isinstance(name, str) or name not in controllers for name in names):
+        return None
+    return [controllers[name] for name in names]
+
+
+async def fanout(request, path):
+    """Forward the command in the request body to the selected controllers concurrently"""
+    keyerror = apikeyerror(request)
+    if keyerror:
+        return keyerror
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    if not isinstance(body, dict) or 'controller' not in body:
+        return web.Response(text='badly formed json message, a controller is required', status=401)
+    selected = targets(body.pop('controller'))
+    if selected is None:
+        return web.Response(text='unknown controller', status=404)
+    results = await asyncio.gather(*(controller.command(request.app['session'], path, body,
+                                                        settings['gatewaycommandtimeout'])
+                                     for controller in selected))
+    merged = {controller.name: result for controller, result in zip(selected, results)}
+    allok = all(result['code'] is not None and result['code'] < 300 for result in results)
+    return web.json_response({'results': merged}, status=201 if allok else 207)
+
+
+async def api(request):
+    """Fan a valve command out to the selected controllers"""
+    return await fanout(request, '/api')
+
+
+async def apibatch(request):
+    """Fan a batch of valve operations out to the selected controllers"""
+    return await fanout(request, '/api/batch')
+
+
+async def apistatus(request):
+    """The merged status of every controller in JSON format"""
+    keyerror = apikeyerror(request)
+    if keyerror:
+        return keyerror
+    return web.json_response({'controllers': await mergedstatus(request.app['session'])})
+
+
+async def index(request):
+    """The merged status page"""
+    html = templates.get_template('gateway.html').render(controllers=await mergedstatus(request.app['session']),
+                                                         version=VERSION)
+    return web.Response(text=html, content_type='text/html')
+
+
+async def healthz(_request):
+    """The gateway is healthy when it is running, the controllers are listed with their last known state"""
+    return web.json_response({'ready': True, 'controllers': {controller.name: controller.error is None and
+                                                             controller.valves is not None
+                                                             for controller in controllers.values()}},
+                             headers={'Cache-Control': 'no-store'})
+
+
+async def opensession(application):
+    """Create the pooled client session once the event loop is running"""
+    application['session'] = ClientSession(connector=TCPConnector(limit_per_host=settings['gatewayconnections'],
+                                                                   keepalive_timeout=60))
+
+
+async def closesession(application):
+    """Close the client session and its connections"""
+    await application['session'].close()
+
+
+def makeapp():
+    """Return a new gateway web application, each event loop (e.g. each test) needs its own"""
+    application = web.Application()
+    application.on_startup.append(opensession)
+    application.on_cleanup.append(closesession)
+    application.router.add_get('/', index)
+    application.router.add_post('/api', api)
+    application.router.add_post('/api/batch', apibatch)
+    application.router.add_get('/api/status', apistatus)
+    application.router.add_get('/healthz', healthz)
+    application.router.add_static('/static', os.path.join(BASEDIR, 'static'))
+    return application
+
+
+app = makeapp()
+
+
+def startstandins(count, baseport, apikey='standin-key'):
+    """
+    Starts local stand-in controllers for testing the gateway: each is asyncapp.py on simulated
+    GPIO pins, from its own scratch directory, on consecutive ports from baseport.
+
+    Returns:
+        list[dict]: 'gatewaycontrollers' style entries for the stand-ins.
+    """
+    entries = []
+    for number in range(count):
+        workdir = tempfile.mkdtemp(prefix='valvestandin-')
+        os.makedirs(os.path.join(workdir, 'logs'))
+        with open(os.path.join(workdir, 'cputemp'), 'w', encoding='utf-8') as file:
+            file.write('45000\n')
+        with open(os.path.join(workdir, 'settings.json'), 'w', encoding='utf-8') as file:
+            json.dump({'api-key': apikey, 'gpiobackend': 'simulated', 'cputemp': os.path.join(workdir, 'cputemp'),
+                       'sharedstatepath': os.path.join(workdir, 'valvecontroller.state'),
+                       'ownersocket': os.path.join(workdir, 'owner.sock'), 'settingspoll': 0}, file, indent=4)
+        process = subprocess.Popen([sys.executable, os.path.join(BASEDIR, 'asyncapp.py'), '--port',
+                                    str(baseport + number)], cwd=workdir, stdout=subprocess.DEVNULL)
+        atexit.register(process.terminate)
+        entries.append({'name': 'standin%d' % (number + 1), 'url': 'http://127.0.0.1:%d' % (baseport + number),
+                        'api-key': apikey})
+        logger.info('Gateway: stand-in controller %s on port %s in %s', number + 1, baseport + number, workdir)
+    for entry in entries:
+        for _attempt in range(100):
+            try:
+                with urlopen(entry['url'] + '/healthz', timeout=1):
+                    break
+            except OSError:
+                sleep(0.1)
+    return entries
+
+
+def main():
+    """Command line entry point, serves the gateway on a UNIX socket or TCP port"""
+    global controllers
+    parser = argparse.ArgumentParser(description='Valve Controller fleet gateway')
+    parser.add_argument('--unix', help='UNIX socket path to listen on')
+    parser.add_argument('--host', default='127.0.0.1', help='TCP address to listen on')
+    parser.add_argument('--port', type=int, default=8090, help='TCP port to listen on')
+    parser.add_argument('--standins', type=int, default=0, help='start this many local simulated controllers')
+    parser.add_argument('--standinport', type=int, default=8101, help='port of the first stand-in controller')
+    arguments = parser.parse_args()
+    if arguments.standins:
+        controllers = buildcontrollers(startstandins(arguments.standins, arguments.standinport))
+    else:
+        settingswatcher.watcher.start()
+    logger.info('Starting Valve Controller gateway version %s for %s controllers', VERSION, len(controllers))
+    if arguments.unix:
+        web.run_app(app, path=arguments.unix)
+    else:
+        web.run_app(app, host=arguments.host, port=arguments.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""
+GPIO backend selection.
+
+valvecontrol drives the pins through the GPIO object exported by this module, chosen by the
+'gpiobackend' setting:
+
+- 'lgpio' (the default): an LgpioGPIO driving the pins directly through the lgpio library
+  (installed with rpi-lgpio), so that a list of output pins set up together can be written as
+  one grouped write.
+- 'rpi': the RPi.GPIO module (provided by rpi-lgpio on current Raspberry Pi OS), which writes
+  a list of pins one pin at a time.
+- 'simulated': a SimulatedGPIO that keeps the pin levels in memory and waits 'gpiolatency'
+  seconds in every call, so the controller can be run and load tested on any Linux machine.
+
+Pins set up with a single GPIO.setup(list, GPIO.OUT) call form an output group; groupwrite
+changes any subset of them in one hardware operation where the backend supports it (lgpio and
+simulated) and falls back to a list write on RPi.GPIO.
+"""
+
+from threading import Lock
+from time import sleep
+from app_control import settings
+
+
+class SimulatedGPIO:
+    """
+    In-memory stand-in for the parts of RPi.GPIO used by the controller.
+
+    Parameters:
+        latency (float): Seconds added to every setup, output and input call.
+    """
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.pins = {}
+        """Current level of every pin that has been set up, by channel number"""
+        self.calls = 0
+        self.mode = None
+        self.group = []
+        """The channels of the output group, bit n of a group write is channel group[n]"""
+        self.lock = Lock()
+
+    def wait(self):
+        """Simulate the time taken by a call to the hardware"""
+        if self.latency > 0:
+            sleep(self.latency)
+
+    def setwarnings(self, flag):
+        """Ignored, present for compatibility with RPi.GPIO"""
+
+    def setmode(self, mode):
+        """Record the pin numbering mode"""
+        self.mode = mode
+
+    def setup(self, channel, direction):
+        """Set up one channel or a list of channels, outputs start low"""
+        self.wait()
+        with self.lock:
+            for pin in channel if isinstance(channel, (list, tuple)) else [channel]:
+                self.pins.setdefault(pin, self.LOW)
+            if isinstance(channel, (list, tuple)) and direction == self.OUT:
+                self.group = list(channel)
+            self.calls += 1
+
+    def output(self, channel, level):
+        """Set one channel or a list of channels to a level or a matching list of levels"""
+        self.wait()
+        channels = channel if isinstance(channel, (list, tuple)) else [channel]
+        levels = level if isinstance(level, (list, tuple)) else [level] * len(channels)
+        with self.lock:
+            for pin, value in zip(channels, levels):
+                if pin not in self.pins:
+                    raise RuntimeError('The GPIO channel has not been set up as an OUTPUT')
+                self.pins[pin] = int(bool(value))
+            self.calls += 1
+
+    def groupwrite(self, bits, mask):
+        """Set the output group channels selected by mask to the levels in bits, as one call"""
+        self.wait()
+        with self.lock:
+            for index, pin in enumerate(self.group):
+                if mask >> index & 1:
+                    self.pins[pin] = bits >> index & 1
+            self.calls += 1
+
+    def input(self, channel):
+        """Return the level of a channel"""
+        self.wait()
+        with self.lock:
+            self.calls += 1
+            return self.pins.get(channel, self.LOW)
+
+    def cleanup(self, channel=None):
+        """Forget the state of one channel, a list of channels or every channel"""
+        with self.lock:
+            if channel is None:
+                self.pins.clear()
+            else:
+                for pin in channel if isinstance(channel, (list, tuple)) else [channel]:
+                    self.pins.pop(pin, None)
+
+
+class LgpioGPIO:
+    """
+    The parts of the RPi.GPIO interface used by the controller, implemented over lgpio.
+
+    A list of channels set up as outputs in one call is claimed as an lgpio group, after which
+    writes to any of its channels, including groupwrite, are single group_write calls.
+
+    Parameters:
+        chip (int): The gpiochip device number, 0 on current Raspberry Pi OS.
+    """
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self, chip=0):
+        import lgpio   # pylint: disable=import-outside-toplevel
+        self.lgpio = lgpio
+        self.handle = lgpio.gpiochip_open(chip)
+        self.group = []
+        """The channels of the output group, bit n of a group write is channel group[n]"""
+        self.layout = {}
+        """Group bit of each channel in the output group"""
+
+    def setwarnings(self, flag):
+        """Ignored, present for compatibility with RPi.GPIO"""
+
+    def setmode(self, mode):
+        """Only BCM numbering is supported"""
+        if mode != self.BCM:
+            raise ValueError('the lgpio backend only supports BCM pin numbering')
+
+    def setup(self, channel, direction):
+        """Claim one channel, or claim a list of output channels as the output group"""
+        if isinstance(channel, (list, tuple)) and direction == self.OUT:
+            if self.group:
+                self.lgpio.group_free(self.handle, self.group[0])
+            self.lgpio.group_claim_output(self.handle, list(channel), [0] * len(channel))
+            self.group = list(channel)
+            self.layout = {pin: 1 << index for index, pin in enumerate(self.group)}
+            return
+        for pin in channel if isinstance(channel, (list, tuple)) else [channel]:
+            if direction == self.OUT:
+                self.lgpio.gpio_claim_output(self.handle, pin, 0)
+            else:
+                self.lgpio.gpio_claim_input(self.handle, pin)
+
+    def groupwrite(self, bits, mask):
+        """Set the output group channels selected by mask to the levels in bits, as one call"""
+        self.lgpio.group_write(self.handle, self.group[0], bits, mask)
+
+    def output(self, channel, level):
+        """Set one channel or a list of channels to a level or a matching list of levels"""
+        channels = channel if isinstance(channel, (list, tuple)) else [channel]
+        levels = level if isinstance(level, (list, tuple)) else [level] * len(channels)
+        bits = mask = 0
+        for pin, value in zip(channels, levels):
+            if pin in self.layout:
+                mask |= self.layout[pin]
+                if value:
+                    bits |= self.layout[pin]
+            else:
+                self.lgpio.gpio_write(self.handle, pin, int(bool(value)))
+        if mask:
+            self.groupwrite(bits, mask)
+
+    def input(self, channel):
+        """Return the level of a channel"""
+        if channel in self.layout:
+            return int(self.lgpio.group_read(self.handle, self.group[0])[1] & self.layout[channel] != 0)
+        return self.lgpio.gpio_read(self.handle, channel)
+
+    def cleanup(self, _channel=None):
+        """Release every claimed channel and close the chip"""
+        self.lgpio.gpiochip_close(self.handle)
+
+
+def groupwrite(channels, bits, mask):
+    """
+    Writes the output group in one operation where the backend supports it.
+
+    Parameters:
+        channels (list[int]): The channels passed to GPIO.setup, bit n refers to channels[n].
+        bits (int): The level of each channel.
+        mask (int): The channels to change, the others keep their level.
+    """
+    if hasattr(GPIO, 'groupwrite'):
+        GPIO.groupwrite(bits, mask)
+        return
+    pins = [pin for index, pin in enumerate(channels) if mask >> index & 1]
+    levels = [bits >> index & 1 for index in range(len(channels)) if mask >> index & 1]
+    if pins:
+        GPIO.output(pins, levels)
+
+
+def loadbackend(name):
+    """
+    Returns the GPIO implementation for a backend name.
+
+    Parameters:
+        name (str): 'rpi', 'lgpio' or 'simulated'.
+
+    Raises:
+        ValueError: If the name is not a known backend.
+    """
+    if name == 'rpi':
+        from RPi import GPIO as rpigpio   # pylint: disable=import-outside-toplevel
+        return rpigpio
+    if name == 'lgpio':
+        return LgpioGPIO(settings['gpiochip'])
+    if name == 'simulated':
+        return SimulatedGPIO(settings['gpiolatency'])
+    raise ValueError('unknown gpiobackend setting %r, use "rpi", "lgpio" or "simulated"' % name)
+
+
+GPIO = loadbackend(settings['gpiobackend'])
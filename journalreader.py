@@ -0,0 +1,132 @@
+"""
+System journal reader for the /syslog page.
+
+Runs journalctl directly (no shell) with a timeout and keeps the output for a short time so that
+concurrent and repeated page views share one journal query. Requests for the same page and
+filters that arrive while a query is running wait for that query instead of starting another.
+
+Pages are linked by journal cursors: journalctl prints the cursor of the oldest entry of a page
+(--show-cursor), and the next older page is read from just after it (--after-cursor), so every
+page costs one page of entries however far back it is.
+"""
+
+import re
+import subprocess
+from threading import Lock
+from time import monotonic
+from logmanager import logger
+from app_control import settings
+
+JOURNALCTL = '/bin/journalctl'
+PRIORITIES = ['emerg', 'alert', 'crit', 'err', 'warning', 'notice', 'info', 'debug']
+UNITPATTERN = re.compile(r'^[A-Za-z0-9@._:\-]+$')
+CURSORPATTERN = re.compile(r'^[A-Za-z0-9=;_\-]+$')
+CURSORLINE = '-- cursor: '
+"""The start of the last output line when journalctl is run with --show-cursor"""
+
+cache = {}
+"""Journal query results keyed by (lines, cursor, unit, priority), each value is (expiry time, result)"""
+cachelock = Lock()
+querylocks = {}
+"""
+[lock, users] per cache key with a query running or waiting, the lock is held while the query
+runs so identical requests wait for it, and the entry is dropped by the last of its users
+"""
+
+
+def journalcommand(count, cursor=None, unit=None, priority=None):
+    """
+    Builds the journalctl argument list for count entries, newest first, ending with the cursor
+    of the oldest entry shown.
+
+    Parameters:
+        count (int): The number of journal entries to return.
+        cursor (str): Start with the entry older than this cursor, None for the newest entries.
+        unit (str): Only show entries from this systemd unit.
+        priority (str): Only show entries of this priority name or higher.
+
+    Returns:
+        list[str]: The command and its arguments.
+    """
+    command = [JOURNALCTL, '--no-pager', '--quiet', '--reverse', '--show-cursor', '--lines', str(count)]
+    if cursor:
+        command.append('--after-cursor=%s' % cursor)
+    if unit:
+        command.append('--unit=%s' % unit)
+    if priority:
+        command.append('--priority=%s' % priority)
+    return command
+
+
+def runjournal(command):
+    """
+    Runs journalctl and returns its output lines, or a single error line if it fails.
+
+    Parameters:
+        command (list[str]): The command built by journalcommand.
+
+    Returns:
+        list[str]: The output lines of the command.
+    """
+    try:
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False,
+                                timeout=settings['journaltimeout'])
+    except subprocess.TimeoutExpired:
+        logger.warning('System journal query timed out after %s seconds', settings['journaltimeout'])
+        return ['journalctl did not respond within %s seconds' % settings['journaltimeout']]
+    except OSError as error:
+        logger.warning('System journal query failed: %s', error)
+        return ['journalctl could not be run: %s' % error]
+    if result.returncode != 0:
+        return [line for line in result.stderr.decode('utf-8', errors='replace').split('\n') if line]
+    return [line for line in result.stdout.decode('utf-8', errors='replace').split('\n') if line]
+
+
+def readjournal(count, cursor=None, unit=None, priority=None):
+    """
+    Returns one page of system journal entries, newest first.
+
+    Results are cached for the 'journalcachetime' setting (seconds) and shared by every request
+    for the same page and filters. Invalid cursors, unit names and priorities are ignored.
+
+    Parameters:
+        count (int): The number of entries in a page.
+        cursor (str): The cursor returned with the previous page, None for the newest entries.
+        unit (str): Only show entries from this systemd unit.
+        priority (str): Only show entries of this priority name or higher, e.g. 'warning'.
+
+    Returns:
+        tuple: (lines, older) where lines is the list of log lines and older is the cursor of
+        the next (older) page, or None if this is the last page.
+    """
+    cursor = cursor if cursor and CURSORPATTERN.match(cursor) else None
+    unit = unit if unit and UNITPATTERN.match(unit) else None
+    priority = priority if priority in PRIORITIES else None
+    key = (count, cursor, unit, priority)
+    with cachelock:
+        entry = cache.get(key)
+        if entry and entry[0] > monotonic():
+            return entry[1]
+        querylock = querylocks.setdefault(key, [Lock(), 0])
+        querylock[1] += 1
+    try:
+        with querylock[0]:
+            with cachelock:
+                entry = cache.get(key)
+                if entry and entry[0] > monotonic():
+                    return entry[1]
+            lines = runjournal(journalcommand(count, cursor, unit, priority))
+            last = lines.pop() if lines and lines[-1].startswith(CURSORLINE) else None
+            older = last[len(CURSORLINE):] if last and len(lines) >= count else None
+            result = (lines, older)
+            with cachelock:
+                now = monotonic()
+                for expiredkey in [name for name, value in cache.items() if value[0] <= now]:
+                    del cache[expiredkey]
+                cache[key] = (now + settings['journalcachetime'], result)
+        return result
+    finally:
+        with cachelock:
+            querylock[1] -= 1
+            if querylock[1] == 0:
+                del querylocks[key]
@@ -1,11 +1,18 @@
 """
 logmanager, setus up application logging. use the **logger** property to
 write to the log.
+
+Records are passed through a bounded queue to a dedicated writer thread that owns the
+RotatingFileHandler, so callers never wait on the SD card or a rotation rename. If the
+queue is full records are dropped and counted rather than blocking the caller, and the
+queue is flushed to the file when the application shuts down.
 """
 import os
 import sys
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+from queue import Queue, Full
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from app_control import settings
 
 # Ensure log directory exists
@@ -13,6 +20,22 @@ log_dir = os.path.dirname(settings['logfilepath'])
 if not os.path.exists(log_dir):
     os.makedirs(log_dir)
 
+
+class BoundedQueueHandler(QueueHandler):
+    """QueueHandler that drops and counts records when the queue is full instead of blocking"""
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        """Put the record on the queue without waiting, counting it if the queue is full"""
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
 logger = logging.getLogger(settings['logappname'])
 """
 Usage:\n
@@ -26,9 +49,26 @@ if settings['loglevel'].upper() == 'DEBUG':
 else:
     logger.setLevel(logging.INFO)
 
-LogFile = RotatingFileHandler(settings['logfilepath'], maxBytes=1048576, backupCount=10)
+backupcount = 10
+"""Number of rotated log files kept by the RotatingFileHandler (.1 to .10)"""
+LogFile = RotatingFileHandler(settings['logfilepath'], maxBytes=1048576, backupCount=backupcount)
 formatter = logging.Formatter('%(asctime)s, %(name)s, %(levelname)s : %(message)s')
 LogFile.setFormatter(formatter)
-logger.addHandler(LogFile)
+logqueue = Queue(maxsize=settings['logqueuesize'])
+loghandler = BoundedQueueHandler(logqueue)
+loglistener = QueueListener(logqueue, LogFile, respect_handler_level=True)
+loglistener.start()
+logger.addHandler(loghandler)
+
+
+def stoplogging():
+    """Write any queued records to the log file and stop the writer thread"""
+    loglistener.stop()
+    LogFile.flush()
+    if loghandler.dropped:
+        print('%s log records were dropped because the log queue was full' % loghandler.dropped)
+
+
+atexit.register(stoplogging)
 logger.info('Running Python %s on %s', sys.version, sys.platform)
 logger.info('Logging level set to: %s', settings['loglevel'].upper())
@@ -0,0 +1,392 @@
+"""
+Log file reader for the log viewer pages.
+
+Reads log files backwards from the end in fixed size blocks so that the newest lines can be
+returned without loading the whole file. Pages are linked by a cursor that records the file
+(by inode, so it survives a rotation rename) and the byte offset of the oldest line returned,
+and paging carries on into the rotated backups (.1, .2 ...) written by the RotatingFileHandler.
+
+Filtered searches (level, time range and text) use a sparse per-file index of timestamp to byte
+offset, sampled every INDEXSTEP bytes. The index is built the first time a file is searched and
+then extended as the file grows, so a time range query seeks straight to the region it needs.
+"""
+
+import os
+import re
+from bisect import bisect_left, bisect_right
+from threading import Lock
+from logmanager import backupcount
+
+BLOCKSIZE = 65536
+INDEXSTEP = 65536
+SEARCHLIMIT = 100000
+"""The maximum number of lines a single search page will examine"""
+
+MONTHS = {'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04', 'May': '05', 'Jun': '06',
+          'Jul': '07', 'Aug': '08', 'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12'}
+ISOTIME = re.compile(r'^\[?(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2}:\d{2})')
+ACCESSTIME = re.compile(r'\[(\d{2})/(\w{3})/(\d{4}):(\d{2}:\d{2}:\d{2}) ')
+
+
+def rotatedfiles(path, backups=backupcount):
+    """
+    Lists a log file and its rotated backups from newest to oldest.
+
+    Parameters:
+        path (str): Path of the live log file.
+        backups (int): The highest backup number to look for.
+
+    Returns:
+        list[str]: The paths that exist, the live file first followed by path.1, path.2 ...
+    """
+    candidates = [path] + ['%s.%s' % (path, index) for index in range(1, backups + 1)]
+    return [candidate for candidate in candidates if os.path.isfile(candidate)]
+
+
+def makecursor(file_path, offset):
+    """Return the paging cursor for the given offset in the file"""
+    return '%s:%s' % (os.stat(file_path).st_ino, offset)
+
+
+def findcursor(files, cursor):
+    """
+    Resolves a paging cursor against the current list of log files.
+
+    Parameters:
+        files (list[str]): Log files from newest to oldest, as returned by rotatedfiles.
+        cursor (str): A cursor returned by readlog.
+
+    Returns:
+        tuple: (index into files, byte offset), or (None, None) if the file no longer exists or
+        the cursor is malformed.
+    """
+    try:
+        inode, offset = (int(part) for part in cursor.split(':'))
+    except (AttributeError, ValueError):
+        return None, None
+    for index, file_path in enumerate(files):
+        if os.stat(file_path).st_ino == inode:
+            return index, min(offset, os.path.getsize(file_path))
+    return None, None
+
+
+def iterbackward(file_path, offset=None):
+    """
+    Generator that reads complete lines backwards from offset, newest first.
+
+    Parameters:
+        file_path (str): The file to read.
+        offset (int): Byte offset to read back from, None for the end of the file.
+
+    Yields:
+        tuple: (line, start) where line is the decoded line without its line ending and start
+        is the byte offset at which the line begins.
+    """
+    with open(file_path, 'rb') as f:
+        if offset is None:
+            offset = f.seek(0, os.SEEK_END)
+        position = offset
+        buffer = b''
+        if position > 0:
+            readsize = min(BLOCKSIZE, position)
+            position -= readsize
+            f.seek(position)
+            buffer = f.read(readsize)
+            if buffer.endswith(b'\n'):
+                buffer = buffer[:-1]
+        while True:
+            newline = buffer.rfind(b'\n')
+            if newline >= 0:
+                line = buffer[newline + 1:]
+                buffer = buffer[:newline]
+                yield line.decode('utf-8', errors='replace'), position + newline + 1
+            elif position > 0:
+                readsize = min(BLOCKSIZE, position)
+                position -= readsize
+                f.seek(position)
+                buffer = f.read(readsize) + buffer
+            else:
+                if buffer:
+                    yield buffer.decode('utf-8', errors='replace'), 0
+                return
+
+
+def readbackward(file_path, offset, count):
+    """
+    Reads up to count complete lines that end before offset, newest first.
+
+    Parameters:
+        file_path (str): The file to read.
+        offset (int): Byte offset to read back from, None for the end of the file.
+        count (int): The maximum number of lines to return.
+
+    Returns:
+        tuple: (lines, start) where lines is a list of decoded lines without line endings, newest
+        first, and start is the byte offset of the oldest line returned (0 once the start of the
+        file has been reached).
+    """
+    lines = []
+    start = 0
+    for line, start in iterbackward(file_path, offset):
+        lines.append(line)
+        if len(lines) >= count:
+            break
+    else:
+        start = 0
+    return lines, start
+
+
+def readlog(file_path, count, cursor=None):
+    """
+    Returns a page of the newest log lines, continuing into the rotated backups.
+
+    Parameters:
+        file_path (str): Path of the live log file.
+        count (int): The number of lines in a page.
+        cursor (str): The cursor returned with the previous page, None for the newest lines.
+
+    Returns:
+        tuple: (lines, cursor) where lines is a list of log lines newest first and cursor is the
+        value to pass for the next (older) page, or None when there are no older lines.
+    """
+    files = rotatedfiles(file_path)
+    if cursor is None:
+        index, offset = 0, None
+    else:
+        index, offset = findcursor(files, cursor)
+        if index is None:
+            return [], None
+    lines = []
+    while index < len(files):
+        page, offset = readbackward(files[index], offset, count - len(lines))
+        lines.extend(page)
+        if len(lines) >= count and offset > 0:
+            return lines, makecursor(files[index], offset)
+        index += 1
+        offset = None
+        if len(lines) >= count:
+            break
+    if index < len(files):
+        return lines, makecursor(files[index], os.path.getsize(files[index]))
+    return lines, None
+
+
+def linetime(line):
+    """
+    Extracts the timestamp from a log line.
+
+    Understands the python logger format ('2025-01-31 09:00:00,123, ...'), the gunicorn error log
+    format ('[2025-01-31 09:00:00 +0000] ...') and the gunicorn access log format
+    ('... [31/Jan/2025:09:00:00 +0000] ...').
+
+    Parameters:
+        line (str): The log line.
+
+    Returns:
+        str: The timestamp as 'YYYY-MM-DD HH:MM:SS', which sorts in time order, or None if the
+        line has no timestamp (e.g. a traceback continuation line).
+    """
+    match = ISOTIME.match(line)
+    if match:
+        return '%s %s' % match.groups()
+    match = ACCESSTIME.search(line, 0, 120)
+    if match and match.group(2) in MONTHS:
+        return '%s-%s-%s %s' % (match.group(3), MONTHS[match.group(2)], match.group(1), match.group(4))
+    return None
+
+
+def parsetime(value):
+    """
+    Converts a time filter from a query string into the form returned by linetime.
+
+    Parameters:
+        value (str): 'YYYY-MM-DD HH:MM[:SS]' or 'YYYY-MM-DDTHH:MM[:SS]' as sent by a datetime-local input.
+
+    Returns:
+        str: 'YYYY-MM-DD HH:MM:SS', or None if the value is empty or not recognised.
+    """
+    if not value:
+        return None
+    match = re.match(r'^(\d{4}-\d{2}-\d{2})[ T](\d{2}:\d{2})(:\d{2})?$', value.strip())
+    if not match:
+        return None
+    return '%s %s%s' % (match.group(1), match.group(2), match.group(3) or ':00')
+
+
+class LogIndex:
+    """
+    Sparse timestamp to byte offset index of one log file.
+
+    One entry is recorded for the first timestamped line found after every INDEXSTEP bytes. The
+    index remembers how far it has got, so update only samples the bytes appended since the
+    last call. If the file has shrunk or its first bytes have changed the index is rebuilt.
+    """
+
+    def __init__(self):
+        self.times = []
+        self.offsets = []
+        self.scanned = 0
+        self.size = 0
+        self.head = b''
+
+    def update(self, file_path):
+        """
+        Extend the index to cover any bytes appended to the file since the last update.
+
+        Returns:
+            LogIndex: This index, or a new one built from the start if the file has been
+            truncated or rewritten.
+        """
+        with open(file_path, 'rb') as f:
+            size = f.seek(0, os.SEEK_END)
+            f.seek(0)
+            head = f.read(64)
+            if size < self.size or head[:len(self.head)] != self.head:
+                return LogIndex().update(file_path)
+            self.head = head
+            self.size = size
+            position = self.scanned
+            while position < size:
+                f.seek(position)
+                if position > 0:
+                    f.readline()
+                linestart = f.tell()
+                found = False
+                while linestart < size:
+                    line = f.readline()
+                    if not line.endswith(b'\n'):
+                        break
+                    timestamp = linetime(line.decode('utf-8', errors='replace'))
+                    if timestamp is not None:
+                        if not self.times or timestamp >= self.times[-1]:
+                            self.times.append(timestamp)
+                            self.offsets.append(linestart)
+                        found = True
+                        break
+                    linestart = f.tell()
+                if not found:
+                    break
+                position = linestart + INDEXSTEP
+            self.scanned = position
+        return self
+
+    def offsetafter(self, timestamp):
+        """Return an offset after which every line is newer than timestamp, None for end of file"""
+        index = bisect_right(self.times, timestamp)
+        if index < len(self.offsets):
+            return self.offsets[index]
+        return None
+
+    def offsetbefore(self, timestamp):
+        """Return an offset before which every line is older than timestamp"""
+        index = bisect_left(self.times, timestamp) - 1
+        if index >= 0:
+            return self.offsets[index]
+        return 0
+
+
+indexes = {}
+"""LogIndex objects for each log, keyed by live log path and then by file inode"""
+indexlock = Lock()
+
+
+def fileindex(file_path, files):
+    """
+    Returns the up to date LogIndex of one of the files of a log.
+
+    Indexes are kept by inode so they follow a file when the RotatingFileHandler renames it.
+    Indexes of files that are no longer part of the log are dropped.
+
+    Parameters:
+        file_path (str): The file to index.
+        files (list[str]): All the files of the log, the live file first.
+
+    Returns:
+        LogIndex: The index of the file.
+    """
+    with indexlock:
+        logindexes = indexes.setdefault(files[0], {})
+        inodes = {os.stat(name).st_ino for name in files}
+        for inode in list(logindexes):
+            if inode not in inodes:
+                del logindexes[inode]
+        inode = os.stat(file_path).st_ino
+        index = logindexes[inode] = logindexes.get(inode, LogIndex()).update(file_path)
+    return index
+
+
+def linematches(line, level, text):
+    """Return True if the line contains the level name and the text (case-insensitive)"""
+    if level and level not in line:
+        return False
+    if text and text not in line.lower():
+        return False
+    return True
+
+
+def searchlog(file_path, count, level=None, text=None, start=None, end=None, cursor=None):
+    """
+    Returns a page of the newest log lines that match the filters, continuing into the rotated
+    backups.
+
+    The index of each file is used to start reading just after the end of the time range and to
+    stop just before its start, so only the region of each file inside the range is read. Lines
+    without a timestamp (e.g. tracebacks) are given the time of the next newer timestamped line.
+
+    Parameters:
+        file_path (str): Path of the live log file.
+        count (int): The maximum number of lines in a page.
+        level (str): Only return lines containing this level name, e.g. 'WARNING'.
+        text (str): Only return lines containing this text, case-insensitive.
+        start (str): Only return lines at or after this time, 'YYYY-MM-DD HH:MM:SS'.
+        end (str): Only return lines at or before this time, 'YYYY-MM-DD HH:MM:SS'.
+        cursor (str): The cursor returned with the previous page, None for the newest lines.
+
+    Returns:
+        tuple: (lines, cursor) where lines is a list of matching log lines newest first and
+        cursor is the value to pass for the next (older) page, or None when the search is complete.
+    """
+    level = level.upper() if level else None
+    text = text.lower() if text else None
+    files = rotatedfiles(file_path)
+    if cursor is None:
+        index, offset = 0, None
+    else:
+        index, offset = findcursor(files, cursor)
+        if index is None:
+            return [], None
+    lines = []
+    examined = 0
+    while index < len(files):
+        lower = 0
+        if start is not None or end is not None:
+            logindex = fileindex(files[index], files)
+            if end is not None:
+                upper = logindex.offsetafter(end)
+                if upper is not None and (offset is None or upper < offset):
+                    offset = upper
+            if start is not None:
+                lower = logindex.offsetbefore(start)
+        linetimestamp = None
+        for line, linestart in iterbackward(files[index], offset):
+            if linestart < lower:
+                return lines, None
+            timestamp = linetime(line) or linetimestamp
+            linetimestamp = timestamp
+            if start is not None and timestamp is not None and timestamp < start:
+                return lines, None
+            examined += 1
+            inrange = end is None or timestamp is None or timestamp <= end
+            if inrange and linematches(line, level, text):
+                lines.append(line)
+            if len(lines) >= count or examined >= SEARCHLIMIT:
+                if linestart > 0:
+                    return lines, makecursor(files[index], linestart)
+                break
+        index += 1
+        offset = None
+        if len(lines) >= count or examined >= SEARCHLIMIT:
+            break
+    if index < len(files):
+        return lines, makecursor(files[index], os.path.getsize(files[index]))
+    return lines, None
@@ -0,0 +1,219 @@
+"""
+Metrics collection for the /metrics endpoint.
+
+Provides counters, histograms and gauges that are cheap enough to update on every request and
+every GPIO call (a dictionary lookup, a bisect and a lock, around a microsecond) and renders them
+in the Prometheus text exposition format.
+
+Each gunicorn worker counts its own requests, so the counters and histograms of the workers that
+do not own the GPIO are sent to the owner as a snapshot (see valvecontrol.pushmetrics) and the
+owner renders the sum of them all with its own; /metrics is therefore the same whichever worker
+serves it. Gauges are read in the owner. Snapshots of workers that have exited are folded into
+one retired total so the counters never go backwards while the owner keeps running.
+"""
+
+from bisect import bisect_left
+from threading import Lock
+
+LATENCYBUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                  1.0, 2.5, 5.0)
+"""Histogram buckets in seconds for HTTP request latency"""
+GPIOBUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+               0.001, 0.005, 0.01)
+"""Histogram buckets in seconds for individual GPIO calls"""
+TIMERBUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                0.05, 0.1)
+"""Histogram buckets in seconds for the lateness of timed valve actions"""
+
+registry = []
+"""Every metric in the order they are rendered"""
+workers = {}
+"""The last snapshot sent by each other worker, by pid, 0 holding the totals of workers that have exited"""
+
+
+def labeltext(labelnames, labels):
+    """Format label names and values as {name="value",...}, an empty string if there are none"""
+    if not labelnames:
+        return ''
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(labelnames, labels)]
+    return '{%s}' % ','.join(pairs)
+
+
+class Counter:
+    """A monotonically increasing count, optionally split by label values"""
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = Lock()
+        registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        """Add amount to the count for the given label values"""
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def snapshot(self):
+        """Return the counts as a JSON serialisable list of [labels, value]"""
+        with self.lock:
+            return self.entries(self.values)
+
+    @staticmethod
+    def add(totals, entries):
+        """Add snapshot entries into a {labels: value} dictionary"""
+        for labels, value in entries:
+            labels = tuple(labels)
+            totals[labels] = totals.get(labels, 0) + value
+
+    @staticmethod
+    def entries(totals):
+        """Return a {labels: value} dictionary as snapshot entries"""
+        return [[list(labels), value] for labels, value in totals.items()]
+
+    def render(self, others=()):
+        """Return the Prometheus text lines for this counter, adding the counts of other workers' snapshots"""
+        lines = ['# HELP %s %s' % (self.name, self.description), '# TYPE %s counter' % self.name]
+        with self.lock:
+            totals = dict(self.values)
+        for other in others:
+            self.add(totals, other.get(self.name, ()))
+        for labels, value in sorted(totals.items()):
+            lines.append('%s%s %s' % (self.name, labeltext(self.labelnames, labels), value))
+        return lines
+
+
+class Histogram:
+    """A distribution of observed values (e.g. durations), optionally split by label values"""
+
+    def __init__(self, name, description, labelnames=(), buckets=LATENCYBUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values = {}
+        self.lock = Lock()
+        registry.append(self)
+
+    def observe(self, value, *labels):
+        """Record one observation for the given label values"""
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def snapshot(self):
+        """Return the observations as a JSON serialisable list of [labels, bucket counts, sum]"""
+        with self.lock:
+            return [[list(labels), list(entry[0]), entry[1]] for labels, entry in self.values.items()]
+
+    @staticmethod
+    def add(totals, entries):
+        """Add snapshot entries into a {labels: (bucket counts, sum)} dictionary"""
+        for labels, counts, total in entries:
+            labels = tuple(labels)
+            current = totals.get(labels)
+            if current is None or len(current[0]) != len(counts):
+                totals[labels] = (list(counts), total)
+            else:
+                totals[labels] = ([mine + theirs for mine, theirs in zip(current[0], counts)], current[1] + total)
+
+    @staticmethod
+    def entries(totals):
+        """Return a {labels: (bucket counts, sum)} dictionary as snapshot entries"""
+        return [[list(labels), counts, total] for labels, (counts, total) in totals.items()]
+
+    def render(self, others=()):
+        """Return the Prometheus text lines for this histogram with cumulative buckets, adding other workers' snapshots"""
+        lines = ['# HELP %s %s' % (self.name, self.description), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            totals = {labels: (list(entry[0]), entry[1]) for labels, entry in self.values.items()}
+        for other in others:
+            self.add(totals, other.get(self.name, ()))
+        for labels, (counts, total) in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %s' % (self.name, labeltext(self.labelnames + ('le',),
+                                                                       labels + (bound,)), cumulative))
+            lines.append('%s_sum%s %s' % (self.name, labeltext(self.labelnames, labels), total))
+            lines.append('%s_count%s %s' % (self.name, labeltext(self.labelnames, labels), cumulative))
+        return lines
+
+
+class Gauge:
+    """A value read from a function each time the metrics are rendered"""
+
+    def __init__(self, name, description, function):
+        self.name = name
+        self.description = description
+        self.function = function
+        registry.append(self)
+
+    def render(self, _others=()):
+        """Return the Prometheus text lines for this gauge, nothing if the value cannot be read"""
+        try:
+            value = self.function()
+        except (OSError, ValueError):
+            return []
+        if value is None:
+            return []
+        return ['# HELP %s %s' % (self.name, self.description), '# TYPE %s gauge' % self.name,
+                '%s %s' % (self.name, value)]
+
+
+def snapshot():
+    """Return the counters and histograms of this process as a JSON serialisable {name: entries}"""
+    return {metric.name: metric.snapshot() for metric in registry if hasattr(metric, 'snapshot')}
+
+
+def collect(pid, values, alive):
+    """
+    Stores the snapshot sent by another worker and retires the snapshots of workers that have exited.
+
+    Parameters:
+        pid (int): The worker's pid.
+        values (dict): Its snapshot, as returned by snapshot().
+        alive (callable): alive(pid) returns False once a worker has exited.
+    """
+    workers[pid] = values
+    for other in [other for other in workers if other not in (0, pid) and not alive(other)]:
+        retired = {}
+        for metric in registry:
+            if hasattr(metric, 'snapshot'):
+                totals = {}
+                for entries in (workers.get(0, {}).get(metric.name, ()), workers[other].get(metric.name, ())):
+                    metric.add(totals, entries)
+                retired[metric.name] = metric.entries(totals)
+        workers[0] = retired
+        del workers[other]
+
+
+def render(others=None):
+    """
+    Return every registered metric in the Prometheus text exposition format.
+
+    Parameters:
+        others (list): Snapshots of other workers to add to the counters and histograms of this
+            process, by default every one stored by collect.
+    """
+    if others is None:
+        others = list(workers.values())
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render(others))
+    return '\n'.join(lines) + '\n'
+
+
+requestlatency = Histogram('valvecontroller_http_request_duration_seconds',
+                           'Time taken to handle each HTTP request', ('route', 'method'))
+gpiolatency = Histogram('valvecontroller_gpio_call_duration_seconds', 'Time taken by each GPIO call',
+                        ('call',), GPIOBUCKETS)
+timererror = Histogram('valvecontroller_timer_error_seconds',
+                       'Time between the due time of each timed action and when it actually ran', (), TIMERBUCKETS)
+commands = Counter('valvecontroller_commands_total', 'Valve commands by outcome', ('outcome',))
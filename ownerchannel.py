@@ -0,0 +1,118 @@
+"""
+Command channel between gunicorn worker processes and the process that owns the GPIO.
+
+The owning process listens on a UNIX socket. Other workers send each hardware command to it as a
+single JSON line, {"command": name, "args": [...]}, and wait for a JSON line reply holding either
+the result or an error. Errors are turned back into the same exceptions the caller would have
+seen had the command run in its own process.
+"""
+
+import os
+import json
+import socket
+import socketserver
+from concurrent.futures import TimeoutError as CommandTimeout
+from threading import Thread
+from time import monotonic, sleep
+from executor import ExecutorBusy
+from logmanager import logger
+
+CONNECTRETRY = 1.0
+"""Seconds to keep retrying the connection while a newly elected owner starts its listener"""
+FORWARDMARGIN = 1.0
+"""
+Seconds a forwarding worker waits beyond the command timeout, so the owner's own timeout (which
+cancels a command that has not started) always expires first and the worker gets its answer
+"""
+
+
+class OwnerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Threaded UNIX socket server run by the owning process"""
+    daemon_threads = True
+
+    def __init__(self, path, dispatch):
+        self.dispatch = dispatch
+        super().__init__(path, OwnerHandler)
+
+
+class OwnerHandler(socketserver.StreamRequestHandler):
+    """Runs each command line received from a worker and writes back the reply"""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                reply = {'result': self.server.dispatch(request['command'], *request.get('args', []))}
+            except ExecutorBusy:
+                reply = {'error': 'busy'}
+            except CommandTimeout:
+                reply = {'error': 'timeout'}
+            except Exception as error:  # report every failure back to the worker
+                logger.exception('Forwarded command failed')
+                reply = {'error': 'failed', 'message': str(error)}
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+
+def startserver(path, dispatch):
+    """
+    Starts the owner's command listener on a daemon thread.
+
+    Parameters:
+        path (str): The UNIX socket path, any stale socket left by a previous owner is removed.
+        dispatch (callable): Called as dispatch(command, *args) for each request.
+
+    Returns:
+        OwnerServer: The running server.
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    server = OwnerServer(path, dispatch)
+    os.chmod(path, 0o660)
+    Thread(target=server.serve_forever, name='owner-channel', daemon=True).start()
+    return server
+
+
+def forward(path, command, args, timeout):
+    """
+    Sends a command to the owning process and waits for the reply.
+
+    Parameters:
+        path (str): The owner's UNIX socket path.
+        command (str): The command name.
+        args (list): JSON serialisable arguments.
+        timeout (float): Seconds to wait for the reply.
+
+    Returns:
+        The command's result.
+
+    Raises:
+        ExecutorBusy: If the owner's queue is full or no owner can be reached.
+        concurrent.futures.TimeoutError: If the owner did not reply in time.
+        RuntimeError: If the command failed in the owning process.
+    """
+    deadline = monotonic() + CONNECTRETRY
+    while True:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(timeout)
+        try:
+            connection.connect(path)
+            break
+        except OSError:
+            connection.close()
+            if monotonic() > deadline:
+                raise ExecutorBusy('hardware owner process is not available') from None
+            sleep(0.05)
+    try:
+        connection.sendall(json.dumps({'command': command, 'args': list(args)}).encode('utf-8') + b'\n')
+        reply = json.loads(connection.makefile('rb').readline() or b'{"error": "failed"}')
+    except socket.timeout:
+        raise CommandTimeout() from None
+    finally:
+        connection.close()
+    if 'error' not in reply:
+        return reply['result']
+    if reply['error'] == 'busy':
+        raise ExecutorBusy('hardware command queue is full')
+    if reply['error'] == 'timeout':
+        raise CommandTimeout()
+    raise RuntimeError(reply.get('message', 'forwarded command failed'))
@@ -0,0 +1,171 @@
+"""
+Shared timer scheduler for timed valve actions.
+
+Every timed action (open for a duration, close after a delay, the delayed restart) is kept in
+one heap ordered by its due time on the monotonic clock and run by a single scheduler thread,
+rather than one threading.Timer thread per action. The thread sleeps on a condition until
+shortly before the next action is due and then spins for the last 'timerspin' seconds, so
+actions fire within tens of microseconds of their due time instead of at the mercy of the OS
+sleep granularity. Hardware actions are handed to the hardware executor so they still run on
+the single thread that owns the GPIO. The achieved timing error of every action is recorded.
+"""
+
+import heapq
+from collections import deque
+from itertools import count
+from threading import Thread, Condition
+from time import monotonic, time, sleep
+from logmanager import logger
+from metrics import timererror
+
+HISTORYLENGTH = 100
+"""Number of finished actions kept for describe"""
+
+
+class TimedAction:
+    """
+    One scheduled action.
+
+    Parameters:
+        timerid (int): The id used to cancel the action.
+        due (float): monotonic() time at which the action should run.
+        function (callable): Called with args when the action runs.
+        args (tuple): The arguments for function.
+        description (str): What the action does, e.g. 'close valve 3'.
+        hardware (bool): True to run the action on the hardware executor.
+    """
+
+    def __init__(self, timerid, due, function, args, description, hardware):
+        self.timerid = timerid
+        self.due = due
+        self.function = function
+        self.args = args
+        self.description = description
+        self.hardware = hardware
+        self.state = 'pending'
+        """pending, done, failed or cancelled"""
+        self.error = None
+        """Seconds between the due time and the time the action actually ran, once it has run"""
+
+    def describe(self):
+        """Return the action as a JSON serialisable dictionary"""
+        return {'id': self.timerid, 'action': self.description, 'state': self.state,
+                'due': round(time() + self.due - monotonic(), 6),
+                'error_ms': None if self.error is None else round(self.error * 1000, 3)}
+
+
+class TimerScheduler:
+    """
+    Runs timed actions from a heap on one thread.
+
+    Parameters:
+        spin (float): Seconds before an action is due at which the thread stops sleeping and
+            spins on the clock, 0 to rely on the condition wait alone.
+        name (str): The name of the scheduler thread.
+    """
+
+    def __init__(self, spin=0.001, name='valve-timers'):
+        self.spin = spin
+        self.heap = []
+        self.actions = {}
+        """Pending actions by id"""
+        self.history = deque(maxlen=HISTORYLENGTH)
+        self.ids = count(1)
+        self.condition = Condition()
+        self.executor = None
+        self.thread = Thread(target=self.run, name=name, daemon=True)
+
+    def start(self, executor):
+        """Start the scheduler thread, hardware actions are submitted to executor"""
+        self.executor = executor
+        self.thread.start()
+
+    def schedule(self, delay, function, *args, description='', hardware=True):
+        """
+        Schedules an action.
+
+        Parameters:
+            delay (float): Seconds from now, on the monotonic clock, until the action runs.
+            function (callable): Called with args when the action runs.
+            description (str): What the action does, shown by describe and in the log.
+            hardware (bool): True to run the action on the hardware executor, False to run it on
+                the scheduler thread (only for quick actions that do not touch the GPIO).
+
+        Returns:
+            TimedAction: The scheduled action.
+        """
+        with self.condition:
+            action = TimedAction(next(self.ids), monotonic() + max(0.0, delay), function, args, description,
+                                 hardware)
+            self.actions[action.timerid] = action
+            heapq.heappush(self.heap, (action.due, action.timerid, action))
+            self.condition.notify()
+        return action
+
+    def cancel(self, timerid):
+        """Cancel a pending action, return True if it was pending"""
+        with self.condition:
+            action = self.actions.pop(timerid, None)
+            if action is None:
+                return False
+            action.state = 'cancelled'
+            self.history.append(action)
+            self.condition.notify()
+        logger.info('Timer %s (%s) cancelled', timerid, action.description)
+        return True
+
+    def describe(self):
+        """Return the pending actions, soonest first, followed by the recently finished ones"""
+        with self.condition:
+            pending = sorted(self.actions.values(), key=lambda action: action.due)
+            finished = list(self.history)
+        return [action.describe() for action in pending + finished[::-1]]
+
+    def execute(self, action):
+        """Run an action and record its timing error"""
+        action.error = monotonic() - action.due
+        timererror.observe(max(0.0, action.error))
+        try:
+            action.function(*action.args)
+            action.state = 'done'
+        except Exception:
+            action.state = 'failed'
+            logger.exception('Timer %s (%s) failed', action.timerid, action.description)
+            raise
+        finally:
+            with self.condition:
+                self.history.append(action)
+        logger.debug('Timer %s (%s) ran %.3fms after its due time', action.timerid, action.description,
+                     action.error * 1000)
+
+    def nextdue(self):
+        """Wait for the next due action and remove it from the heap, skipping cancelled ones"""
+        with self.condition:
+            while True:
+                while self.heap and self.heap[0][2].state == 'cancelled':
+                    heapq.heappop(self.heap)
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                wait = self.heap[0][0] - monotonic() - self.spin
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                due, timerid, action = heapq.heappop(self.heap)
+                del self.actions[timerid]
+                break
+        while monotonic() < due:
+            sleep(0)   # yield the GIL so the executor is not held up while spinning
+        return action
+
+    def run(self):
+        """Scheduler thread loop, runs due actions for the life of the process"""
+        while True:
+            action = self.nextdue()
+            if action.hardware:
+                self.executor.submitwait(self.execute, action)
+            else:
+                try:
+                    self.execute(action)
+                except Exception:  # already logged, keep the scheduler running
+                    pass
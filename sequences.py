@@ -0,0 +1,262 @@
+"""
+Stored valve sequences.
+
+A sequence is a named, ordered list of steps kept in the 'sequences' setting, e.g.
+
+    "sequences": {
+        "pipettefill": [
+            {"item": "valve2", "command": "close"},
+            {"item": "valve1", "command": "open"},
+            {"wait": 500},
+            {"item": "valve1", "command": "close"}
+        ]
+    }
+
+Each step is a valve open/close, closeallvalves, or a wait in milliseconds. The sequences are
+compiled once when the settings are loaded: consecutive valve steps are merged into one stage
+holding an open mask and a close mask on the valve state word, applied as one grouped write, and
+every wait becomes the delay after a stage. While compiling, every stage is checked against the
+valve interlocks assuming the valves the sequence does not touch are closed, so a sequence that
+could ever open two interlocked valves itself is rejected before it can be run. Valves opened
+outside the sequence are checked again as each stage is applied.
+
+SequenceRunner starts, follows and aborts the runs in the process that owns the GPIO.
+"""
+
+from collections import namedtuple
+from time import time
+from logmanager import logger
+from metrics import commands
+
+Stage = namedtuple('Stage', 'openmask closemask delay')
+"""One compiled stage: bits to set, bits to clear, and seconds to wait before the next stage"""
+
+
+def compilesequence(name, steps, table):
+    """
+    Compiles and validates one sequence.
+
+    Parameters:
+        name (str): The sequence name, used in error messages.
+        steps (list[dict]): The steps as stored in the settings.
+        table (ValveTable): The valve table giving the state bits and interlocks.
+
+    Returns:
+        list[Stage]: The compiled stages.
+
+    Raises:
+        ValueError: If a step is badly formed or the sequence would open interlocked valves.
+    """
+    if not isinstance(steps, list) or len(steps) == 0:
+        raise ValueError('sequence %s must be a non-empty list of steps' % name)
+    stages = []
+    openmask = closemask = 0
+    pending = False
+    state = 0
+    for index, step in enumerate(steps):
+        if not isinstance(step, dict):
+            raise ValueError('sequence %s step %s: badly formed step' % (name, index))
+        if 'wait' in step:
+            try:
+                delay = float(step['wait']) / 1000
+            except (TypeError, ValueError):
+                raise ValueError('sequence %s step %s: wait must be a number of milliseconds' % (name, index)) from None
+            if delay < 0:
+                raise ValueError('sequence %s step %s: wait must not be negative' % (name, index))
+            if pending:
+                stages.append(Stage(openmask, closemask, delay))
+                state = (state & ~closemask) | openmask
+                openmask = closemask = 0
+                pending = False
+            elif stages:
+                stages[-1] = stages[-1]._replace(delay=stages[-1].delay + delay)
+            else:
+                stages.append(Stage(0, 0, delay))
+            continue
+        item = step.get('item')
+        command = step.get('command')
+        if item == 'closeallvalves':
+            openmask, closemask = 0, table.allmask
+        else:
+            try:
+                valveid = int(item[5:]) if item[:5] == 'valve' else None
+            except (TypeError, ValueError):
+                valveid = None
+            if valveid not in table.bit:
+                raise ValueError('sequence %s step %s: unknown item %s' % (name, index, item))
+            bit = table.bit[valveid]
+            if command == 'open':
+                openmask, closemask = openmask | bit, closemask & ~bit
+            elif command == 'close':
+                openmask, closemask = openmask & ~bit, closemask | bit
+            else:
+                raise ValueError('sequence %s step %s: bad valve command %s' % (name, index, command))
+        pending = True
+        conflicts = table.conflicts((state & ~closemask) | openmask)
+        if conflicts:
+            raise ValueError('sequence %s step %s: interlocked valves %s would be open together'
+                             % (name, index, ', '.join(str(valveid) for valveid in conflicts)))
+    if pending:
+        stages.append(Stage(openmask, closemask, 0.0))
+    return stages
+
+
+def compilesequences(definitions, table):
+    """
+    Compiles every stored sequence.
+
+    Parameters:
+        definitions (dict): {name: steps} from the 'sequences' setting.
+        table (ValveTable): The valve table giving the state bits and interlocks.
+
+    Returns:
+        tuple: ({name: list[Stage]} of the valid sequences, {name: error message} of the rejected ones).
+    """
+    compiled = {}
+    errors = {}
+    for name, steps in (definitions or {}).items():
+        try:
+            compiled[name] = compilesequence(name, steps, table)
+        except ValueError as error:
+            errors[name] = str(error)
+    return compiled, errors
+
+
+class SequenceRun:
+    """
+    The progress of one run of a sequence.
+
+    Parameters:
+        runid (int): The run id, used to query or abort the run.
+        name (str): The sequence name.
+        stages (list[Stage]): The compiled stages.
+    """
+
+    def __init__(self, runid, name, stages):
+        self.runid = runid
+        self.name = name
+        self.stages = stages
+        self.stage = 0
+        """Index of the next stage to apply"""
+        self.state = 'running'
+        """running, done, aborted or failed"""
+        self.error = None
+        self.started = time()
+        self.finished = None
+        self.timer = None
+        """The scheduled TimedAction of the next stage"""
+
+    def finish(self, state, error=None):
+        """Mark the run as finished"""
+        self.state = state
+        self.error = error
+        self.finished = time()
+        self.timer = None
+
+    def describe(self):
+        """Return the run progress as a JSON serialisable dictionary"""
+        return {'run': self.runid, 'sequence': self.name, 'state': self.state, 'stage': self.stage,
+                'stages': len(self.stages), 'started': self.started, 'finished': self.finished,
+                'error': self.error}
+
+
+class SequenceRunner:
+    """
+    The stored sequences and their recent runs, in the owning process. Every method runs on the
+    hardware executor thread.
+
+    Parameters:
+        compiled (dict): {name: list[Stage]} of the valid sequences, see compilesequences.
+        errors (dict): {name: error message} of the rejected sequences.
+        applystate (callable): applystate(target, source) drives the valves to a state word and
+            returns False if the interlocks refuse it.
+        currentstate (callable): Returns the current valve state word.
+        timers (TimerScheduler): Runs the stages after the first at their due time.
+    """
+    MAXRUNS = 20
+    """Finished runs kept for status queries"""
+
+    def __init__(self, compiled, errors, applystate, currentstate, timers):
+        self.sequences = {}
+        self.errors = {}
+        self.runs = {}
+        """The recent runs by run id"""
+        self.applystate = applystate
+        self.currentstate = currentstate
+        self.timers = timers
+        self.load(compiled, errors)
+
+    def load(self, compiled, errors):
+        """Make newly compiled sequences current, logging the rejected ones"""
+        self.sequences, self.errors = compiled, errors
+        for name, error in errors.items():
+            logger.error('Sequence %s rejected: %s', name, error)
+
+    def command(self, item, command):
+        """
+        Starts, queries or aborts a stored sequence run.
+
+        Parameters:
+            item (str): 'sequence' to start the sequence named by command, or 'runN' for run N.
+            command (str): The sequence name, or 'status' or 'abort' for a run.
+
+        Returns:
+            dict: {'run': progress} (see SequenceRun.describe) or {'error': message}.
+        """
+        if item == 'sequence':
+            if command not in self.sequences:
+                return {'error': self.errors.get(command, 'unknown sequence %s' % command)}
+            if any(run.state == 'running' for run in self.runs.values()):
+                return {'error': 'a sequence is already running'}
+            run = SequenceRun(max(self.runs, default=0) + 1, command, self.sequences[command])
+            self.runs[run.runid] = run
+            while len(self.runs) > self.MAXRUNS:
+                del self.runs[min(self.runs)]
+            logger.info('Sequence %s started as run %s', command, run.runid)
+            commands.inc('sequence_started')
+            self.runstage(run)
+            return {'run': run.describe()}
+        try:
+            run = self.runs.get(int(item[3:])) if item[:3] == 'run' else None
+        except ValueError:
+            run = None
+        if run is None:
+            return {'error': 'unknown sequence run %s' % item}
+        if command == 'abort' and run.state == 'running':
+            if run.timer is not None:
+                self.timers.cancel(run.timer.timerid)
+            run.finish('aborted')
+            logger.warning('Sequence %s run %s aborted at stage %s', run.name, run.runid, run.stage)
+            commands.inc('sequence_aborted')
+        elif command not in ('abort', 'status'):
+            return {'error': 'bad run command %s' % command}
+        return {'run': run.describe()}
+
+    def runstage(self, run):
+        """
+        Applies the next stage of a sequence run and schedules the one after it.
+
+        Each stage is applied with applystate, so the valves it changes switch together and valves
+        opened outside the sequence are checked against the interlocks; a stage that would open
+        interlocked valves fails the run and leaves the valves as they are.
+        """
+        if run.state != 'running':
+            return
+        stage = run.stages[run.stage]
+        if not self.applystate((self.currentstate() & ~stage.closemask) | stage.openmask, 'sequence'):
+            run.finish('failed', 'stage %s would open interlocked valves' % run.stage)
+            logger.error('Sequence %s run %s failed at stage %s', run.name, run.runid, run.stage)
+            commands.inc('sequence_failed')
+            return
+        run.stage += 1
+        if run.stage == len(run.stages):
+            run.finish('done')
+            logger.info('Sequence %s run %s completed', run.name, run.runid)
+            return
+        run.timer = self.timers.schedule(stage.delay, self.runstage, run,
+                                         description='sequence %s run %s stage %s' % (run.name, run.runid, run.stage))
+
+    def describe(self):
+        """Return the stored sequences with their number of stages, the load errors and the recent runs"""
+        return {'sequences': {name: len(stages) for name, stages in self.sequences.items()},
+                'errors': self.errors, 'runs': [run.describe() for run in self.runs.values()]}
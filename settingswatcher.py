@@ -0,0 +1,109 @@
+"""
+Hot reload of the settings file.
+
+One thread per process checks the modification time and size of settings.json every
+'settingspoll' seconds. When the file changes it is read into a new settings snapshot, offered
+to the registered checks, and if none of them refuses it the snapshot replaces the current one
+in a single assignment. Requests already running keep the snapshot they started with, and the
+listeners are then told about the change so they can rebuild anything derived from the settings
+(the valve table, the compiled sequences, the log level). A file that cannot be parsed or is
+refused is logged and the current settings stay in force until the file is changed again. A
+refusal rejects the whole file, so its changes to unrelated settings wait as well. Nothing is
+written to the GPIO by a reload.
+"""
+
+import logging
+from threading import Thread, Event
+from logmanager import logger
+from app_control import settings, reloadsettings, settingsstamp
+
+checks = []
+"""check(new) callables returning a reason to refuse a new settings snapshot, or None"""
+listeners = []
+"""listener(old, new) callables told about every published settings snapshot"""
+
+
+def addcheck(check):
+    """Register a check that can refuse a reloaded settings snapshot"""
+    checks.append(check)
+
+
+def addlistener(listener):
+    """Register a listener called with (old, new) snapshots after the settings are reloaded"""
+    listeners.append(listener)
+
+
+def refusal(new):
+    """Return the reason the first check gives for refusing a snapshot, None if all accept it"""
+    for check in checks:
+        reason = check(new)
+        if reason:
+            return reason
+    return None
+
+
+def setloglevel(old, new):
+    """Listener, applies a changed 'loglevel' setting"""
+    if old['loglevel'].upper() != new['loglevel'].upper():
+        logger.setLevel(logging.DEBUG if new['loglevel'].upper() == 'DEBUG' else logging.INFO)
+        logger.info('Logging level set to: %s', new['loglevel'].upper())
+
+
+addlistener(setloglevel)
+
+
+def reload():
+    """
+    Reloads the settings file and tells the listeners.
+
+    Returns:
+        list: The names of the settings that changed, empty if the file was refused or unchanged.
+    """
+    try:
+        old, new = reloadsettings(refusal)
+    except (ValueError, TypeError) as error:
+        logger.error('Settings: reload of settings.json refused, keeping the current settings: %s', error)
+        return []
+    changed = sorted(item for item in new if item != 'LastSave' and new[item] != old.get(item))
+    if not changed:
+        return []
+    logger.info('Settings: reloaded, changed %s', ', '.join(changed))
+    for listener in listeners:
+        try:
+            listener(old, new)
+        except Exception:   # one listener failing must not stop the others
+            logger.exception('Settings: reload listener %s failed', getattr(listener, '__name__', listener))
+    return changed
+
+
+class SettingsWatcher:
+    """Polls the settings file on a background thread and reloads it when it changes"""
+
+    def __init__(self):
+        self.stamp = settingsstamp()
+        self.stopevent = Event()
+        self.thread = Thread(target=self.run, name='settings-watcher', daemon=True)
+
+    def start(self):
+        """Start the watcher thread, unless 'settingspoll' is 0"""
+        if settings['settingspoll'] and not self.thread.is_alive():
+            self.thread.start()
+
+    def poll(self):
+        """Reload the settings if the file has changed since it was last read"""
+        stamp = settingsstamp()
+        if stamp is None or stamp == self.stamp:
+            return
+        self.stamp = stamp
+        reload()
+
+    def run(self):
+        """Watcher thread loop"""
+        while not self.stopevent.wait(settings['settingspoll'] or 1):
+            try:
+                self.poll()
+            except Exception:   # keep watching whatever happens
+                logger.exception('Settings: reload failed')
+
+
+watcher = SettingsWatcher()
@@ -0,0 +1,130 @@
+"""
+Valve state shared between gunicorn worker processes.
+
+One worker process is elected to own the GPIO by taking an exclusive lock on the owner lock
+file; it keeps the lock for its lifetime, and when it exits the lock is released so another
+worker can take over. The owner publishes the valve state word, the state version and the
+reconciliation and watchdog results in a small memory mapped file (in /dev/shm by default) so that every
+worker can serve status reads without asking the owner. Access to the mapped file is guarded by
+a file lock between processes and a thread lock within a process.
+"""
+
+import os
+import mmap
+import fcntl
+import struct
+from collections import namedtuple
+from threading import Lock
+
+LAYOUT = struct.Struct('<QQQQQdddQQ')
+"""
+state version, valve state word, gunicorn master pid, owner pid, drift mask, drift checked time,
+watchdog heartbeat time, time of the last successful hardware call, boot id and start time of the
+gunicorn master (see masteridentity)
+"""
+SharedValues = namedtuple('SharedValues', 'version state masterpid ownerpid driftmask driftchecked heartbeat '
+                                          'hardwareok bootid masterstart')
+
+
+def masteridentity():
+    """
+    Identifies the gunicorn master this worker belongs to, so a worker taking over the GPIO can
+    tell a sibling that died from a previous run of the application.
+
+    Returns:
+        tuple: (boot id, master start time in clock ticks since boot), both non-zero, or None if
+        the parent process is not a gunicorn master (e.g. asyncapp.py, or a service whose parent
+        is PID 1) or cannot be identified.
+    """
+    parent = os.getppid()
+    if parent <= 1:
+        return None
+    try:
+        with open('/proc/%d/cmdline' % parent, 'rb') as file:
+            if b'gunicorn' not in file.read():
+                return None
+        with open('/proc/%d/stat' % parent, 'r', encoding='ascii') as file:
+            starttime = int(file.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/sys/kernel/random/boot_id', 'r', encoding='ascii') as file:
+            bootid = int(file.read().strip().replace('-', '')[:16], 16)
+    except (OSError, ValueError, IndexError):
+        return None
+    if not bootid or not starttime:
+        return None
+    return bootid, starttime
+
+
+def processalive(pid):
+    """Return True if a process with the pid exists"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedState:
+    """
+    The memory mapped block of valve state shared by all worker processes.
+
+    Parameters:
+        path (str): The file to map, created if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o660)
+        if os.fstat(self.fd).st_size < LAYOUT.size:
+            os.ftruncate(self.fd, LAYOUT.size)
+        self.map = mmap.mmap(self.fd, LAYOUT.size)
+        self.lock = Lock()
+
+    def read(self):
+        """Return the shared values as a SharedValues tuple"""
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_SH)
+            try:
+                return SharedValues(*LAYOUT.unpack_from(self.map, 0))
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def write(self, **values):
+        """Replace the named shared values, e.g. write(version=3, state=5)"""
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                current = SharedValues(*LAYOUT.unpack_from(self.map, 0))
+                LAYOUT.pack_into(self.map, 0, *current._replace(**values))
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+class OwnerLock:
+    """
+    The lock that elects the worker process that owns the GPIO.
+
+    Parameters:
+        path (str): The lock file, created if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def acquire(self):
+        """Try to become the owner without waiting, return True if this process is the owner"""
+        if self.fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o660)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    def owned(self):
+        """Return True if this process holds the lock"""
+        return self.fd is not None
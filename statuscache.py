@@ -0,0 +1,72 @@
+"""
+Single-flight coalescing of valve status reads.
+
+Status polls from several clients tend to arrive together. Rather than each request taking its
+own state snapshot, building its own list of dicts and serialising its own JSON, the requests
+share one StatusEntry: within 'statuswindow' seconds of the last snapshot the entry is returned
+as it is, after that one request takes a new snapshot while any others arriving meanwhile wait
+for it, and the JSON body is only serialised again when the state version has changed. The body
+holds only valve ids and states, and the valve ids cannot change without a restart, so the ETag
+is the state version alone and is the same in every worker process.
+"""
+
+import json
+from collections import namedtuple
+from threading import Lock
+from time import monotonic
+from metrics import Counter
+
+StatusEntry = namedtuple('StatusEntry', 'version state body etag taken')
+"""A status snapshot: state version, state word, serialised JSON body, its ETag, and the monotonic() time it was taken"""
+
+statusreads = Counter('valvecontroller_status_reads_total', 'Status reads by how they were served', ('served',))
+
+
+class CoalescedStatus:
+    """
+    The shared status entry.
+
+    Parameters:
+        window (float): Seconds a snapshot is shared for before the next read takes a new one.
+        snapshot (callable): Returns the current (version, state word).
+        render (callable): Returns the JSON serialisable status of a state word.
+    """
+
+    def __init__(self, window, snapshot, render):
+        self.window = window
+        self.snapshot = snapshot
+        self.render = render
+        self.entry = None
+        self.lock = Lock()
+
+    def get(self, fresh=False):
+        """
+        Returns the status entry.
+
+        Parameters:
+            fresh (bool): Take a new snapshot even within the window, e.g. straight after a
+                command so the reply shows its effect.
+
+        Returns:
+            StatusEntry: The shared entry.
+        """
+        entry = self.entry
+        if not fresh and entry is not None and monotonic() - entry.taken < self.window:
+            statusreads.inc('shared')
+            return entry
+        with self.lock:
+            entry = self.entry
+            if not fresh and entry is not None and monotonic() - entry.taken < self.window:
+                statusreads.inc('shared')   # another request refreshed it while this one waited
+                return entry
+            version, state = self.snapshot()
+            etag = 'v%s' % version
+            if entry is not None and entry.etag == etag:
+                statusreads.inc('snapshot')
+                entry = entry._replace(taken=monotonic())
+            else:
+                statusreads.inc('rendered')
+                body = json.dumps(self.render(state), sort_keys=True, separators=(',', ':')) + '\n'
+                entry = StatusEntry(version, state, body.encode('utf-8'), etag, monotonic())
+            self.entry = entry
+            return entry
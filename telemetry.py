@@ -0,0 +1,154 @@
+"""
+Background telemetry sampler.
+
+One thread in the process that owns the GPIO samples the CPU temperature, the firmware throttle flags, the load
+average and the process thread count every 'telemetryinterval' seconds into a fixed-size ring
+buffer holding the last 'telemetrysamples' samples. Pages read the latest sample instead of
+opening the thermal file on every view, and /api/telemetry returns the history downsampled into
+min/max/avg buckets so throttling in a hot rack can be seen after the event. The other workers
+get the history and the latest sample from the owner (valvecontrol.telemetryhistory and
+latestsample), so the thread count is that of the owning process.
+"""
+
+import os
+from collections import deque, namedtuple
+from threading import Thread, Event, active_count
+from time import time
+from logmanager import logger
+from app_control import settings
+
+Sample = namedtuple('Sample', 'time temperature throttled load threads')
+"""One telemetry sample, temperature in degrees C (None if unreadable), throttled as the firmware flag word"""
+THROTTLEFLAGS = {0: 'under-voltage', 1: 'frequency capped', 2: 'throttled', 3: 'soft temperature limit',
+                 16: 'under-voltage occurred', 17: 'frequency capping occurred', 18: 'throttling occurred',
+                 19: 'soft temperature limit occurred'}
+"""Names of the bits of the firmware get_throttled word"""
+
+
+def readtemperature():
+    """Return the CPU temperature in degrees C from the 'cputemp' file, rounded to one decimal place"""
+    with open(settings['cputemp'], 'r', encoding='utf-8') as file:
+        return round(float(file.readline()) / 1000, 1)
+
+
+def readthrottled():
+    """Return the firmware throttle flag word from the 'throttlepath' file, None if it cannot be read"""
+    try:
+        with open(settings['throttlepath'], 'r', encoding='utf-8') as file:
+            return int(file.readline().strip(), 16)
+    except (OSError, ValueError):
+        return None
+
+
+def throttlenames(flags):
+    """Return the names of the throttle flags set in a flag word"""
+    if not flags:
+        return []
+    return [name for bit, name in THROTTLEFLAGS.items() if flags & (1 << bit)]
+
+
+def summary(values):
+    """Return {min, max, avg} of the values that are not None, None if there are none"""
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    return {'min': min(values), 'max': max(values), 'avg': round(sum(values) / len(values), 2)}
+
+
+class TelemetrySampler:
+    """
+    Samples the telemetry into a ring buffer on a background thread.
+
+    Parameters:
+        interval (float): Seconds between samples.
+        size (int): The number of samples kept.
+    """
+
+    def __init__(self, interval, size):
+        self.interval = interval
+        self.samples = deque(maxlen=size)
+        self.latest = None
+        """The most recent Sample"""
+        self.stopevent = Event()
+        self.thread = Thread(target=self.run, name='telemetry-sampler', daemon=True)
+
+    def start(self):
+        """Take the first sample and start the sampler thread"""
+        self.sample()
+        self.thread.start()
+
+    def sample(self):
+        """Take one sample and add it to the ring buffer"""
+        try:
+            temperature = readtemperature()
+        except (OSError, ValueError):
+            temperature = None
+        sample = Sample(time(), temperature, readthrottled(), round(os.getloadavg()[0], 2), active_count())
+        self.samples.append(sample)
+        self.latest = sample
+        if sample.throttled and sample.throttled & 0xF and not self.previousflags() & 0xF:
+            logger.warning('CPU throttling: %s at %s C', ', '.join(throttlenames(sample.throttled & 0xF)),
+                           sample.temperature)
+        return sample
+
+    def previousflags(self):
+        """Return the throttle flags of the sample before the latest, 0 if there is none"""
+        if len(self.samples) < 2:
+            return 0
+        return self.samples[-2].throttled or 0
+
+    def run(self):
+        """Sampler thread loop"""
+        while not self.stopevent.wait(self.interval):
+            try:
+                self.sample()
+            except Exception:   # keep sampling whatever happens
+                logger.exception('Telemetry sample failed')
+
+    def history(self, buckets=60, since=None):
+        """
+        Returns the sampled history downsampled into equal time buckets.
+
+        Parameters:
+            buckets (int): The number of buckets the time window is divided into.
+            since (float): Start of the window as a unix time, defaults to the oldest sample.
+
+        Returns:
+            dict: The sample interval, the latest sample and a list of buckets, each with its
+            start and end time, sample count, min/max/avg of the temperature, load and thread
+            count, and the throttle flags seen in the bucket.
+        """
+        samples = list(self.samples)
+        if since is not None:
+            samples = [sample for sample in samples if sample.time >= since]
+        result = {'interval': self.interval, 'latest': self.describe(self.latest), 'buckets': []}
+        if not samples:
+            return result
+        start = samples[0].time if since is None else since
+        width = max((samples[-1].time - start) / max(1, buckets), 1e-9)
+        grouped = {}
+        for sample in samples:
+            grouped.setdefault(min(int((sample.time - start) / width), buckets - 1), []).append(sample)
+        for index in sorted(grouped):
+            group = grouped[index]
+            flags = 0
+            for sample in group:
+                flags |= sample.throttled or 0
+            result['buckets'].append({'start': round(start + index * width, 3), 'end': round(start + (index + 1) * width, 3),
+                                      'count': len(group),
+                                      'temperature': summary(sample.temperature for sample in group),
+                                      'load': summary(sample.load for sample in group),
+                                      'threads': summary(sample.threads for sample in group),
+                                      'throttled': throttlenames(flags)})
+        return result
+
+    @staticmethod
+    def describe(sample):
+        """Return a sample as a JSON serialisable dictionary"""
+        if sample is None:
+            return None
+        return {'time': sample.time, 'temperature': sample.temperature, 'load': sample.load,
+                'threads': sample.threads, 'throttled': throttlenames(sample.throttled)}
+
+
+sampler = TelemetrySampler(settings['telemetryinterval'], settings['telemetrysamples'])
@@ -0,0 +1,22 @@
+"""
+Runs the tests in a scratch directory, on the simulated GPIO backend.
+
+app_control and logmanager read and create settings.json and ./logs in the working directory
+when they are imported, so the directory is changed, and a settings file written that selects
+the simulated pins and keeps the logs, shared state and owner socket inside it (by absolute
+path, as the atexit handlers may run in another directory), before any test module imports them.
+"""
+
+import os
+import json
+import tempfile
+
+os.chdir(tempfile.mkdtemp(prefix='valvecontroller-tests-'))
+with open('settings.json', 'w', encoding='utf-8') as settingsfile:
+    json.dump({'gpiobackend': 'simulated', 'settingspoll': 0,
+               'logfilepath': os.path.abspath('logs/valvecontroller.log'),
+               'gunicornpath': os.path.abspath('logs') + '/',
+               'historypath': os.path.abspath('logs/valvehistory.bin'),
+               'statspath': os.path.abspath('logs/accessstats.json'),
+               'sharedstatepath': os.path.abspath('valvecontroller.state'),
+               'ownersocket': os.path.abspath('owner.sock')}, settingsfile)
@@ -0,0 +1,43 @@
+"""Tests of the access log statistics"""
+
+from accessstats import AccessStats
+
+UNIXSOCKETLINES = [
+    b' - - [17/Oct/2026:06:31:00 +0000] "GET /api/status HTTP/1.0" 200 512 "-" "curl/8.5.0"\n',
+    b' - - [17/Oct/2026:06:31:01 +0000] "POST /api HTTP/1.0" 401 35 "-" "python-requests/2.31"\n',
+]
+"""Lines as gunicorn writes them when bound to unix:/tmp/gunicorn.sock, with an empty client field"""
+
+
+def makestats(tmp_path, lines):
+    """Return the statistics of an access log holding the lines"""
+    logpath = tmp_path / 'gunicorn-access.log'
+    logpath.write_bytes(b''.join(lines))
+    return AccessStats(lambda: str(logpath), lambda: str(tmp_path / 'accessstats.json'))
+
+
+def test_unix_socket_lines_are_parsed(tmp_path):
+    """Lines with an empty client are counted, under the client '-'"""
+    report = makestats(tmp_path, UNIXSOCKETLINES).report()
+    assert report['lines'] == 2
+    assert report['unparsed'] == 0
+    assert report['clients'] == [{'client': '-', 'requests': 2, 'errors': 1, 'errorrate': 50.0, 'bytes': 547}]
+    assert [entry['endpoint'] for entry in report['endpoints']] == ['/api/status', '/api']
+    assert report['statuses'] == {'200': 1, '401': 1}
+
+
+def test_tcp_lines_keep_the_client_address(tmp_path):
+    """Lines from a TCP bind are counted under their client address"""
+    line = b'127.0.0.1 - - [17/Oct/2026:06:31:00 +0000] "GET /api/status HTTP/1.1" 200 512 "-" "curl/8.5.0"\n'
+    report = makestats(tmp_path, [line]).report()
+    assert report['clients'][0]['client'] == '127.0.0.1'
+
+
+def test_only_appended_lines_are_read_again(tmp_path):
+    """A second update parses only the lines added since the checkpoint"""
+    stats = makestats(tmp_path, UNIXSOCKETLINES[:1])
+    assert stats.report()['lines'] == 1
+    with open(stats.logpath(), 'ab') as file:
+        file.write(UNIXSOCKETLINES[1])
+    assert stats.report()['lines'] == 2
+    assert AccessStats(stats.logpath, stats.statspath).report()['lines'] == 2
@@ -0,0 +1,61 @@
+"""Tests of the single-thread hardware executor"""
+
+from concurrent.futures import TimeoutError as CommandTimeout
+from threading import Event
+import pytest
+from executor import HardwareExecutor, ExecutorBusy
+
+
+@pytest.fixture(name='executor')
+def executorfixture():
+    """A started executor with room for two waiting commands"""
+    executor = HardwareExecutor(2, name='test-executor')
+    executor.start()
+    return executor
+
+
+def blocked(executor):
+    """Occupy the executor thread until the returned event is set"""
+    started = Event()
+    release = Event()
+    executor.submit(lambda: (started.set(), release.wait(5)))
+    assert started.wait(5)
+    return release
+
+
+def test_commands_run_in_order_on_the_executor_thread(executor):
+    """Commands run one at a time in arrival order, on the executor thread, and return their result"""
+    ran = []
+    futures = [executor.submit(ran.append, number) for number in range(2)]
+    assert [future.result(5) for future in futures] == [None, None]
+    assert executor.call(executor.onexecutor, timeout=5)
+    assert ran == [0, 1]
+
+
+def test_a_full_queue_refuses_at_once(executor):
+    """With the thread busy and the queue full a further command raises ExecutorBusy straight away"""
+    release = blocked(executor)
+    executor.submit(print)
+    executor.submit(print)
+    with pytest.raises(ExecutorBusy):
+        executor.submit(print)
+    release.set()
+
+
+def test_a_command_that_times_out_in_the_queue_never_runs(executor):
+    """call cancels a command that had not started when its timeout expired, so it is not run later"""
+    release = blocked(executor)
+    ran = []
+    with pytest.raises(CommandTimeout):
+        executor.call(ran.append, 'late', timeout=0.05)
+    release.set()
+    executor.call(print, timeout=5)
+    assert not ran
+
+
+def test_an_exception_reaches_the_caller_and_the_thread_carries_on(executor):
+    """A failing command raises its own exception in the caller and does not count as a success"""
+    with pytest.raises(ZeroDivisionError):
+        executor.call(lambda: 1 / 0, timeout=5)
+    assert executor.call(lambda: 'ok', timeout=5) == 'ok'
+    assert executor.completed == 1
@@ -0,0 +1,103 @@
+"""Tests of the fleet gateway against in-process stand-in controllers"""
+
+import asyncio
+from aiohttp import web, ClientSession
+from aiohttp.test_utils import TestServer, TestClient
+from app_control import settings
+import gateway
+
+STANDINKEY = 'standin-key'
+VALVES = [{'valve': 1, 'status': 'closed'}, {'valve': 2, 'status': 'open'}]
+
+
+def standinapp(seen):
+    """
+    Return a stand-in controller serving /api/status with the ETag "v1" and accepting every
+    /api command, recording the If-None-Match header of each status request in seen
+    """
+    async def status(request):
+        if request.headers.get('Api-Key') != STANDINKEY:
+            return web.Response(text='access token(s) incorrect', status=401)
+        seen.append(request.headers.get('If-None-Match'))
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304, headers={'ETag': '"v1"'})
+        return web.json_response(VALVES, headers={'ETag': '"v1"'})
+
+    async def command(request):
+        return web.json_response(await request.json(), status=201)
+
+    application = web.Application()
+    application.router.add_get('/api/status', status)
+    application.router.add_post('/api', command)
+    return application
+
+
+async def startstandin(seen):
+    """Start a stand-in controller and return its server"""
+    server = TestServer(standinapp(seen))
+    await server.start_server()
+    return server
+
+
+def test_fetch_reuses_the_cached_status_on_304():
+    """A second fetch sends the ETag, and the 304 keeps the cached valves"""
+    async def scenario():
+        seen = []
+        server = await startstandin(seen)
+        controller = gateway.Controller('line1', str(server.make_url('')), STANDINKEY, 2.0)
+        async with ClientSession() as session:
+            await controller.fetch(session)
+            await controller.fetch(session)
+        await server.close()
+        return seen, controller.describe()
+
+    seen, described = asyncio.run(scenario())
+    assert seen == [None, '"v1"']
+    assert described['ok'] and described['valves'] == VALVES
+
+
+def test_failed_fetch_marks_the_last_status_stale():
+    """A controller that stops answering keeps its last status, marked stale with the error"""
+    async def scenario():
+        server = await startstandin([])
+        controller = gateway.Controller('line1', str(server.make_url('')), STANDINKEY, 0.5)
+        async with ClientSession() as session:
+            await controller.fetch(session)
+            await server.close()
+            await controller.fetch(session)
+        return controller.describe()
+
+    described = asyncio.run(scenario())
+    assert not described['ok']
+    assert described['stale'] and described['error']
+    assert described['valves'] == VALVES
+
+
+def test_command_fan_out_reports_a_partial_failure_as_207(monkeypatch):
+    """A command reaching one controller but not the other gives 207 with both results"""
+    async def scenario():
+        server = await startstandin([])
+        down = await startstandin([])
+        downurl = str(down.make_url(''))
+        await down.close()
+        monkeypatch.setattr(gateway, 'controllers', gateway.buildcontrollers([
+            {'name': 'up', 'url': str(server.make_url('')), 'api-key': STANDINKEY},
+            {'name': 'down', 'url': downurl, 'api-key': STANDINKEY}]))
+        async with TestClient(TestServer(gateway.makeapp())) as client:
+            message = {'item': 'valve1', 'command': 'open'}
+            partial = await client.post('/api', json=dict(message, controller='*'),
+                                        headers={'Api-Key': settings['api-key']})
+            single = await client.post('/api', json=dict(message, controller='up'),
+                                       headers={'Api-Key': settings['api-key']})
+            merged = await client.get('/api/status', headers={'Api-Key': settings['api-key']})
+            replies = (partial.status, await partial.json(), single.status, await merged.json())
+        await server.close()
+        return replies
+
+    partialstatus, partial, singlestatus, merged = asyncio.run(scenario())
+    assert partialstatus == 207
+    assert partial['results']['up'] == {'code': 201, 'result': {'item': 'valve1', 'command': 'open'}}
+    assert partial['results']['down']['code'] is None
+    assert singlestatus == 201
+    assert merged['controllers']['up']['valves'] == VALVES
+    assert not merged['controllers']['down']['ok']
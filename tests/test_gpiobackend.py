@@ -0,0 +1,56 @@
+"""Tests of the grouped GPIO writes of each backend"""
+
+import sys
+import types
+import gpiobackend
+from gpiobackend import SimulatedGPIO, LgpioGPIO, groupwrite
+
+CHANNELS = [23, 17, 13, 19]
+
+
+def listgpio(calls):
+    """Return a stand-in for RPi.GPIO, which has no group write, recording every output call in calls"""
+    return types.SimpleNamespace(output=lambda channel, level: calls.append((channel, level)))
+
+
+def test_rpi_gpio_falls_back_to_a_write_of_the_changed_pins(monkeypatch):
+    """Without a group write only the pins selected by the mask are written, in one list call"""
+    calls = []
+    monkeypatch.setattr(gpiobackend, 'GPIO', listgpio(calls))
+    groupwrite(CHANNELS, 0b0101, 0b0111)
+    assert calls == [([23, 17, 13], [1, 0, 1])]
+
+
+def test_rpi_gpio_fallback_writes_nothing_for_an_empty_mask(monkeypatch):
+    """A write that changes no pin makes no GPIO call"""
+    calls = []
+    monkeypatch.setattr(gpiobackend, 'GPIO', listgpio(calls))
+    groupwrite(CHANNELS, 0b1111, 0)
+    assert not calls
+
+
+def test_simulated_group_write_is_one_call(monkeypatch):
+    """The simulated backend changes the masked pins of its output group in a single call"""
+    simulated = SimulatedGPIO()
+    simulated.setup(CHANNELS, simulated.OUT)
+    monkeypatch.setattr(gpiobackend, 'GPIO', simulated)
+    calls = simulated.calls
+    groupwrite(CHANNELS, 0b1001, 0b1011)
+    assert simulated.calls == calls + 1
+    assert simulated.pins == {23: 1, 17: 0, 13: 0, 19: 1}
+
+
+def test_lgpio_writes_the_output_group_with_one_group_write(monkeypatch):
+    """Writes to pins of the lgpio output group, as a list or group write, are single group_write calls"""
+    calls = []
+    fake = types.SimpleNamespace(gpiochip_open=lambda chip: 7,
+                                 group_claim_output=lambda *args: calls.append(('claim',) + args),
+                                 group_write=lambda *args: calls.append(('write',) + args))
+    monkeypatch.setitem(sys.modules, 'lgpio', fake)
+    backend = LgpioGPIO()
+    backend.setup(CHANNELS, backend.OUT)
+    monkeypatch.setattr(gpiobackend, 'GPIO', backend)
+    groupwrite(CHANNELS, 0b0010, 0b0110)
+    backend.output([13, 19], [1, 1])
+    assert calls == [('claim', 7, CHANNELS, [0, 0, 0, 0]), ('write', 7, 23, 0b0010, 0b0110),
+                     ('write', 7, 23, 0b1100, 0b1100)]
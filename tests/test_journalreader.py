@@ -0,0 +1,71 @@
+"""Tests of the journal reader's cursor paging and shared queries"""
+
+from threading import Thread, Event
+import journalreader
+from journalreader import readjournal
+
+
+def fakejournal(monkeypatch, entries, release=None):
+    """
+    Replace journalctl by a stand-in over a list of entries (oldest first) that honours
+    --lines, --after-cursor and --show-cursor, using each entry's index as its cursor.
+
+    Returns:
+        list: The argument list of every journalctl run.
+    """
+    commands = []
+
+    def runjournal(command):
+        commands.append(command)
+        if release is not None:
+            release.wait(5)
+        count = int(command[command.index('--lines') + 1])
+        end = len(entries)
+        for argument in command:
+            if argument.startswith('--after-cursor='):
+                end = int(argument[len('--after-cursor=s='):].split(';')[0])
+        shown = list(range(end - 1, max(end - count, 0) - 1, -1))
+        return [entries[index] for index in shown] + ['-- cursor: s=%s;i=1' % shown[-1]] if shown else []
+
+    journalreader.cache.clear()
+    monkeypatch.setattr(journalreader, 'runjournal', runjournal)
+    return commands
+
+
+def test_older_pages_are_read_from_the_cursor(monkeypatch):
+    """Each page asks journalctl for one page of entries after the previous page's cursor"""
+    commands = fakejournal(monkeypatch, ['entry %s' % index for index in range(7)])
+    lines, older = readjournal(3)
+    assert lines == ['entry 6', 'entry 5', 'entry 4']
+    assert older == 's=4;i=1'
+    lines, older = readjournal(3, older)
+    assert lines == ['entry 3', 'entry 2', 'entry 1']
+    lines, older = readjournal(3, older)
+    assert lines == ['entry 0']
+    assert older is None
+    assert [command[command.index('--lines') + 1] for command in commands] == ['3', '3', '3']
+    assert commands[1][-1] == '--after-cursor=s=4;i=1'
+
+
+def test_bad_cursors_units_and_priorities_are_ignored(monkeypatch):
+    """Arguments that do not look like a cursor, unit or priority never reach journalctl"""
+    commands = fakejournal(monkeypatch, ['entry'])
+    readjournal(3, 's=1 --since=yesterday', 'bad unit!', 'loud')
+    assert commands == [[journalreader.JOURNALCTL, '--no-pager', '--quiet', '--reverse', '--show-cursor',
+                         '--lines', '3']]
+
+
+def test_concurrent_requests_share_one_query(monkeypatch):
+    """Requests for the same page while its query runs wait for it, and are then served from the cache"""
+    release = Event()
+    commands = fakejournal(monkeypatch, ['entry %s' % index for index in range(5)], release)
+    results = []
+    threads = [Thread(target=lambda: results.append(readjournal(2))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(commands) == 1
+    assert results == [(['entry 4', 'entry 3'], 's=3;i=1')] * 5
+    assert not journalreader.querylocks
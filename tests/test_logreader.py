@@ -0,0 +1,128 @@
+"""Tests of the reverse log reader, its paging across rotated files and the filtered search"""
+
+import os
+import logreader
+from logreader import readlog, readbackward, searchlog, LogIndex, linetime
+
+
+def writelog(path, first, last):
+    """Write numbered lines first..last to a log file, oldest first"""
+    with open(path, 'w', encoding='utf-8') as logfile:
+        for number in range(first, last + 1):
+            logfile.write('line %d\n' % number)
+
+
+def numbers(lines):
+    """Return the line numbers of 'line N' log lines"""
+    return [int(line.split()[1]) for line in lines]
+
+
+def test_lines_are_read_newest_first_across_block_boundaries(tmp_path, monkeypatch):
+    """A block size smaller than a line still returns whole lines, newest first"""
+    monkeypatch.setattr(logreader, 'BLOCKSIZE', 5)
+    path = str(tmp_path / 'test.log')
+    writelog(path, 1, 20)
+    lines, start = readbackward(path, None, 3)
+    assert lines == ['line 20', 'line 19', 'line 18']
+    assert start == os.path.getsize(path) - len('line 18\nline 19\nline 20\n')
+
+
+def test_pages_continue_into_the_rotated_backups(tmp_path):
+    """The cursor carries paging on from the live file into path.1 and stops at the oldest line"""
+    path = str(tmp_path / 'test.log')
+    writelog(path + '.1', 1, 5)
+    writelog(path, 6, 9)
+    pages = []
+    lines, cursor = readlog(path, 3)
+    pages.append(numbers(lines))
+    while cursor is not None:
+        lines, cursor = readlog(path, 3, cursor)
+        pages.append(numbers(lines))
+    assert pages == [[9, 8, 7], [6, 5, 4], [3, 2, 1]]
+
+
+def test_a_cursor_follows_its_file_through_a_rotation(tmp_path):
+    """A cursor taken before the live file is renamed to path.1 continues from the same line"""
+    path = str(tmp_path / 'test.log')
+    writelog(path, 1, 6)
+    _, cursor = readlog(path, 2)
+    os.rename(path, path + '.1')
+    writelog(path, 7, 8)
+    lines, _ = readlog(path, 2, cursor)
+    assert numbers(lines) == [4, 3]
+
+
+def test_a_cursor_for_an_unknown_file_ends_the_paging(tmp_path):
+    """A cursor whose file is no longer one of the log files, or a malformed one, returns an empty last page"""
+    path = str(tmp_path / 'test.log')
+    writelog(path, 1, 6)
+    other = str(tmp_path / 'other.log')
+    writelog(other, 1, 6)
+    assert readlog(path, 2, logreader.makecursor(other, 10)) == ([], None)
+    assert readlog(path, 2, 'not-a-cursor') == ([], None)
+
+
+def writetimedlog(path, seconds, level='INFO'):
+    """Write one python logger format line for each second in seconds, oldest first"""
+    with open(path, 'a', encoding='utf-8') as logfile:
+        for second in seconds:
+            logfile.write('2025-01-31 09:00:%02d,000, %s, message %d\n' % (second, level, second))
+
+
+def test_line_times_of_every_log_format():
+    """The python logger, gunicorn error and gunicorn access formats all give a sortable time"""
+    assert linetime('2025-01-31 09:00:05,123, INFO, started') == '2025-01-31 09:00:05'
+    assert linetime('[2025-01-31 09:00:05 +0000] [12] [INFO] Booting') == '2025-01-31 09:00:05'
+    assert linetime('127.0.0.1 - - [31/Jan/2025:09:00:05 +0000] "GET / HTTP/1.1" 200') == '2025-01-31 09:00:05'
+    assert linetime('Traceback (most recent call last):') is None
+
+
+def test_the_index_extends_as_the_file_grows(tmp_path, monkeypatch):
+    """update keeps the same index and only samples the appended bytes"""
+    monkeypatch.setattr(logreader, 'INDEXSTEP', 1)
+    path = str(tmp_path / 'test.log')
+    writetimedlog(path, range(0, 3))
+    index = LogIndex().update(path)
+    assert len(index.times) == 3
+    writetimedlog(path, range(3, 5))
+    assert index.update(path) is index
+    assert index.times[-1] == '2025-01-31 09:00:04'
+    assert len(index.times) == 5
+
+
+def test_a_rewritten_file_gets_a_new_index(tmp_path, monkeypatch):
+    """A truncated or rewritten file is indexed again from the start by a new LogIndex"""
+    monkeypatch.setattr(logreader, 'INDEXSTEP', 1)
+    path = str(tmp_path / 'test.log')
+    writetimedlog(path, range(0, 5))
+    index = LogIndex().update(path)
+    os.remove(path)
+    writetimedlog(path, range(10, 12))
+    rebuilt = index.update(path)
+    assert rebuilt is not index
+    assert rebuilt.times == ['2025-01-31 09:00:10', '2025-01-31 09:00:11']
+    assert len(index.times) == 5
+
+
+def test_search_by_time_range_level_and_text(tmp_path, monkeypatch):
+    """Only lines inside the time range with the level and text are returned, newest first"""
+    monkeypatch.setattr(logreader, 'INDEXSTEP', 1)
+    path = str(tmp_path / 'test.log')
+    writetimedlog(path, range(0, 10))
+    writetimedlog(path, range(10, 20), level='WARNING')
+    lines, cursor = searchlog(path, 100, start='2025-01-31 09:00:05', end='2025-01-31 09:00:12')
+    assert [line.split()[-1] for line in lines] == [str(second) for second in range(12, 4, -1)]
+    assert cursor is None
+    lines, _ = searchlog(path, 100, level='warning', text='MESSAGE 1', end='2025-01-31 09:00:15')
+    assert [line.split()[-1] for line in lines] == ['15', '14', '13', '12', '11', '10']
+
+
+def test_search_pages_through_the_matches(tmp_path):
+    """A full page of matches returns a cursor that carries on with the older matches"""
+    path = str(tmp_path / 'test.log')
+    writetimedlog(path, range(0, 6))
+    lines, cursor = searchlog(path, 4, level='INFO')
+    assert len(lines) == 4
+    lines, cursor = searchlog(path, 4, level='INFO', cursor=cursor)
+    assert [line.split()[-1] for line in lines] == ['1', '0']
+    assert cursor is None
@@ -0,0 +1,77 @@
+"""Tests of the metrics and their aggregation over the gunicorn workers"""
+
+import pytest
+import metrics
+from metrics import Counter, Histogram, Gauge
+
+
+@pytest.fixture(name='registry')
+def registryfixture(monkeypatch):
+    """Give each test an empty registry and no stored worker snapshots"""
+    monkeypatch.setattr(metrics, 'registry', [])
+    monkeypatch.setattr(metrics, 'workers', {})
+    return metrics.registry
+
+
+def test_counter_renders_each_label_value(registry):
+    """A counter is rendered with its help, type and one line per label value"""
+    counter = Counter('test_total', 'Test count', ('outcome',))
+    counter.inc('ok')
+    counter.inc('ok', amount=2)
+    counter.inc('refused')
+    assert registry == [counter]
+    assert counter.render() == ['# HELP test_total Test count', '# TYPE test_total counter',
+                                'test_total{outcome="ok"} 3', 'test_total{outcome="refused"} 1']
+
+
+def test_histogram_buckets_are_cumulative(registry):
+    """Each observation lands in the first bucket it fits and the rendered buckets are cumulative"""
+    histogram = Histogram('test_seconds', 'Test time', buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe(value)
+    lines = histogram.render()
+    assert lines[2:] == ['test_seconds_bucket{le="0.1"} 1', 'test_seconds_bucket{le="1.0"} 3',
+                         'test_seconds_bucket{le="+Inf"} 4', 'test_seconds_sum 4.25', 'test_seconds_count 4']
+    assert len(registry) == 1
+
+
+def test_other_workers_are_added_to_this_one(registry):
+    """The owner renders the sum of its own metrics and every snapshot collected from the other workers"""
+    counter = Counter('test_total', 'Test count', ('outcome',))
+    histogram = Histogram('test_seconds', 'Test time', buckets=(1.0,))
+    counter.inc('ok')
+    histogram.observe(0.5)
+    other = {'test_total': [[['ok'], 2], [['refused'], 1]], 'test_seconds': [[[], [0, 1], 2.0]]}
+    metrics.collect(101, other, lambda pid: True)
+    text = metrics.render()
+    assert 'test_total{outcome="ok"} 3\n' in text
+    assert 'test_total{outcome="refused"} 1\n' in text
+    assert 'test_seconds_count 2\n' in text
+    assert 'test_seconds_sum 2.5\n' in text
+    assert len(registry) == 2
+
+
+def test_exited_workers_are_retired_into_one_total(registry):
+    """Snapshots of workers that have exited are folded into key 0, so the totals never go backwards"""
+    counter = Counter('test_total', 'Test count')
+    assert registry == [counter]
+    metrics.collect(101, {'test_total': [[[], 2]]}, lambda pid: True)
+    metrics.collect(102, {'test_total': [[[], 5]]}, lambda pid: True)
+    metrics.collect(103, {'test_total': [[[], 1]]}, lambda pid: pid == 103)
+    assert sorted(metrics.workers) == [0, 103]
+    assert metrics.workers[0] == {'test_total': [[[], 7]]}
+    metrics.collect(104, {'test_total': [[[], 1]]}, lambda pid: pid == 104)
+    assert metrics.workers[0] == {'test_total': [[[], 8]]}
+    assert 'test_total 9\n' in metrics.render()
+
+
+def test_a_gauge_that_cannot_be_read_is_left_out(registry):
+    """A gauge whose function fails or returns None renders nothing"""
+    def unreadable():
+        raise OSError('no sensor')
+
+    Gauge('test_temperature', 'Test gauge', unreadable)
+    Gauge('test_missing', 'Test gauge', lambda: None)
+    Gauge('test_value', 'Test gauge', lambda: 42)
+    assert len(registry) == 3
+    assert metrics.render() == '# HELP test_value Test gauge\n# TYPE test_value gauge\ntest_value 42\n'
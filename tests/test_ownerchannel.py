@@ -0,0 +1,68 @@
+"""Tests of the owner election, the shared state block and the owner command channel"""
+
+from concurrent.futures import TimeoutError as CommandTimeout
+import pytest
+import ownerchannel
+from executor import ExecutorBusy
+from sharedstate import SharedState, OwnerLock
+
+
+def dispatch(command, *args):
+    """Stand-in for valvecontrol.dispatch, answering or failing by command name"""
+    if command == 'busy':
+        raise ExecutorBusy('hardware command queue is full')
+    if command == 'slow':
+        raise CommandTimeout()
+    if command == 'broken':
+        raise ValueError('pin write failed')
+    return [command] + list(args)
+
+
+@pytest.fixture(name='owner', scope='module')
+def ownerfixture(tmp_path_factory):
+    """Run the owner channel on a UNIX socket for the tests of this module and return its path"""
+    path = str(tmp_path_factory.mktemp('owner') / 'owner.sock')
+    server = ownerchannel.startserver(path, dispatch)
+    yield path
+    server.shutdown()
+    server.server_close()
+
+
+def test_a_forwarded_command_returns_the_owners_result(owner):
+    """The command and its arguments reach the owner and its result comes back as JSON"""
+    assert ownerchannel.forward(owner, 'valveopen', [3, 'api'], 5) == ['valveopen', 3, 'api']
+
+
+@pytest.mark.parametrize('command, error', [('busy', ExecutorBusy), ('slow', CommandTimeout),
+                                            ('broken', RuntimeError)])
+def test_owner_errors_are_raised_again_in_the_worker(owner, command, error):
+    """A full queue, a timeout or a failure in the owner raises the matching exception in the worker"""
+    with pytest.raises(error):
+        ownerchannel.forward(owner, command, [], 5)
+
+
+def test_no_owner_is_reported_as_busy(tmp_path, monkeypatch):
+    """A worker that cannot reach any owner gives up after the connect retry time with ExecutorBusy"""
+    monkeypatch.setattr(ownerchannel, 'CONNECTRETRY', 0.1)
+    with pytest.raises(ExecutorBusy):
+        ownerchannel.forward(str(tmp_path / 'missing.sock'), 'valveopen', [3], 5)
+
+
+def test_only_one_owner_is_elected(tmp_path):
+    """The owner lock is held by the first to take it until it is released"""
+    path = str(tmp_path / 'state.owner')
+    first, second = OwnerLock(path), OwnerLock(path)
+    assert first.acquire()
+    assert first.acquire()
+    assert not second.acquire()
+    assert not second.owned()
+
+
+def test_shared_values_are_seen_through_every_mapping(tmp_path):
+    """A write through one mapping of the shared state is read through another, other values are kept"""
+    path = str(tmp_path / 'state')
+    owner, worker = SharedState(path), SharedState(path)
+    owner.write(version=4, state=0b101)
+    owner.write(driftmask=2)
+    values = worker.read()
+    assert (values.version, values.state, values.driftmask) == (4, 0b101, 2)
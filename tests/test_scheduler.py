@@ -0,0 +1,50 @@
+"""Tests of the timer heap that runs timed valve actions"""
+
+from threading import Event
+from scheduler import TimerScheduler
+
+
+def test_actions_come_off_the_heap_in_due_order():
+    """Actions scheduled out of order are taken in due time order"""
+    timers = TimerScheduler(spin=0)
+    for delay, name in [(0.03, 'third'), (0.01, 'first'), (0.02, 'second')]:
+        timers.schedule(delay, print, description=name)
+    assert [timers.nextdue().description for _ in range(3)] == ['first', 'second', 'third']
+
+
+def test_a_cancelled_action_is_skipped():
+    """A cancelled action is dropped from the heap and listed as cancelled, a second cancel does nothing"""
+    timers = TimerScheduler(spin=0)
+    cancelled = timers.schedule(0, print, description='close valve 3')
+    kept = timers.schedule(0.01, print, description='close valve 4')
+    assert timers.cancel(cancelled.timerid)
+    assert not timers.cancel(cancelled.timerid)
+    assert timers.nextdue() is kept
+    assert [(entry['action'], entry['state']) for entry in timers.describe()] == [('close valve 3', 'cancelled')]
+
+
+def test_the_thread_runs_each_action_and_records_its_error():
+    """The scheduler thread runs due actions with their arguments and records how late they ran"""
+    timers = TimerScheduler(spin=0.001, name='test-timers')
+    ran = []
+    finished = Event()
+    timers.start(None)
+    timers.schedule(0.02, ran.append, 'later', description='later', hardware=False)
+    timers.schedule(0.01, ran.append, 'sooner', description='sooner', hardware=False)
+    timers.schedule(0.03, finished.set, hardware=False)
+    assert finished.wait(2)
+    assert ran == ['sooner', 'later']
+    described = [entry for entry in timers.describe() if entry['action'] in ran]
+    assert [(entry['action'], entry['state']) for entry in described] == [('later', 'done'), ('sooner', 'done')]
+    assert all(entry['error_ms'] >= 0 for entry in described)
+
+
+def test_a_failing_action_does_not_stop_the_thread():
+    """An action that raises is marked failed and the following actions still run"""
+    timers = TimerScheduler(spin=0, name='test-timers')
+    finished = Event()
+    timers.start(None)
+    failing = timers.schedule(0, lambda: 1 / 0, description='fails', hardware=False)
+    timers.schedule(0.01, finished.set, hardware=False)
+    assert finished.wait(2)
+    assert failing.state == 'failed'
@@ -0,0 +1,109 @@
+"""Tests of the stored sequence compiler and the sequence runner"""
+
+import types
+import pytest
+from valvetable import ValveTable
+from sequences import compilesequence, compilesequences, SequenceRunner, Stage
+
+VALVES = [{'id': 1, 'gpio': 23, 'description': 'Inlet', 'excluded': 2},
+          {'id': 2, 'gpio': 17, 'description': 'Pump', 'excluded': 1},
+          {'id': 3, 'gpio': 13, 'description': 'Pipette', 'excluded': 0}]
+TABLE = ValveTable(VALVES, (), [23, 17, 13])
+FILL = [{'item': 'valve2', 'command': 'close'}, {'item': 'valve1', 'command': 'open'},
+        {'wait': 500}, {'item': 'valve1', 'command': 'close'}, {'item': 'valve3', 'command': 'open'}]
+
+
+class Bench:
+    """Valve state, applystate and timers standing in for the owning process"""
+
+    def __init__(self, state=0, refuse=False):
+        self.state = state
+        self.refuse = refuse
+        self.scheduled = []
+        self.cancelled = []
+        self.timers = types.SimpleNamespace(schedule=self.schedule, cancel=self.cancelled.append)
+
+    def applystate(self, target, _source):
+        """Apply the target state unless told to refuse it"""
+        if self.refuse:
+            return False
+        self.state = target
+        return True
+
+    def schedule(self, delay, function, *args, description=''):
+        """Record a timed stage instead of running it"""
+        action = types.SimpleNamespace(timerid=len(self.scheduled) + 1, delay=delay, function=function, args=args,
+                                       description=description)
+        self.scheduled.append(action)
+        return action
+
+    def runner(self, definitions):
+        """Return a runner of the compiled definitions on this bench"""
+        return SequenceRunner(*compilesequences(definitions, TABLE), self.applystate, lambda: self.state, self.timers)
+
+
+def test_valve_steps_between_waits_become_one_stage():
+    """Consecutive valve steps merge into one open and close mask, each wait is the delay after a stage"""
+    bit = TABLE.bit
+    assert compilesequence('fill', FILL, TABLE) == [Stage(bit[1], bit[2], 0.5), Stage(bit[3], bit[1], 0.0)]
+    assert compilesequence('pause', [{'wait': 100}, {'wait': 200}], TABLE) == [Stage(0, 0, pytest.approx(0.3))]
+
+
+@pytest.mark.parametrize('steps, error', [
+    ([], 'must be a non-empty list'),
+    ([{'item': 'valve9', 'command': 'open'}], 'unknown item valve9'),
+    ([{'item': 'valve1', 'command': 'toggle'}], 'bad valve command toggle'),
+    ([{'wait': 'soon'}], 'wait must be a number'),
+    ([{'wait': -1}], 'wait must not be negative'),
+    ([{'item': 'valve1', 'command': 'open'}, {'wait': 10}, {'item': 'valve2', 'command': 'open'}],
+     'interlocked valves 1, 2 would be open together')])
+def test_bad_sequences_are_rejected_at_load(steps, error):
+    """A badly formed sequence, or one that would open interlocked valves, is rejected with its reason"""
+    compiled, errors = compilesequences({'bad': steps, 'fill': FILL}, TABLE)
+    assert list(compiled) == ['fill']
+    assert error in errors['bad']
+
+
+def test_a_run_applies_each_stage_after_its_delay():
+    """The first stage is applied at once and each following stage is scheduled after the delay"""
+    bench = Bench(state=TABLE.bit[2])
+    runner = bench.runner({'fill': FILL})
+    reply = runner.command('sequence', 'fill')
+    assert reply['run']['stage'] == 1
+    assert bench.state == TABLE.bit[1]
+    assert runner.command('sequence', 'fill') == {'error': 'a sequence is already running'}
+    timer = bench.scheduled[0]
+    assert timer.delay == 0.5
+    timer.function(*timer.args)
+    assert bench.state == TABLE.bit[3]
+    assert runner.command('run1', 'status')['run']['state'] == 'done'
+
+
+def test_an_aborted_run_cancels_its_next_stage():
+    """Aborting a running sequence cancels the scheduled stage and a late stage call does nothing"""
+    bench = Bench()
+    runner = bench.runner({'fill': FILL})
+    runner.command('sequence', 'fill')
+    assert runner.command('run1', 'abort')['run']['state'] == 'aborted'
+    assert bench.cancelled == [1]
+    timer = bench.scheduled[0]
+    timer.function(*timer.args)
+    assert bench.state == TABLE.bit[1]
+
+
+def test_a_refused_stage_fails_the_run():
+    """A stage the interlocks refuse fails the run and leaves the valves as they are"""
+    bench = Bench(refuse=True)
+    runner = bench.runner({'fill': FILL})
+    reply = runner.command('sequence', 'fill')
+    assert reply['run']['state'] == 'failed'
+    assert reply['run']['error'] == 'stage 0 would open interlocked valves'
+    assert not bench.scheduled
+
+
+def test_unknown_sequences_and_runs_are_reported():
+    """Starting a rejected or unknown sequence, or querying an unknown run, gives an error"""
+    runner = Bench().runner({'bad': []})
+    assert 'must be a non-empty list' in runner.command('sequence', 'bad')['error']
+    assert runner.command('sequence', 'missing') == {'error': 'unknown sequence missing'}
+    assert runner.command('run7', 'status') == {'error': 'unknown sequence run run7'}
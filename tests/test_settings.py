@@ -0,0 +1,25 @@
+"""Tests of the settings snapshots pinned by requests"""
+
+from threading import Thread
+import app_control
+from app_control import settings, pinsettings, releasesettings, currentsettings, publish
+
+
+def test_a_pinned_snapshot_survives_a_reload():
+    """Lookups made for a request read the snapshot it started with until it is released"""
+    original = currentsettings()
+    try:
+        pinned = pinsettings()
+        publish(dict(original, loglines=7))
+        assert settings['loglines'] == original['loglines']
+        assert currentsettings() is pinned
+        seen = []
+        thread = Thread(target=lambda: seen.append(settings['loglines']))
+        thread.start()
+        thread.join()
+        assert seen == [7]
+        releasesettings()
+        assert settings['loglines'] == 7
+    finally:
+        releasesettings()
+        app_control.snapshot = original
@@ -0,0 +1,77 @@
+"""Tests of the coalesced status reads"""
+
+import json
+from threading import Thread, Event
+from statuscache import CoalescedStatus
+
+
+class Source:
+    """A valve state that counts how often it is read and rendered"""
+
+    def __init__(self):
+        self.version = 1
+        self.state = 0b01
+        self.snapshots = 0
+        self.renders = 0
+
+    def snapshot(self):
+        """Return the current (version, state word)"""
+        self.snapshots += 1
+        return self.version, self.state
+
+    def render(self, state):
+        """Return the status of a state word"""
+        self.renders += 1
+        return [{'valve': 1, 'status': 'open' if state & 1 else 'closed'}]
+
+
+def test_reads_inside_the_window_share_one_snapshot():
+    """Every read within the window returns the same entry without reading the state again"""
+    source = Source()
+    status = CoalescedStatus(60, source.snapshot, source.render)
+    first = status.get()
+    assert status.get() is first
+    assert (source.snapshots, source.renders) == (1, 1)
+    assert json.loads(first.body) == [{'valve': 1, 'status': 'open'}]
+    assert first.etag == 'v1'
+
+
+def test_the_body_is_rendered_again_only_when_the_version_changes():
+    """A new snapshot of an unchanged version keeps the body, a new version renders a new one"""
+    source = Source()
+    status = CoalescedStatus(0, source.snapshot, source.render)
+    first = status.get()
+    again = status.get()
+    assert again.body is first.body
+    assert (source.snapshots, source.renders) == (2, 1)
+    source.version, source.state = 2, 0
+    changed = status.get(fresh=True)
+    assert changed.etag == 'v2'
+    assert json.loads(changed.body) == [{'valve': 1, 'status': 'closed'}]
+    assert source.renders == 2
+
+
+def test_concurrent_readers_wait_for_the_one_snapshot():
+    """Readers arriving while a snapshot is being taken get that snapshot instead of taking their own"""
+    source = Source()
+    started = Event()
+    release = Event()
+
+    def slowsnapshot():
+        started.set()
+        release.wait(2)
+        return source.snapshot()
+
+    status = CoalescedStatus(60, slowsnapshot, source.render)
+    entries = []
+    readers = [Thread(target=lambda: entries.append(status.get())) for _ in range(5)]
+    readers[0].start()
+    started.wait(2)
+    for reader in readers[1:]:
+        reader.start()
+    release.set()
+    for reader in readers:
+        reader.join(2)
+    assert len(entries) == 5
+    assert all(entry is entries[0] for entry in entries)
+    assert source.snapshots == 1
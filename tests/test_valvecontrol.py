@@ -0,0 +1,39 @@
+"""Tests of the batch transitions of valvecontrol on the simulated pins"""
+
+import pytest
+import valvecontrol
+
+
+def failingwrite(*_args):
+    """Stand-in for a GPIO group write on failing hardware"""
+    raise OSError('pin write failed')
+
+
+def test_a_failed_batch_is_rolled_back_and_the_error_raised(monkeypatch):
+    """The original hardware error reaches the caller after the valves are put back"""
+    original = valvecontrol.valvestate
+    monkeypatch.setattr(valvecontrol, 'applystate', failingwrite)
+    with pytest.raises(OSError, match='pin write failed'):
+        valvecontrol.runbatch([{'item': 'valve6', 'command': 'open'}])
+    assert valvecontrol.valvestate == original
+
+
+def test_a_failing_rollback_does_not_hide_the_original_error(monkeypatch, caplog):
+    """Both failures are logged and the one raised is the error of the batch itself"""
+    def batchwrite(*_args):
+        raise ValueError('batch write failed')
+
+    monkeypatch.setattr(valvecontrol, 'applystate', batchwrite)
+    monkeypatch.setattr(valvecontrol, 'gpiogroupwrite', failingwrite)
+    with pytest.raises(ValueError, match='batch write failed'):
+        valvecontrol.runbatch([{'item': 'valve6', 'command': 'open'}])
+    messages = [record.getMessage() for record in caplog.records]
+    assert any('batch failed part way through' in message for message in messages)
+    assert any('batch rollback failed' in message for message in messages)
+
+
+def test_a_refused_state_rejects_the_batch(monkeypatch):
+    """A batch whose final state applystate refuses is reported as rejected, not applied"""
+    monkeypatch.setattr(valvecontrol, 'applystate', lambda target, source: False)
+    error = valvecontrol.runbatch([{'item': 'valve6', 'command': 'open'}])
+    assert error == 'batch would open interlocked valves'
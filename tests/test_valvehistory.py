@@ -0,0 +1,67 @@
+"""Tests of the binary valve history journal and its time queries"""
+
+import os
+import pytest
+import valvehistory
+from valvehistory import RECORD, CLOSED, OPEN
+
+
+@pytest.fixture(name='journal')
+def journalfixture(tmp_path, monkeypatch):
+    """Point the history at an empty file and let each test set the record time"""
+    path = str(tmp_path / 'valvehistory.bin')
+    clock = [1000.0]
+    monkeypatch.setattr(valvehistory, 'settings', {'historypath': path})
+    monkeypatch.setattr(valvehistory, 'time', lambda: clock[0])
+    monkeypatch.setattr(valvehistory, 'statereader', None)
+    valvehistory.pending.clear()
+    return path, clock
+
+
+def test_records_are_fixed_width_and_in_write_order(journal):
+    """Each transition is one RECORD sized little endian record of time, valve, states and source"""
+    path, clock = journal
+    valvehistory.record(3, CLOSED, OPEN, 'api')
+    clock[0] = 1001.5
+    valvehistory.record(3, OPEN, CLOSED, 'timer')
+    valvehistory.flush()
+    assert os.path.getsize(path) == 2 * RECORD.size
+    with open(path, 'rb') as f:
+        records = list(RECORD.iter_unpack(f.read()))
+    assert records == [(1000.0, 3, CLOSED, OPEN, valvehistory.SOURCES.index('api')),
+                       (1001.5, 3, OPEN, CLOSED, valvehistory.SOURCES.index('timer'))]
+
+
+def test_transitions_in_a_window_skip_the_checkpoints(journal):
+    """A time window is found by binary search and the checkpoint records are not reported"""
+    _, clock = journal
+    with valvehistory.historylock:
+        valvehistory.checkpointrecords({1: CLOSED, 2: OPEN}, 'checkpoint')
+    for second, valveid in enumerate([1, 2, 1, 2, 1], start=1):
+        clock[0] = 1000.0 + second
+        valvehistory.record(valveid, CLOSED, OPEN, 'batch')
+    found = valvehistory.transitions(since=1002, until=1004)
+    assert [(item['timestamp'], item['valve']) for item in found] == [(1002.0, 2), (1003.0, 1), (1004.0, 2)]
+    assert [item['timestamp'] for item in valvehistory.transitions(valveid=1, limit=2)] == [1001.0, 1003.0]
+    assert valvehistory.transitions(since=1000)[0]['source'] == 'batch'
+
+
+def test_state_at_a_time_reads_back_to_the_last_record_of_each_valve(journal):
+    """stateat reports the newest state of each valve at or before the time, unknown if never recorded"""
+    _, clock = journal
+    with valvehistory.historylock:
+        valvehistory.checkpointrecords({1: CLOSED, 2: CLOSED}, 'startup')
+    clock[0] = 1005.0
+    valvehistory.record(1, CLOSED, OPEN, 'api')
+    clock[0] = 1010.0
+    valvehistory.record(1, OPEN, CLOSED, 'api')
+    assert valvehistory.stateat(1004, [1, 2, 3]) == {1: 'closed', 2: 'closed', 3: 'unknown'}
+    assert valvehistory.stateat(1005, [1, 2]) == {1: 'open', 2: 'closed'}
+    assert valvehistory.stateat(1010, [1]) == {1: 'closed'}
+
+
+def test_query_times_are_parsed():
+    """Both epoch seconds and local times from a datetime input are accepted"""
+    assert valvehistory.parsewhen('1000.5') == 1000.5
+    assert valvehistory.parsewhen('2025-01-31T09:00') == valvehistory.parsewhen('2025-01-31 09:00:00')
+    assert valvehistory.parsewhen('yesterday') is None
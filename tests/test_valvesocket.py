@@ -0,0 +1,78 @@
+"""Tests of the persistent socket protocol on a UNIX socket"""
+
+import socket
+from threading import Thread
+import pytest
+from app_control import settings
+from executor import HardwareExecutor
+from valvesocket import UnixValveServer, SocketHandler
+
+
+class Valves:
+    """Valve state changed by the protocol commands, numbered from the bit of each valve id"""
+
+    def __init__(self):
+        self.version = 0
+        self.mask = 0
+
+    def control(self, item, command, _duration):
+        """Open or close a valve, refusing valve 9 as interlocked"""
+        if item == 'valve9':
+            return 'interlock', self.version, self.mask
+        if item == 'closeallvalves':
+            self.mask = 0
+        elif command == 'open':
+            self.mask |= 1 << int(item[5:])
+        else:
+            self.mask &= ~(1 << int(item[5:]))
+        self.version += 1
+        return None, self.version, self.mask
+
+    def status(self):
+        """Return (None, version, mask) of the current state"""
+        return None, self.version, self.mask
+
+
+@pytest.fixture(name='connect')
+def connectfixture(tmp_path):
+    """Serve the protocol on a UNIX socket in tmp_path and return a function opening a client connection"""
+    valves = Valves()
+    executor = HardwareExecutor(16, name='test-executor')
+    executor.start()
+    server = UnixValveServer(str(tmp_path / 'valves.sock'), SocketHandler)
+    server.submit, server.control, server.status = executor.submit, valves.control, valves.status
+    Thread(target=server.serve_forever, daemon=True).start()
+    clients = []
+
+    def connect():
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(5)
+        client.connect(server.server_address)
+        clients.append(client)
+        return client, client.makefile('rb')
+
+    yield connect
+    for client in clients:
+        client.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_a_bad_key_is_refused(connect):
+    """A connection that does not authenticate first gets ERR auth and is closed"""
+    client, replies = connect()
+    client.sendall(b'AUTH wrong\n')
+    assert replies.readline() == b'ERR auth\n'
+    assert replies.readline() == b''
+
+
+def test_pipelined_commands_are_answered_in_order(connect):
+    """Replies come back one per command in the order sent, each with the state after its own command"""
+    client, replies = connect()
+    client.sendall(b'AUTH %s\n' % settings['api-key'].encode('utf-8'))
+    assert replies.readline() == b'OK 0 0\n'
+    client.sendall(b'O 1\nS\nO 3\nX 1\nO 9\nP 4 100\nC 1\nA\nQ\n')
+    lines = [replies.readline() for _ in range(8)]
+    assert lines == [b'OK 1 2\n', b'OK 1 2\n', b'OK 2 a\n', b'ERR badcommand 2 a\n', b'ERR interlock 2 a\n',
+                     b'OK 3 1a\n', b'OK 4 18\n', b'OK 5 0\n']
+    assert replies.readline() == b''
@@ -0,0 +1,116 @@
+"""Tests of the valve table interlocks and batch planning"""
+
+import pytest
+from valvetable import ValveTable, planbatch
+
+VALVES = [{'id': 1, 'gpio': 23, 'description': 'Inlet', 'excluded': 2},
+          {'id': 2, 'gpio': 17, 'description': 'Pump', 'excluded': 1},
+          {'id': 3, 'gpio': 13, 'description': 'Pipette', 'excluded': [0]},
+          {'id': 4, 'gpio': 19, 'description': 'Line', 'excluded': 0},
+          {'id': 5, 'gpio': 18, 'description': 'Spike', 'excluded': 0}]
+
+
+def maketable(groups=()):
+    """Return a table of the test valves on channels listed out of valve order"""
+    return ValveTable(VALVES, groups, [13, 23, 17, 19, 18])
+
+
+def openstate(table, *valveids):
+    """Return the state word with the given valves open"""
+    return sum(table.bit[valveid] for valveid in valveids)
+
+
+def test_exclusions_apply_both_ways():
+    """An excluded valve blocks the valve that lists it and the other way round"""
+    table = maketable()
+    assert not table.canopen(2, openstate(table, 1))
+    assert not table.canopen(1, openstate(table, 2))
+    assert table.canopen(3, openstate(table, 1, 4))
+
+
+def test_exclusion_group_refuses_a_conflicting_open():
+    """Only one valve of an exclusion group can be open"""
+    table = maketable([[3, 4, 5]])
+    state = openstate(table, 4)
+    assert not table.canopen(5, state)
+    assert not table.canopen(3, state)
+    assert table.blockers(5, state) == [4]
+    assert table.canopen(1, state)
+
+
+def test_conflicts_lists_every_open_valve_breaking_an_interlock():
+    """conflicts names every open valve that has an excluded valve open"""
+    table = maketable([[3, 4, 5]])
+    assert table.conflicts(openstate(table, 3, 5, 1)) == [3, 5]
+    assert table.conflicts(openstate(table, 3, 1)) == []
+
+
+def test_interlock_with_an_unknown_valve_is_refused():
+    """An exclusion group naming an unknown valve raises ValueError"""
+    with pytest.raises(ValueError):
+        maketable([[4, 9]])
+
+
+def test_pinbits_follow_the_channel_order():
+    """The output group bits follow the channel list, not the valve order"""
+    table = maketable()
+    assert table.pinbits(openstate(table, 1)) == 0b10
+    assert table.pinbits(openstate(table, 3, 5)) == 0b10001
+    assert table.pinmask == 0b11111
+
+
+def test_changes_and_descriptions():
+    """changes, describe and describepage report the state word valve by valve"""
+    table = maketable()
+    assert table.changes(openstate(table, 1), openstate(table, 4)) == {1: 'closed', 4: 'open'}
+    assert table.changes(None, 0) == dict.fromkeys([1, 2, 3, 4, 5], 'closed')
+    assert table.describe(openstate(table, 2))[:2] == [{'valve': 1, 'status': 'closed'},
+                                                       {'valve': 2, 'status': 'open'}]
+    assert table.describepage(0)[0] == {'id': 1, 'description': 'Inlet', 'status': 'closed'}
+
+
+def test_batch_closing_before_opening_is_accepted():
+    """Closing the blocking valve first lets a later step open its partner"""
+    table = maketable()
+    steps, error = planbatch(table, [{'item': 'valve1', 'command': 'close'},
+                                     {'item': 'valve2', 'command': 'open'}], openstate(table, 1))
+    assert error is None
+    assert steps == [('close', 1), ('open', 2)]
+
+
+def test_batch_opening_before_closing_is_refused():
+    """Opening before the blocking valve is closed refuses the whole batch"""
+    table = maketable()
+    steps, error = planbatch(table, [{'item': 'valve2', 'command': 'open'},
+                                     {'item': 'valve1', 'command': 'close'}], openstate(table, 1))
+    assert steps is None
+    assert error == 'operation 0: cannot open valve 2 as valve 1 is open'
+
+
+def test_batch_closeallvalves_clears_the_interlocks_for_later_steps():
+    """Steps after closeallvalves are checked against an all-closed state"""
+    table = maketable([[3, 4, 5]])
+    steps, error = planbatch(table, [{'item': 'closeallvalves', 'command': 'close'},
+                                     {'item': 'valve5', 'command': 'open'}], openstate(table, 4))
+    assert error is None
+    assert steps == [('closeallvalves', 0), ('open', 5)]
+
+
+@pytest.mark.parametrize('operations, message', [
+    ([], 'batch must be a non-empty list of operations'),
+    ([{'item': 'valve1'}], 'operation 0: badly formed json message'),
+    ([{'item': 'restart', 'command': 'pi'}], 'operation 0: restart is not allowed in a batch'),
+    ([{'item': 'valvex', 'command': 'open'}], 'operation 0: incorrect json message'),
+    ([{'item': 'valve9', 'command': 'open'}], 'operation 0: bad valve number 9'),
+    ([{'item': 'valve1', 'command': 'toggle'}], 'operation 0: bad valve command toggle'),
+])
+def test_batch_rejects_malformed_operations(operations, message):
+    """Malformed operations are refused with a message naming the step"""
+    assert planbatch(maketable(), operations, 0) == (None, message)
+
+
+def test_tag_follows_the_descriptions_only():
+    """The tag is the same for equal descriptions and changes when a description does"""
+    renamed = [dict(valve, description='Renamed') if valve['id'] == 4 else valve for valve in VALVES]
+    assert maketable().tag == maketable([[3, 4, 5]]).tag
+    assert ValveTable(renamed).tag != maketable().tag
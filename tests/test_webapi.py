@@ -0,0 +1,43 @@
+"""Tests of the /api message checks shared by the Flask and aiohttp applications"""
+
+import asyncio
+import pytest
+from aiohttp.test_utils import TestServer, TestClient
+from app_control import settings
+import app
+import asyncapp
+
+BADMESSAGES = [{'item': 5, 'command': 'open'}, {'item': 'valve1', 'command': ['open']}, {'item': 'valve1'},
+               ['valve1', 'open'], 'valve1']
+
+
+@pytest.mark.parametrize('message', BADMESSAGES)
+def test_flask_refuses_a_badly_formed_message(message):
+    """A message without a string item and command gets a 401, not a 500"""
+    response = app.app.test_client().post('/api', json=message, headers={'Api-Key': settings['api-key']})
+    assert response.status_code == 401
+    assert response.get_data(as_text=True) == 'badly formed json message'
+
+
+def test_aiohttp_refuses_the_same_messages():
+    """asyncapp answers each badly formed message exactly as the Flask application does"""
+    async def scenario():
+        replies = []
+        async with TestClient(TestServer(asyncapp.app)) as client:
+            for message in BADMESSAGES:
+                response = await client.post('/api', json=message, headers={'Api-Key': settings['api-key']})
+                replies.append((response.status, await response.text()))
+        return replies
+
+    assert asyncio.run(scenario()) == [(401, 'badly formed json message')] * len(BADMESSAGES)
+
+
+def test_both_applications_run_a_valid_command():
+    """A well formed command is applied and answered with the valve status"""
+    response = app.app.test_client().post('/api', json={'item': 'valve6', 'command': 'open'},
+                                          headers={'Api-Key': settings['api-key']})
+    assert response.status_code == 201
+    assert {'valve': 6, 'status': 'open'} in response.get_json()
+    response = app.app.test_client().post('/api', json={'item': 'valve6', 'command': 'close'},
+                                          headers={'Api-Key': settings['api-key']})
+    assert {'valve': 6, 'status': 'closed'} in response.get_json()
@@ -7,110 +7,203 @@ valve states, handles system commands, and provides status monitoring capabiliti
 
 Features:
 - Individual valve control (open/close) with conflict prevention
-- Batch operations (close all valves)
+- Valve table compiled from the 'valves' setting into id lookups, a bit-per-valve state word and
+  many-to-many exclusion masks, so an interlock check is a single AND, and rebuilt without a
+  restart when the settings file is reloaded (settingswatcher)
+- Batch operations (close all valves, ordered multi-valve transitions applied all-or-nothing)
+- applystate primitive that drives every valve to a target state word in one grouped GPIO write
 - System control commands (restart)
-- Status reporting for monitoring
+- Stored sequences from the 'sequences' setting, validated and compiled at load time and
+  run server-side stage by stage with progress and abort
+- Optional persistent TCP/UNIX socket protocol (valvesocket) with pipelined one-line commands
+- Timed valve commands (open for a duration, open or close after a delay) run by one
+  scheduler thread from a timer heap, cancellable and reporting their achieved timing error
+- Status reporting for monitoring, served from an in-memory copy of the valve state
+- Background reconciliation of the in-memory state against the GPIO pins
+- Watchdog that drives the ready pin only while hardware commands complete, and a health
+  summary (healthstatus) answered from the shared state
+- Change notification with a state version so clients can be pushed each transition
+- Every transition recorded in the binary valve history journal (valvehistory)
 - Logging of all valve operations and errors
+- All hardware changes run in order on a single executor thread that owns the GPIO,
+  with a bounded command queue so callers are refused quickly when it is saturated
+- Safe with several gunicorn worker processes: one elected worker owns and initialises
+  the GPIO, the others forward commands to it and read the valve state from shared memory
 
 The module initializes GPIO pins, defines valve configurations with their relationships,
 and provides functions for valve manipulation through a consistent interface.
 
 Dependencies:
-- RPi.GPIO: For hardware control of GPIO pins
-- threading.Timer: For delayed execution of commands
+- gpiobackend: For hardware control of GPIO pins (lgpio or RPi.GPIO, or simulated pins off the Pi)
+- scheduler: For timed valve commands and the delayed restart, run from one timer heap
 - logmanager: For operational logging
 """
 
-from threading import Timer
+from threading import Thread, Event, Condition
+from concurrent.futures import Future, TimeoutError as CommandTimeout
+from datetime import datetime
+from time import perf_counter, time, monotonic
 import os
-from RPi import GPIO
+import atexit
+from gpiobackend import GPIO, groupwrite
 from logmanager import logger
+from app_control import settings
+import valvehistory
+import metrics
+from metrics import gpiolatency, commands
+from executor import HardwareExecutor, ExecutorBusy
+from scheduler import TimerScheduler
+from watchdog import Watchdog
+from telemetry import sampler, Sample
+from sequences import compilesequences, SequenceRunner
+from valvetable import ValveTable, planbatch
+from sharedstate import SharedState, OwnerLock, masteridentity, processalive
+import ownerchannel
+import valvesocket
+import settingswatcher
 
 
 logger.info('Application starting')
-GPIO.setwarnings(False)
-GPIO.setmode(GPIO.BCM)
 channellist = [23, 17, 13, 19, 18, 27, 9, 24, 22, 11, 21, 26, 20, 12]
-GPIO.setup(channellist, GPIO.OUT)
-GPIO.output(channellist, 0)
-
-valves = [
-    {
-        'id': 1,
-        'gpio': channellist[0],
-        'description': '4He pipette input',
-        'excluded': 2
-    },
-    {
-        'id': 2,
-        'gpio': channellist[1],
-        'description': '4He pipette output',
-        'excluded': 1
-    },
-    {
-        'id': 3,
-        'gpio': channellist[2],
-        'description': '3He pipette output',
-        'excluded': 4
-    },
-    {
-        'id': 4,
-        'gpio': channellist[3],
-        'description': '3He pipette input',
-        'excluded': 3
-    },
-    {
-        'id': 5,
-        'gpio': channellist[4],
-        'description': 'port 1',
-        'excluded': 10
-    },
-    {
-        'id': 6,
-        'gpio': channellist[5],
-        'description': 'ion pump',
-        'excluded': 0
-    },
-    {
-        'id': 7,
-        'gpio': channellist[6],
-        'description': 'gas analyser',
-        'excluded': 0
-    },
-    {
-        'id': 8,
-        'gpio': channellist[7],
-        'description': 'gallery A',
-        'excluded': 0
-    },
-    {
-        'id': 10,
-        'gpio': channellist[8],
-        'description': 'laser cell',
-        'excluded': 5
-    },
-    {
-        'id': 11,
-        'gpio': channellist[9],
-        'description': 'getter',
-        'excluded': 0
-    },
-    {
-        'id': 12,
-        'gpio': channellist[10],
-        'description': 'buffer tank',
-        'excluded': 0
-    },
-    {
-        'id': 13,
-        'gpio': channellist[11],
-        'description': 'turbo pump',
-        'excluded': 0
-    }
-]
-
-
-def parsecontrol(item, command):
+
+"""
+The output pins of the valve board in the order they make up the GPIO output group, the valves are
+defined by the 'valves' setting (id, gpio pin from this list, description and 'excluded' valve
+ids) and the 'exclusiongroups' setting, many-to-many interlock groups each holding the ids of
+valves of which at most one may be open at a time, e.g. [[5, 10, 13]].
+"""
+
+
+valvetable = ValveTable(settings['valves'], settings['exclusiongroups'], channellist)
+valvestate = 0
+"""
+Bit-per-valve word of the valves that are open, bit positions are given by valvetable.bit. Only
+kept up to date in the owning process, other workers read the shared copy through statesnapshot.
+"""
+stateversion = 0
+"""Incremented every time valvestate changes"""
+statechanged = Condition()
+"""Notified every time valvestate changes, used by waitforchange"""
+shared = SharedState(settings['sharedstatepath'])
+"""Valve state, version and reconciliation result shared with the other worker processes"""
+ownerlock = OwnerLock(settings['sharedstatepath'] + '.owner')
+"""Held by the worker process that owns the GPIO"""
+SHAREDPOLL = 0.25
+"""Seconds between checks of the shared state version by waitforchange in non-owning workers"""
+READYPIN = 12
+"""Output pin held high (or pulsed by the watchdog) while the controller is ready"""
+lasthardware = 0.0
+"""time() of the last valve write or input read that succeeded, in the owning process"""
+
+
+def gpiogroupwrite(bits, mask):
+    """Write the valve output group in one grouped write, timing the call for the metrics endpoint"""
+    global lasthardware
+    start = perf_counter()
+    groupwrite(channellist, bits, mask)
+    gpiolatency.observe(perf_counter() - start, 'group')
+    lasthardware = time()
+
+
+def gpioinput(channel):
+    """Read a GPIO pin, timing the call for the metrics endpoint"""
+    global lasthardware
+    start = perf_counter()
+    level = GPIO.input(channel)
+    gpiolatency.observe(perf_counter() - start, 'input')
+    lasthardware = time()
+    return level
+
+
+def setready(level):
+    """Write the ready pin, not a hardware call for lasthardware as the watchdog probes write it all the time"""
+    GPIO.output(READYPIN, level)
+
+
+def publishheartbeat(heartbeat):
+    """Record the watchdog heartbeat and the time of the last successful hardware call in the shared state"""
+    shared.write(heartbeat=heartbeat, hardwareok=lasthardware)
+
+
+hwexecutor = HardwareExecutor(settings['commandqueuesize'])
+"""The single thread that runs every change to the valve outputs, so interlock checks and writes never interleave"""
+timers = TimerScheduler(settings['timerspin'])
+"""The single thread that runs every timed action, started in the owning process"""
+sequencerunner = SequenceRunner(*compilesequences(settings['sequences'], valvetable),
+                                lambda target, source: applystate(target, source), lambda: valvestate, timers)
+"""The stored sequences and their runs, run in the owning process"""
+watchdog = Watchdog(settings['watchdoginterval'], settings['watchdogtimeout'], settings['readypinmode'] == 'toggle')
+"""Probes the executor and drives the ready pin, started in the owning process"""
+
+
+def dispatch(command, *args):
+    """
+    Runs a hardware command in the process that owns the GPIO.
+
+    In the owning process the command is run on the hardware executor (OWNERCOMMANDS, which do
+    not touch the GPIO, are run directly on the calling thread), in any other worker it is
+    forwarded to the owner over the owner channel. If the owner cannot be reached this process
+    tries to take over ownership and then runs the command itself.
+
+    Parameters:
+        command (str): A key of HARDWARECOMMANDS or OWNERCOMMANDS.
+        *args: The arguments for the command, must be JSON serialisable.
+
+    Returns:
+        The result of the command.
+
+    Raises:
+        ExecutorBusy: If the hardware command queue is full or no owner is available.
+        concurrent.futures.TimeoutError: If the command did not complete in time.
+    """
+    if not ownerlock.owned():
+        try:
+            return ownerchannel.forward(settings['ownersocket'], command, args,
+                                        settings['commandtimeout'] + ownerchannel.FORWARDMARGIN)
+        except ExecutorBusy:
+            if not electowner():
+                raise
+    if command in OWNERCOMMANDS:
+        return OWNERCOMMANDS[command](*args)
+    return hwexecutor.call(HARDWARECOMMANDS[command], *args, timeout=settings['commandtimeout'])
+
+
+def parsecontrol(item, command, source='api'):
+    """
+    Runs a control instruction on the hardware executor of the owning process and waits for it
+    to complete.
+
+    The wait is limited by the 'commandtimeout' setting (seconds). See runcontrol for the
+    items and commands.
+
+    Parameters:
+        item (str): The control item, e.g. 'valve1', 'closeallvalves', 'restart'.
+        command (str): The command for the item, e.g. 'open', 'close', 'pi'.
+        source (str): What sent the command, recorded in the valve history.
+
+    Raises:
+        ExecutorBusy: If the hardware command queue is full.
+        concurrent.futures.TimeoutError: If the command did not complete in time.
+    """
+    dispatch('control', item, command, source)
+
+
+def submitcontrol(item, command, source='api'):
+    """
+    Queue a control instruction on the hardware executor and return its Future, in a worker
+    that does not own the GPIO the instruction is forwarded and the Future is already complete.
+    """
+    if ownerlock.owned():
+        return hwexecutor.submit(runcontrol, item, command, source)
+    future = Future()
+    try:
+        future.set_result(parsecontrol(item, command, source))
+    except Exception as error:   # handed to the caller through the Future
+        future.set_exception(error)
+    return future
+
+
+def runcontrol(item, command, source='api'):
     """
     Parses and executes control instructions for items such as valves or system commands.
 
@@ -121,9 +214,12 @@ def parsecontrol(item, command):
 
     Parameters:
     item : str
-        Specifies the name of the control item (e.g., 'valve1', 'closeallvalves', 'restart').
+        Specifies the name of the control item (e.g., 'valve1', 'closeallvalves', 'restart',
+        'timer7').
     command : str
-        Provides the command to execute for the given item (e.g., 'open', 'close', 'pi').
+        Provides the command to execute for the given item (e.g., 'open', 'close', 'pi', 'cancel').
+    source : str
+        What sent the command, recorded in the valve history (see valvehistory.SOURCES).
 
     Raises:
     ValueError
@@ -135,145 +231,501 @@ def parsecontrol(item, command):
     try:
         if item[:5] == 'valve':
             valve = int(item[5:])
-            if 0 < valve < 14:
+            if valve in valvetable.bit:
                 if command == 'open':
-                    valveopen(valve)
+                    opened = valveopen(valve, source)
+                    commands.inc('opened' if opened else 'rejected_interlock')
                 elif command == 'close':
-                    valveclose(valve)
+                    valveclose(valve, source)
+                    commands.inc('closed')
                 else:
                     logger.warning('bad valve command')
+                    commands.inc('bad_command')
             else:
                 logger.warning('bad valve number')
+                commands.inc('bad_valve')
         elif item == 'closeallvalves':
-            allclose()
+            allclose(source)
+            commands.inc('closed_all')
+        elif item[:5] == 'timer':
+            if command == 'cancel':
+                if timers.cancel(int(item[5:])):
+                    commands.inc('timer_cancelled')
+            else:
+                logger.warning('bad timer command')
+                commands.inc('bad_command')
         elif item == 'restart':
             if command == 'pi':
                 logger.warning('Restart command received: system will restart in 15 seconds')
-                timerthread = Timer(15, reboot)
-                timerthread.start()
+                commands.inc('restart')
+                timers.schedule(15, reboot, description='restart', hardware=False)
     except ValueError:
         logger.warning('incorrect json message')
+        commands.inc('bad_json')
     except IndexError:
         logger.warning('bad valve number')
+        commands.inc('bad_valve')
+
+
+def parsetimed(item, command, delay=0, duration=0, source='api'):
+    """
+    Schedules a timed valve command on the hardware executor of the owning process, see runtimed.
+
+    Raises:
+        ExecutorBusy: If the hardware command queue is full.
+        concurrent.futures.TimeoutError: If the command did not complete in time.
+    """
+    return dispatch('timed', item, command, delay, duration, source)
+
+
+def runtimed(item, command, delay=0, duration=0, source='api'):
+    """
+    Runs or schedules a timed valve command on the timer scheduler.
+
+    'open' with a duration opens the valve and closes it again duration milliseconds later; with
+    a delay the open (or 'close') happens delay milliseconds from now instead. An immediate open
+    is applied before this returns and its close is timed from the moment the valve opened, so
+    the opening time does not depend on the network round trip of the request.
+
+    Parameters:
+        item (str): The valve, 'valveN'.
+        command (str): 'open' or 'close'.
+        delay (float): Milliseconds before the command runs, 0 to run it now.
+        duration (float): Milliseconds to keep the valve open, 'open' only, 0 to leave it open.
+        source (str): What sent the command, recorded in the valve history for an immediate open.
+
+    Returns:
+        dict: {'timers': [...]} describing each scheduled action (its id is used to cancel it
+        with {'item': 'timerN', 'command': 'cancel'}), or {'error': message} if it was rejected.
+    """
+    try:
+        valveid = int(item[5:]) if item[:5] == 'valve' else None
+        delay = float(delay) / 1000
+        duration = float(duration) / 1000
+    except (TypeError, ValueError):
+        return {'error': 'incorrect json message'}
+    if valveid not in valvetable.bit:
+        return {'error': 'bad valve number'}
+    if command not in ('open', 'close'):
+        return {'error': 'bad valve command %s' % command}
+    if delay < 0 or duration < 0 or (duration and command != 'open'):
+        return {'error': 'delay and duration must be positive and duration only applies to open'}
+    scheduled = []
+    if command == 'open' and delay == 0:
+        if not valveopen(valveid, source):
+            commands.inc('rejected_interlock')
+            return {'error': 'cannot open valve %s as valve %s is open' % (
+                valveid, ', '.join(str(other) for other in valvetable.blockers(valveid, valvestate)))}
+        commands.inc('opened')
+    else:
+        scheduled.append(timers.schedule(delay, runcontrol, item, command, 'timer',
+                                         description='%s valve %s' % (command, valveid)))
+    if duration:
+        scheduled.append(timers.schedule(delay + duration, runcontrol, item, 'close', 'timer',
+                                         description='close valve %s' % valveid))
+    for action in scheduled:
+        logger.info('Timer %s scheduled: %s in %.3fs', action.timerid, action.description, action.due - monotonic())
+    return {'timers': [action.describe() for action in scheduled]}
+
+
+def socketcontrol(item, command, duration=0):
+    """
+    Runs one socket protocol command (see valvesocket) on the executor thread.
+
+    Parameters:
+        item (str): 'valveN' or 'closeallvalves'.
+        command (str): 'open' or 'close' for a valve.
+        duration (int): Milliseconds to keep the valve open, 0 for a plain open.
+
+    Returns:
+        tuple: (error, version, mask) where error is None or the reason the command did not run
+        and mask has bit N set for each open valve N.
+    """
+    error = None
+    if item[:5] == 'valve' and int(item[5:]) not in valvetable.bit:
+        error = 'badvalve'
+    elif duration:
+        result = runtimed(item, command, 0, duration, 'socket')
+        if 'error' in result:
+            error = 'interlock' if result['error'].startswith('cannot open') else 'badcommand'
+    else:
+        runcontrol(item, command, 'socket')
+        if command == 'open' and not valvetable.isopen(int(item[5:]), valvestate):
+            error = 'interlock'
+    return error, stateversion, valvetable.idbits(valvestate)
+
+
+def socketstatus():
+    """Return (None, version, mask) of the current state for the socket protocol"""
+    version, state = statesnapshot()
+    return None, version, valvetable.idbits(state)
+
+
+def listtimers():
+    """Return the pending and recently finished timed actions of the owning process"""
+    return dispatch('timers')
 
 
-def valveopen(valveid):
+def parsesequence(item, command):
+    """
+    Starts, queries or aborts a stored sequence run in the owning process, see SequenceRunner.command.
+
+    Raises:
+        ExecutorBusy: If the hardware command queue is full.
+        concurrent.futures.TimeoutError: If the command did not complete in time.
+    """
+    return dispatch('sequence', item, command)
+
+
+def listsequences():
+    """Return the stored sequences and recent runs from the owning process, see SequenceRunner.describe"""
+    return dispatch('sequences')
+
+
+def parsebatch(operations, source='batch'):
+    """
+    Validates and applies an ordered list of valve operations as a single unit on the hardware
+    executor of the owning process, waiting up to the 'commandtimeout' setting for it to complete.
+
+    Parameters:
+        operations (list[dict]): Ordered list of {'item': ..., 'command': ...} operations, where
+            item is 'valveN' or 'closeallvalves' and command is 'open' or 'close'.
+        source (str): What sent the batch, recorded in the valve history.
+
+    Returns:
+        str: None if the batch was applied, otherwise a message explaining why it was rejected.
+
+    Raises:
+        ExecutorBusy: If the hardware command queue is full.
+        concurrent.futures.TimeoutError: If the batch did not complete in time.
+    """
+    return dispatch('batch', operations, source)
+
+
+def runbatch(operations, source='batch'):
+    """
+    Validates and applies an ordered list of valve operations as a single unit.
+
+    The whole list is checked against the valve interlocks before any output is
+    changed. If every step is allowed the state left by the last step is applied with
+    applystate, one grouped write on the executor thread, so every valve in the batch switches
+    together and no other command can interleave. If the hardware write fails the error is
+    logged and every valve is returned to the level it had before the batch started; a failing
+    rollback is logged as well, and the original error is the one raised.
+
+    Parameters:
+        operations (list[dict]): Ordered list of {'item': ..., 'command': ...} operations, where
+            item is 'valveN' or 'closeallvalves' and command is 'open' or 'close'.
+        source (str): What sent the batch, recorded in the valve history.
+
+    Returns:
+        str: None if the batch was applied, otherwise a message explaining why it was rejected.
+    """
+    original = valvestate
+    steps, error = planbatch(valvetable, operations, original)
+    if error:
+        logger.warning('batch rejected, %s', error)
+        commands.inc('batch_rejected')
+        return error
+    target = original
+    for command, valveid in steps:
+        if command == 'open':
+            target |= valvetable.bit[valveid]
+        elif command == 'close':
+            target &= ~valvetable.bit[valveid]
+        else:
+            target = 0
+    try:
+        applied = applystate(target, source)
+    except Exception:
+        logger.exception('batch failed part way through, restoring the valves to their previous state')
+        try:
+            gpiogroupwrite(valvetable.pinbits(original), valvetable.pinmask)
+        except Exception:   # keep the original error as the one raised
+            logger.exception('batch rollback failed, the valve outputs may not match the recorded state')
+        else:
+            setstate(original, 'rollback')
+        raise
+    if not applied:
+        commands.inc('batch_rejected')
+        return 'batch would open interlocked valves'
+    logger.info('Batch of %s operations applied', len(steps))
+    commands.inc('batch_applied')
+    return None
+
+
+def valveopen(valveid, source='api'):
     """
     Opens a valve based on its unique identifier if no conflicting valve is open.
 
     Attempts to open the valve identified by the provided valve ID. Before opening,
-    it checks whether the valve marked as excluded for the specified valve is already open.
-    If the excluded valve is open, the operation is aborted, logging a warning.
+    the valve's exclusion mask is checked against the valve state word. If any
+    excluded valve is open, the operation is aborted, logging a warning.
     If no conflict is found, the specified valve is opened, and this action is logged.
 
     Parameters:
         valveid (int): The unique identifier of the valve to be opened.
+        source (str): What sent the command, recorded in the valve history.
+
+    Returns:
+        bool: True if the valve was opened, False if the interlock prevented it.
     """
-    valve = [valve for valve in valves if valve['id'] == valveid]
-    if valve[0]['excluded'] != 0:
-        if GPIO.input([valvex for valvex in valves if valvex['id'] == valve[0]['excluded']][0]['gpio']) == 1:
-            logger.warning('cannot open valve as the excluded one is also open valve %s', valveid)
-            return
-    GPIO.output(valve[0]['gpio'], 1)
+    if not valvetable.canopen(valveid, valvestate):
+        logger.warning('cannot open valve as the excluded one is also open valve %s', valveid)
+        return False
+    applystate(valvestate | valvetable.bit[valveid], source)
     logger.info('Valve %s opened', valveid)
+    return True
 
 
-def valveclose(valveid):
+def valveclose(valveid, source='api'):
     """
     Closes the specified valve based on its ID.
 
-    The function identifies the valve with the given ID in the list of valves,
-    ensures that the valve's GPIO pin is set to a low state, and logs the
+    The function looks up the valve's GPIO pin in the valve table, sets the pin
+    to a low state, clears the valve's bit in the state word and logs the
     operation. This action effectively closes the valve. The provided valve
-    ID should match an existing valve's ID within the list.
+    ID should match an existing valve's ID within the table.
 
     Parameters:
         valveid (int): The ID of the valve to be closed.
+        source (str): What sent the command, recorded in the valve history.
     """
-    valve = [valve for valve in valves if valve['id'] == valveid]
-    GPIO.output(valve[0]['gpio'], 0)
+    applystate(valvestate & ~valvetable.bit[valveid], source)
     logger.info('Valve %s closed', valveid)
 
 
-def allclose():
+def allclose(source='api'):
     """
     Close all valves by setting the output of the specified channels to 0.
 
     Summary:
-    This function outputs a signal of 0 to all channels specified in the
-    'channellist', effectively closing all valves. It also logs an info
-    message indicating the operation.
+    This function outputs a signal of 0 to every valve channel in one grouped
+    write, effectively closing all valves, and clears the valve state word. It
+    also logs an info message indicating the operation.
 
     Parameters:
-    channellist : list
-        A list of GPIO channel numbers on which the output will be set to 0.
+    source : str
+        What sent the command, recorded in the valve history.
 
     Returns:
     None
     """
-    GPIO.output(channellist, 0)
+    gpiogroupwrite(0, valvetable.pinmask)
+    setstate(0, source)
     logger.info('All Valves Closed')
 
-def status(value):
+
+def applystate(target, source='api'):
+    """
+    Drives the valve outputs to a target state word in one hardware operation.
+
+    Every valve whose level differs between the current and target state is changed by a
+    single grouped GPIO write, so opening three valves and closing two switches all five
+    together. The target is checked against the interlocks first. Must be called on the
+    executor thread.
+
+    Parameters:
+        target (int): The bit-per-valve state word to apply.
+        source (str): What sent the command, recorded in the valve history.
+
+    Returns:
+        bool: True if the state was applied, False if it would open mutually excluded valves.
+    """
+    conflicts = valvetable.conflicts(target)
+    if conflicts:
+        logger.warning('cannot apply valve state %s, interlocked valves %s would be open', bin(target), conflicts)
+        return False
+    changed = (target ^ valvestate) & valvetable.allmask
+    if changed:
+        gpiogroupwrite(valvetable.pinbits(target), valvetable.pinbits(changed))
+    setstate(target & valvetable.allmask, source)
+    return True
+
+
+def setstate(state, source):
+    """
+    Records a new valve state word after the outputs have been written.
+
+    If the state differs from the current one each changed valve is recorded in the valve
+    history, the state version is incremented, the new state is published to the other worker
+    processes and every thread waiting in waitforchange is woken. Must be called on the
+    executor thread.
+
+    Parameters:
+        state (int): The new bit-per-valve state word.
+        source (str): What caused the change, recorded in the valve history.
+    """
+    global valvestate, stateversion
+    if state == valvestate:
+        return
+    changed = state ^ valvestate
+    for valveid in valvetable.ids:
+        bit = valvetable.bit[valveid]
+        if changed & bit:
+            valvehistory.record(valveid, int(valvestate & bit != 0), int(state & bit != 0), source)
+    with statechanged:
+        valvestate = state
+        stateversion += 1
+        shared.write(version=stateversion, state=state)
+        statechanged.notify_all()
+
+
+def currentstates():
+    """Return {valve id: 1 if open else 0} for every valve, used for the history checkpoints"""
+    state = valvestate
+    return {valveid: int(state & valvetable.bit[valveid] != 0) for valveid in valvetable.ids}
+
+
+def statesnapshot():
+    """Return the current (version, state word) pair as a consistent snapshot"""
+    if ownerlock.owned():
+        with statechanged:
+            return stateversion, valvestate
+    values = shared.read()
+    return values.version, values.state
+
+
+def waitforchange(version, timeout):
     """
-    Determines the status based on a given value.
+    Blocks until the state version differs from the one given or the timeout expires.
 
-    This function evaluates the provided integer value and returns a corresponding
-    status string. Specifically, it checks whether the value equals zero to
-    determine if the status is 'closed'. Any other value results in a status
-    of 'open'.
+    In the owning process the wait is woken by setstate, other workers check the shared
+    state every SHAREDPOLL seconds.
 
     Parameters:
-    value (int): The value to evaluate for determining the status.
+        version (int): The state version the caller last saw.
+        timeout (float): Maximum time to wait in seconds.
 
     Returns:
-    str: A string representing the status. Returns 'closed' if the value is
-    0; otherwise, returns 'open'.
+        tuple: The (version, state word) snapshot, the version is unchanged if the wait timed out.
     """
-    if value == 0:
-        return 'closed'
-    return 'open'
+    deadline = perf_counter() + timeout
+    while True:
+        current = statesnapshot()
+        remaining = deadline - perf_counter()
+        if current[0] != version or remaining <= 0:
+            return current
+        with statechanged:
+            if ownerlock.owned():
+                statechanged.wait_for(lambda: stateversion != version, remaining)
+            else:
+                statechanged.wait(min(remaining, SHAREDPOLL))
+
 
+def statechanges(oldstate, newstate):
+    """Return {valve id: 'open' or 'closed'} of the valves that differ between two state words, see ValveTable.changes"""
+    return valvetable.changes(oldstate, newstate)
 
 
-def valvestatus():
+def valvestatus(state=None):
+    """
+    Returns [{valve, status}] of every valve from the in-memory valve state word (the current
+    state by default), see ValveTable.describe. The state word is updated on every write so no
+    GPIO pins are read.
     """
-    Determines the status of valves based on their GPIO input.
+    if state is None:
+        state = statesnapshot()[1]
+    return valvetable.describe(state)
 
-    This function iterates through a list of valves, checks each valve's GPIO
-    input status, and compiles a list of dictionaries containing the valve ID
-    and its respective status.
+
+def httpstatus(state=None):
+    """Returns [{id, description, status}] of every valve for the status page, see valvestatus"""
+    if state is None:
+        state = statesnapshot()[1]
+    return valvetable.describepage(state)
+
+
+def hardwarestate():
+    """
+    Reads every valve GPIO pin and builds the equivalent valve state word.
 
     Returns:
-        list[dict]: A list where each dictionary contains the ID of a valve and
-        its corresponding status, based on GPIO input.
+        int: Bit-per-valve word of the valves whose pins are currently high.
     """
-    statuslist = []
-    for valve in valves:
-        if valve['id'] > 0:
-            statuslist.append({'valve': valve['id'], 'status': status(GPIO.input(valve['gpio']))})
-    return statuslist
+    state = 0
+    for valveid in valvetable.ids:
+        if gpioinput(valvetable.gpio[valveid]) == 1:
+            state |= valvetable.bit[valveid]
+    return state
 
 
-def httpstatus():
+def reconcile():
     """
-    Determine and return the status of a list of valves based on their GPIO input.
+    Compares the in-memory valve state with the GPIO pins and records any drift.
 
-    This function iterates through a list of valve objects, checks each valve's GPIO
-    input to determine its status and then constructs a list of dictionaries containing
-    the valve's ID, description, and current status.
+    The pins are read on the executor thread so that a write in progress is never
+    reported as drift. Any valve whose pin differs from the in-memory state is logged as a
+    warning and published in the shared state for driftstatus, the in-memory state is not
+    changed. Only runs in the owning process.
 
     Returns:
-        list[dict]: A list of dictionaries each containing the valve's `id` (int),
-        `description` (str), and its current `status` (bool or other relevant type
-        returned by the `status` function).
+        list[int]: The ids of the valves whose pin level differs from the in-memory state.
     """
-    statuslist = []
-    for valve in valves:
-        if valve['id'] > 0:
-            statuslist.append({'id': valve['id'], 'description': valve['description'],
-                               'status': status(GPIO.input(valve['gpio']))})
-    return statuslist
+    shadow, hardware = hwexecutor.call(lambda: (valvestate, hardwarestate()), timeout=settings['commandtimeout'])
+    difference = shadow ^ hardware
+    drifted = [valveid for valveid in valvetable.ids if difference & valvetable.bit[valveid]]
+    if drifted:
+        logger.warning('Valve state drift detected on valves %s, memory %s hardware %s',
+                       drifted, bin(shadow), bin(hardware))
+    shared.write(driftmask=difference, driftchecked=time())
+    return drifted
+
+
+def statustag():
+    """
+    Return (state version, state word, drift mask) read together from the shared state, and the
+    tag of the valve table in force (see ValveTable.tag); the status page only changes when one
+    of them changes.
+    """
+    values = shared.read()
+    return values.version, values.state, values.driftmask, valvetable.tag
+
+
+def driftstatus():
+    """Return the time and drifted valve ids of the last reconciliation, from the shared state"""
+    values = shared.read()
+    checked = None
+    if values.driftchecked:
+        checked = datetime.fromtimestamp(values.driftchecked).strftime('%d/%m/%Y %H:%M:%S')
+    return {'checked': checked,
+            'valves': [valveid for valveid in valvetable.ids if values.driftmask & valvetable.bit[valveid]]}
+
+
+def healthstatus():
+    """
+    Returns the health of the controller from the shared state, without touching the GPIO.
+
+    The controller is ready when a process owns the GPIO, that process is running, and the
+    watchdog heartbeat (the last probe to complete on the hardware executor) is newer than the
+    'watchdogtimeout' setting.
+
+    Returns:
+        dict: ready, the owner pid and whether it is alive, this worker's pid and whether it is
+        the owner, the ages in seconds of the heartbeat and of the last successful hardware call
+        (None if there has not been one), the state version and whether any valve has drifted.
+    """
+    values = shared.read()
+    now = time()
+    owneralive = values.ownerpid != 0 and processalive(values.ownerpid)
+    heartbeatage = round(now - values.heartbeat, 3) if values.heartbeat else None
+    return {'ready': owneralive and heartbeatage is not None and heartbeatage <= settings['watchdogtimeout'],
+            'owner': values.ownerpid, 'owneralive': owneralive, 'worker': os.getpid(),
+            'isowner': ownerlock.owned(), 'heartbeatage': heartbeatage,
+            'hardwareage': round(now - values.hardwareok, 3) if values.hardwareok else None,
+            'version': values.version, 'drift': values.driftmask != 0}
+
+
+def reconcileloop(stopevent):
+    """
+    Thread loop that reconciles the in-memory valve state with the hardware at the interval
+    set by the 'reconcileinterval' setting (seconds) until stopevent is set.
+    """
+    while not stopevent.wait(settings['reconcileinterval']):
+        try:
+            reconcile()
+        except Exception:   # keep the thread alive whatever the hardware does
+            logger.exception('Valve state reconciliation failed')
 
 
 def reboot():
@@ -293,5 +745,249 @@ def reboot():
     os.system('sudo reboot')
 
 
-GPIO.output(12, 1)   # set ready
+HARDWARECOMMANDS = {'control': runcontrol, 'batch': runbatch, 'timed': runtimed, 'timers': timers.describe,
+                    'sequence': sequencerunner.command, 'sequences': sequencerunner.describe}
+"""Commands that dispatch runs in the owning process, by name so they can be forwarded"""
+
+
+def collectmetrics(pid, values, render=False):
+    """
+    Owner command, stores the metrics snapshot of another worker.
+
+    Returns:
+        str: The metrics of every worker in the Prometheus text format if render is True, else None.
+    """
+    if pid != os.getpid():
+        metrics.collect(pid, values, processalive)
+    return metrics.render() if render else None
+
+
+def metricstext():
+    """
+    Returns the metrics of every worker in the Prometheus text format, rendered by the owner with
+    this worker's latest counts. Falls back to this worker's own metrics if the owner cannot be reached.
+    """
+    try:
+        return dispatch('metrics', os.getpid(), metrics.snapshot(), True)
+    except (ExecutorBusy, CommandTimeout, RuntimeError):
+        logger.warning('Metrics: the GPIO owner did not answer, serving the metrics of worker %s only', os.getpid())
+        return metrics.render([])
+
+
+def pushmetrics():
+    """Sends this worker's metrics snapshot to the owner, called periodically by non-owning workers"""
+    try:
+        ownerchannel.forward(settings['ownersocket'], 'metrics', [os.getpid(), metrics.snapshot()],
+                             settings['commandtimeout'])
+    except (ExecutorBusy, CommandTimeout, RuntimeError):
+        pass
+
+
+def latestsample():
+    """
+    Returns the latest telemetry Sample, None until there is one. The sampler runs in the owning
+    process only, the other workers use the copy refreshtelemetry fetches from it every few
+    seconds, so reading it never waits on the owner.
+    """
+    return sampler.latest if ownerlock.owned() else remotesample
+
+
+def refreshtelemetry():
+    """Fetches the owner's latest telemetry sample, called periodically by non-owning workers"""
+    global remotesample
+    try:
+        values = ownerchannel.forward(settings['ownersocket'], 'telemetrylatest', [], settings['commandtimeout'])
+    except (ExecutorBusy, CommandTimeout, RuntimeError):
+        return
+    remotesample = None if values is None else Sample(*values)
+
+
+def telemetryhistory(buckets=60, since=None):
+    """Returns the telemetry history sampled by the owning process, see TelemetrySampler.history"""
+    return dispatch('telemetry', buckets, since)
+
+
+remotesample = None
+"""The owner's latest telemetry sample as last fetched by a non-owning worker"""
+OWNERCOMMANDS = {'metrics': collectmetrics, 'telemetry': sampler.history, 'telemetrylatest': lambda: sampler.latest}
+"""Commands that dispatch runs in the owning process without the hardware executor"""
+
+
+def checkvalvemap(new):
+    """
+    Settings check, refuses a reloaded valve map or stored sequences that cannot be applied while
+    running.
+
+    Descriptions and interlocks may change on the fly, but adding, removing or re-pinning a
+    valve changes the GPIO layout and needs a restart. An interlock that the valves open right
+    now would already break is refused as well, rather than closing anything, and so are
+    sequences that cannot be compiled at all (a sequence that only fails its own checks is
+    rejected on its own, as at start up). The table and sequences built here are the ones
+    applysettings puts in place once the settings are published. The new map is compared with
+    the one in force (activemap) rather than the published settings, so a map that was published
+    but could not be put in place is tried again on the next reload.
+
+    Parameters:
+        new (Mapping): The reloaded settings snapshot.
+
+    Returns:
+        str: Why the new settings are refused, None if their valve map can be applied.
+    """
+    global preparedmap
+    preparedmap = None
+    if mapsettings(new) == activemap:
+        return None
+    try:
+        table = ValveTable(new['valves'], new['exclusiongroups'], channellist)
+    except (KeyError, TypeError, ValueError) as error:
+        return 'invalid valve map: %s' % error
+    if table.ids != valvetable.ids or table.gpio != valvetable.gpio:
+        return 'valves added, removed or moved to other pins, restart the controller to apply the new valve map'
+    conflicts = table.conflicts(statesnapshot()[1])
+    if conflicts:
+        return 'open valves %s would break the new interlocks' % ', '.join(str(valveid) for valveid in conflicts)
+    try:
+        compiled, errors = compilesequences(new['sequences'], table)
+    except (AttributeError, KeyError, TypeError, ValueError) as error:
+        return 'invalid sequences: %s' % error
+    preparedmap = (mapsettings(new), table, compiled, errors)
+    return None
+
+
+def mapsettings(values):
+    """Return the settings the valve table and the stored sequences are built from"""
+    return values['valves'], values['exclusiongroups'], values['sequences']
+
+
+def applysettings(_old, new):
+    """
+    Settings listener, puts the valve table and stored sequences that checkvalvemap built for the
+    reloaded settings in place when they differ from the map in force. In the owning process the
+    new table is put in place on the executor thread, between hardware commands. No valve is
+    moved. If the table cannot be put in place (the open valves conflict with it by then, or the
+    executor is busy) the map in force is kept and activemap still describes it.
+    """
+    global preparedmap
+    if mapsettings(new) == activemap:
+        return
+    prepared, preparedmap = preparedmap, None
+    if prepared is None or prepared[0] != mapsettings(new):
+        logger.error('Valve map not reloaded, it was not checked before the settings were published')
+        return
+    mapvalues, table, compiled, errors = prepared
+    if not ownerlock.owned():
+        swapvalvetable(mapvalues, table, compiled, errors)
+        return
+    try:
+        hwexecutor.call(swapvalvetable, mapvalues, table, compiled, errors, timeout=new['commandtimeout'])
+    except (ExecutorBusy, CommandTimeout):
+        logger.error('Valve map not reloaded, the hardware executor did not take it in time; '
+                     'it is tried again on the next change to settings.json')
+
+
+def swapvalvetable(mapvalues, table, compiled, errors):
+    """
+    Make a rebuilt valve table and its compiled sequences current, unless the open valves
+    conflict with it, and record the settings they were built from in activemap.
+    """
+    global valvetable, activemap
+    conflicts = table.conflicts(statesnapshot()[1])
+    if conflicts:
+        logger.error('Valve map not reloaded, open valves %s would break the new interlocks; '
+                     'it is tried again on the next change to settings.json',
+                     ', '.join(str(valveid) for valveid in conflicts))
+        return
+    valvetable = table
+    activemap = mapvalues
+    sequencerunner.load(compiled, errors)
+    logger.info('Valve map reloaded, %s stored sequences', len(compiled))
+
+
+def initialisegpio():
+    """
+    Sets up the GPIO in the process that has just become the owner.
+
+    If the previous owner was a worker of the same gunicorn master and did not shut down
+    cleanly (e.g. it was killed) the outputs are restored from the shared valve state so the
+    line is not disturbed. The master is identified by the boot id and its start time rather
+    than its pid alone, which is reused after a reboot and is always 1 when there is no gunicorn
+    master. Otherwise this is a fresh start and every valve is closed.
+    """
+    global valvestate, stateversion
+    values = shared.read()
+    master = masteridentity()
+    GPIO.setwarnings(False)
+    GPIO.setmode(GPIO.BCM)
+    GPIO.setup(channellist, GPIO.OUT)
+    stateversion = values.version
+    if values.ownerpid != 0 and master is not None and (values.bootid, values.masterstart) == master:
+        valvestate = values.state & valvetable.allmask
+        groupwrite(channellist, valvetable.pinbits(valvestate), valvetable.pinmask)
+        logger.warning('Took over the GPIO from worker %s, valve state restored', values.ownerpid)
+    else:
+        GPIO.output(channellist, 0)
+        valvestate = 0
+        stateversion += 1
+    bootid, masterstart = master or (0, 0)
+    shared.write(version=stateversion, state=valvestate, masterpid=os.getppid(), ownerpid=os.getpid(),
+                 bootid=bootid, masterstart=masterstart)
+
+
+def releaseowner():
+    """Mark the shared state as cleanly released so the next owner starts with all valves closed"""
+    shared.write(ownerpid=0)
+
+
+def electowner():
+    """
+    Tries to make this process the owner of the GPIO.
+
+    On success the GPIO is initialised and the hardware executor, valve history, reconciliation
+    thread, owner command channel, watchdog and telemetry sampler are started, and the ready pin
+    is set.
+
+    Returns:
+        bool: True if this process is (now) the owner.
+    """
+    if ownerlock.owned():
+        return True
+    if not ownerlock.acquire():
+        return False
+    initialisegpio()
+    valvehistory.start(currentstates)
+    hwexecutor.start()
+    timers.start(hwexecutor)
+    Thread(target=reconcileloop, args=(reconcilestop,), name='valve-reconcile', daemon=True).start()
+    ownerchannel.startserver(settings['ownersocket'], dispatch)
+    valvesocket.startservers(hwexecutor.submit, socketcontrol, socketstatus)
+    atexit.register(releaseowner)
+    setready(1)
+    watchdog.start(hwexecutor, setready, publishheartbeat)
+    sampler.start()
+    logger.info('Process %s owns the GPIO', os.getpid())
+    return True
+
+
+def electionloop(stopevent):
+    """
+    Thread loop in non-owning workers that takes over the GPIO if the owner exits, and
+    otherwise sends the owner this worker's metrics and fetches its latest telemetry sample
+    """
+    while not electowner():
+        refreshtelemetry()
+        pushmetrics()
+        if stopevent.wait(2):
+            return
+
+
+activemap = mapsettings(settings)
+"""The valve map settings (see mapsettings) the valve table and stored sequences in force were built from"""
+preparedmap = None
+"""(valve map settings, ValveTable, compiled sequences, sequence errors) built by checkvalvemap for the settings being reloaded"""
+settingswatcher.addcheck(checkvalvemap)
+settingswatcher.addlistener(applysettings)
+reconcilestop = Event()
+if not electowner():
+    Thread(target=electionloop, args=(reconcilestop,), name='owner-election', daemon=True).start()
+    logger.info('Process %s is forwarding hardware commands to the GPIO owner', os.getpid())
 logger.info('Application ready')
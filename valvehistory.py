@@ -0,0 +1,246 @@
+"""
+Valve transition history.
+
+Every valve state change is appended to a binary journal of fixed width records
+(timestamp, valve, old state, new state, source). Because every record is the same size and the
+records are written in time order, the journal can be binary searched by time, so questions such
+as "what was the state of every valve at time T" or "when did valve N change between two times"
+are answered by seeking into the file instead of parsing text logs.
+
+Records are buffered in memory and written by a background thread so that a valve operation
+never waits on the SD card. A checkpoint of every valve is written at startup and once a day so
+that state queries never have to search back further than a day.
+"""
+
+import os
+import atexit
+import struct
+from datetime import datetime
+from threading import Lock, Thread, Event
+from time import time
+from logmanager import logger
+from app_control import settings
+
+RECORD = struct.Struct('<dBBBB')
+"""timestamp (seconds since the epoch), valve id, old state, new state, source"""
+CLOSED = 0
+OPEN = 1
+UNKNOWN = 2
+STATENAMES = ['closed', 'open', 'unknown']
+SOURCES = ['unknown', 'startup', 'checkpoint', 'api', 'batch', 'rollback', 'timer', 'sequence', 'socket']
+"""Names of the sources that change valves, the index is stored in each record"""
+CHECKPOINTINTERVAL = 86400
+
+pending = []
+"""Records waiting to be written by the history thread"""
+historylock = Lock()
+writeevent = Event()
+lastcheckpoint = [0.0]
+statereader = None
+"""Callable returning {valve id: state} for the periodic checkpoint, set by start"""
+historystop = Event()
+
+
+def sourcecode(source):
+    """Return the number stored in a record for the named source"""
+    if source in SOURCES:
+        return SOURCES.index(source)
+    return 0
+
+
+def record(valveid, old, new, source):
+    """
+    Queues one valve transition to be written to the history journal.
+
+    Parameters:
+        valveid (int): The valve that changed.
+        old (int): The previous state, CLOSED, OPEN or UNKNOWN.
+        new (int): The new state, CLOSED or OPEN.
+        source (str): What caused the change, one of SOURCES.
+    """
+    with historylock:
+        pending.append(RECORD.pack(time(), valveid, old, new, sourcecode(source)))
+    writeevent.set()
+
+
+def checkpointrecords(states, source):
+    """
+    Packs a record of the current state of every valve, must be called holding historylock.
+
+    Parameters:
+        states (dict): {valve id: state} of every valve.
+        source (str): 'startup', where the previous state is unknown, or 'checkpoint'.
+    """
+    now = time()
+    code = sourcecode(source)
+    for valveid, state in states.items():
+        pending.append(RECORD.pack(now, valveid, UNKNOWN if source == 'startup' else state, state, code))
+    lastcheckpoint[0] = now
+
+
+def flush():
+    """Write any queued records, and the daily checkpoint when it is due, to the history file"""
+    with historylock:
+        if statereader is not None and time() - lastcheckpoint[0] > CHECKPOINTINTERVAL:
+            checkpointrecords(statereader(), 'checkpoint')
+        if not pending:
+            return
+        with open(settings['historypath'], 'ab') as f:
+            f.write(b''.join(pending))
+        pending.clear()
+
+
+def historyloop(stopevent):
+    """Thread loop that writes queued records to the history file until stopevent is set"""
+    while not stopevent.is_set():
+        writeevent.wait(60)
+        writeevent.clear()
+        try:
+            flush()
+        except OSError:
+            logger.exception('Unable to write the valve history file')
+        stopevent.wait(1)
+
+
+def start(states):
+    """
+    Records a startup checkpoint and starts the history writer thread.
+
+    Parameters:
+        states (callable): Returns {valve id: state} of every valve, used for the startup and
+            daily checkpoints.
+    """
+    global statereader
+    statereader = states
+    with historylock:
+        checkpointrecords(states(), 'startup')
+    Thread(target=historyloop, args=(historystop,), name='valve-history', daemon=True).start()
+
+
+atexit.register(flush)
+
+
+def unpack(data):
+    """Convert a packed record into a dictionary"""
+    timestamp, valveid, old, new, source = RECORD.unpack(data)
+    return {'time': datetime.fromtimestamp(timestamp).isoformat(sep=' ', timespec='milliseconds'),
+            'timestamp': timestamp, 'valve': valveid, 'old': STATENAMES[min(old, UNKNOWN)],
+            'new': STATENAMES[min(new, UNKNOWN)],
+            'source': SOURCES[source] if source < len(SOURCES) else 'unknown'}
+
+
+def findtime(f, count, when):
+    """
+    Binary searches the history file for the first record at or after a time.
+
+    Parameters:
+        f (file): The history file opened in binary mode.
+        count (int): The number of records in the file.
+        when (float): The time in seconds since the epoch.
+
+    Returns:
+        int: The index of the first record with a timestamp >= when, count if there is none.
+    """
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        f.seek(middle * RECORD.size)
+        if struct.unpack('<d', f.read(8))[0] < when:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def parsewhen(value):
+    """
+    Converts a query time into seconds since the epoch.
+
+    Parameters:
+        value (str): Seconds since the epoch, or a local time as 'YYYY-MM-DD HH:MM[:SS]' or
+            'YYYY-MM-DDTHH:MM[:SS]'.
+
+    Returns:
+        float: The time, or None if the value is empty or not recognised.
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for timeformat in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M'):
+        try:
+            return datetime.strptime(value.strip(), timeformat).timestamp()
+        except ValueError:
+            continue
+    return None
+
+
+def transitions(valveid=None, since=None, until=None, limit=10000):
+    """
+    Returns the recorded transitions in a time window, oldest first.
+
+    Parameters:
+        valveid (int): Only return transitions of this valve, None for all valves.
+        since (float): Start of the window in seconds since the epoch, None for the beginning.
+        until (float): End of the window in seconds since the epoch, None for now.
+        limit (int): The maximum number of records to return.
+
+    Returns:
+        list[dict]: The transitions, see unpack for the keys.
+    """
+    flush()
+    if not os.path.isfile(settings['historypath']):
+        return []
+    results = []
+    with open(settings['historypath'], 'rb') as f:
+        count = os.fstat(f.fileno()).st_size // RECORD.size
+        index = findtime(f, count, since) if since is not None else 0
+        f.seek(index * RECORD.size)
+        while index < count and len(results) < limit:
+            block = f.read(RECORD.size * min(4096, count - index))
+            for offset, fields in enumerate(RECORD.iter_unpack(block)):
+                if until is not None and fields[0] > until:
+                    return results
+                if (valveid is None or fields[1] == valveid) and fields[4] != sourcecode('checkpoint'):
+                    results.append(unpack(block[offset * RECORD.size:(offset + 1) * RECORD.size]))
+                    if len(results) >= limit:
+                        break
+            index += len(block) // RECORD.size
+    return results
+
+
+def stateat(when, valveids):
+    """
+    Returns the state of every valve at a given time.
+
+    The file is searched for the last record at or before the time and then read backwards
+    until a record has been found for every valve, which is never more than a day back thanks
+    to the daily checkpoints.
+
+    Parameters:
+        when (float): The time in seconds since the epoch.
+        valveids (list[int]): The valves to report.
+
+    Returns:
+        dict: {valve id: 'open', 'closed' or 'unknown'}.
+    """
+    flush()
+    states = dict.fromkeys(valveids, 'unknown')
+    if not os.path.isfile(settings['historypath']):
+        return states
+    remaining = set(valveids)
+    with open(settings['historypath'], 'rb') as f:
+        index = findtime(f, os.fstat(f.fileno()).st_size // RECORD.size, when + 1e-6)
+        while index > 0 and remaining:
+            first = max(0, index - 4096)
+            f.seek(first * RECORD.size)
+            block = f.read((index - first) * RECORD.size)
+            for offset in range(len(block) - RECORD.size, -1, -RECORD.size):
+                _, valveid, _, new, _ = RECORD.unpack(block[offset:offset + RECORD.size])
+                if valveid in remaining:
+                    states[valveid] = STATENAMES[min(new, UNKNOWN)]
+                    remaining.discard(valveid)
+            index = first
+    return states
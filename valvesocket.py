@@ -0,0 +1,186 @@
+"""
+Persistent socket protocol for lab automation clients.
+
+An optional TCP ('socketport') and/or UNIX socket ('socketpath') listener run by the process
+that owns the GPIO, for clients that send many valve commands in tight sequences and cannot
+afford the HTTP framing and JSON of /api on every one. A connection authenticates once and then
+sends one short command per line; commands may be pipelined, i.e. sent without waiting for the
+replies, which come back one line per command in the order the commands were sent.
+
+Commands:
+    AUTH <api-key>      must be the first line, replied to with OK or ERR auth (then closed)
+    O <valve>           open a valve
+    C <valve>           close a valve
+    P <valve> <ms>      open a valve for ms milliseconds (timed on the controller)
+    A                   close all valves
+    S                   status only
+    Q                   close the connection
+
+Replies:
+    OK <version> <mask>             the command ran
+    ERR <reason> <version> <mask>   it did not; reason is one of interlock, badvalve, badcommand,
+                                    busy, timeout, failed
+
+version is the state version after the command and mask the open valves in hexadecimal with
+bit N set when valve N is open. S and commands refused as badcommand are queued on the hardware
+executor like the others, so their state is taken in pipeline order. Only for busy, timeout and
+failed is the state read when the reply is written.
+"""
+
+import os
+import hmac
+import socket
+import socketserver
+from concurrent.futures import Future, TimeoutError as CommandTimeout
+from queue import Queue
+from threading import Thread
+from logmanager import logger
+from app_control import settings
+from executor import ExecutorBusy
+
+PIPELINEDEPTH = 256
+"""Commands read ahead of their replies on one connection before reading pauses"""
+VERBS = {'O': 'open', 'C': 'close', 'P': 'open'}
+
+
+class SocketHandler(socketserver.StreamRequestHandler):
+    """Serves one client connection, reading commands and writing replies on separate threads"""
+
+    def setup(self):
+        super().setup()
+        if self.request.family in (socket.AF_INET, socket.AF_INET6):
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        line = self.rfile.readline().split()
+        if len(line) != 2 or line[0] != b'AUTH' or \
+                not hmac.compare_digest(line[1], settings['api-key'].encode('utf-8')):
+            logger.warning('Socket: connection refused, missing or invalid key')
+            self.wfile.write(b'ERR auth\n')
+            return
+        self.reply(self.server.status())
+        replies = Queue(PIPELINEDEPTH)
+        writer = Thread(target=self.writereplies, args=(replies,), name='valve-socket-writer', daemon=True)
+        writer.start()
+        try:
+            for line in self.rfile:
+                words = line.split()
+                if words == [b'Q']:
+                    break
+                if words:
+                    replies.put(self.submit(words))
+        finally:
+            replies.put(None)
+            writer.join()
+
+    def submit(self, words):
+        """Start one command, returning a Future of (error, version, mask)"""
+        verb = words[0].decode('ascii', 'replace').upper()
+        try:
+            if verb == 'S' and len(words) == 1:
+                return self.server.submit(self.stateafter, None)
+            try:
+                if verb == 'A' and len(words) == 1:
+                    item, command, duration = 'closeallvalves', 1, 0
+                elif verb in VERBS and len(words) == (3 if verb == 'P' else 2):
+                    item, command = 'valve%d' % int(words[1]), VERBS[verb]
+                    duration = int(words[2]) if verb == 'P' else 0
+                else:
+                    return self.server.submit(self.stateafter, 'badcommand')
+            except ValueError:
+                return self.server.submit(self.stateafter, 'badcommand')
+            return self.server.submit(self.server.control, item, command, duration)
+        except ExecutorBusy:
+            return self.completed('busy')
+
+    def stateafter(self, error):
+        """Run on the executor thread, return (error, version, mask) of the state after the commands queued before it"""
+        return (error,) + self.server.status()[1:]
+
+    @staticmethod
+    def completed(error):
+        """
+        Return a Future already holding (error, None, None) for a command refused because the
+        executor queue is full, the writer fills in the state once the commands before it have
+        completed.
+        """
+        future = Future()
+        future.set_result((error, None, None))
+        return future
+
+    def writereplies(self, replies):
+        """Writer thread, sends the reply of each command in the order the commands arrived"""
+        while True:
+            future = replies.get()
+            if future is None:
+                return
+            try:
+                result = future.result(settings['commandtimeout'])
+            except CommandTimeout:
+                future.cancel()   # not run later if it has not started, the client was told it timed out
+                result = ('timeout', None, None)
+            except Exception:   # reported to the client, the connection stays open
+                logger.exception('Socket: command failed')
+                result = ('failed', None, None)
+            if result[1] is None:
+                result = (result[0],) + self.server.status()[1:]
+            try:
+                self.reply(result)
+            except OSError:
+                return
+
+    def reply(self, result):
+        """Write one (error, version, mask) reply line"""
+        error, version, mask = result
+        if error:
+            self.wfile.write(b'ERR %s %d %x\n' % (error.encode('ascii'), version, mask))
+        else:
+            self.wfile.write(b'OK %d %x\n' % (version, mask))
+
+
+class ValveServerMixin:
+    """The callables a SocketHandler uses to run commands, shared by the TCP and UNIX servers"""
+    daemon_threads = True
+    allow_reuse_address = True
+    submit = None
+    """submit(function, *args) -> Future, queues a function on the hardware executor"""
+    control = None
+    """control(item, command, duration) -> (error, version, mask), run on the hardware executor"""
+    status = None
+    """status() -> (None, version, mask)"""
+
+
+class TCPValveServer(ValveServerMixin, socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Socket protocol server on a TCP port"""
+
+
+class UnixValveServer(ValveServerMixin, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Socket protocol server on a UNIX socket"""
+
+
+def startservers(submit, control, status):
+    """
+    Starts the configured socket protocol listeners on daemon threads.
+
+    Parameters:
+        submit (callable): Queues a function on the hardware executor and returns its Future.
+        control (callable): control(item, command, duration) runs one command on the executor
+            thread and returns (error, version, mask).
+        status (callable): Returns (None, version, mask) of the current state.
+
+    Returns:
+        list: The running servers, empty if neither 'socketport' nor 'socketpath' is set.
+    """
+    servers = []
+    if settings['socketport']:
+        servers.append(TCPValveServer((settings['socketaddress'], settings['socketport']), SocketHandler))
+    if settings['socketpath']:
+        if os.path.exists(settings['socketpath']):
+            os.unlink(settings['socketpath'])
+        servers.append(UnixValveServer(settings['socketpath'], SocketHandler))
+        os.chmod(settings['socketpath'], 0o660)
+    for server in servers:
+        server.submit, server.control, server.status = submit, control, status
+        Thread(target=server.serve_forever, name='valve-socket', daemon=True).start()
+        logger.info('Socket protocol listening on %s', server.server_address)
+    return servers
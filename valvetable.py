@@ -0,0 +1,204 @@
+"""
+The valve table.
+
+The valve definitions from the 'valves' and 'exclusiongroups' settings compiled into indexed
+lookups and interlock bitmasks, with the checks and descriptions that work on a valve state
+word alone and never touch the GPIO: whether a valve can open, which valves changed, the
+valve status lists served by the web applications, and the planning of a batch of valve
+operations. valvecontrol keeps the current table and rebuilds it when the settings are reloaded.
+"""
+
+import json
+import zlib
+
+
+def status(value):
+    """
+    Determines the status based on a given value.
+
+    This function evaluates the provided integer value and returns a corresponding
+    status string. Specifically, it checks whether the value equals zero to
+    determine if the status is 'closed'. Any other value results in a status
+    of 'open'.
+
+    Parameters:
+    value (int): The value to evaluate for determining the status.
+
+    Returns:
+    str: A string representing the status. Returns 'closed' if the value is
+    0; otherwise, returns 'open'.
+    """
+    if value == 0:
+        return 'closed'
+    return 'open'
+
+
+class ValveTable:
+    """
+    The valve definitions compiled into indexed lookups and interlock masks.
+
+    Each valve is given one bit in the valve state word (bit n for the nth valve in the table).
+    Every 'excluded' entry, which may be a single valve id (0 for none) or a list of ids, and
+    every exclusion group is turned into a per-valve exclusion mask holding the bits of all the
+    valves that must be closed before that valve can open. Exclusions are always applied in
+    both directions, so checking whether a valve can open is a single AND against the state word.
+
+    The position of each valve's pin in the GPIO output group (channels) is precomputed as
+    per-byte lookup tables, so pinbits turns a state word into the bits of a grouped GPIO write
+    with a handful of table lookups.
+
+    The tag is a checksum of the valve ids and descriptions, the parts of the settings shown on
+    the status page, so every worker process gives the same tag for the same valve map.
+    """
+
+    def __init__(self, valvelist, groups=(), channels=()):
+        self.ids = [valve['id'] for valve in valvelist if valve['id'] > 0]
+        self.gpio = {valve['id']: valve['gpio'] for valve in valvelist if valve['id'] > 0}
+        self.description = {valve['id']: valve['description'] for valve in valvelist if valve['id'] > 0}
+        self.tag = '%08x' % zlib.crc32(json.dumps([[valveid, self.description[valveid]]
+                                                   for valveid in self.ids]).encode('utf-8'))
+        self.bit = {valveid: 1 << index for index, valveid in enumerate(self.ids)}
+        self.allmask = (1 << len(self.ids)) - 1
+        self.exclusion = dict.fromkeys(self.ids, 0)
+        for valve in valvelist:
+            excluded = valve.get('excluded', 0)
+            if not isinstance(excluded, (list, tuple)):
+                excluded = [excluded]
+            for other in excluded:
+                if other != 0:
+                    self.exclude(valve['id'], other)
+        for group in groups:
+            for valveid in group:
+                for other in group:
+                    if other != valveid:
+                        self.exclude(valveid, other)
+        channels = list(channels) or [self.gpio[valveid] for valveid in self.ids]
+        self.pinbit = {valveid: 1 << channels.index(self.gpio[valveid]) for valveid in self.ids}
+        self.pinmask = self.buildpinbits(self.allmask)
+        self.pintables = [[self.buildpinbits(byte << shift) for byte in range(256)]
+                          for shift in range(0, len(self.ids), 8)]
+
+    def exclude(self, valveid, other):
+        """Make two valves mutually exclusive"""
+        if valveid not in self.bit or other not in self.bit:
+            raise ValueError('interlock between unknown valves %s and %s' % (valveid, other))
+        self.exclusion[valveid] |= self.bit[other]
+        self.exclusion[other] |= self.bit[valveid]
+
+    def canopen(self, valveid, state):
+        """Return True if none of the valves excluded by this valve are open in the state word"""
+        return self.exclusion[valveid] & state == 0
+
+    def blockers(self, valveid, state):
+        """Return the ids of the open valves that stop this valve from opening"""
+        blocking = self.exclusion[valveid] & state
+        return [other for other in self.ids if self.bit[other] & blocking]
+
+    def conflicts(self, state):
+        """Return the ids of every open valve in the state word that has an excluded valve also open"""
+        return [valveid for valveid in self.ids
+                if self.bit[valveid] & state and self.exclusion[valveid] & state]
+
+    def isopen(self, valveid, state):
+        """Return True if the valve's bit is set in the state word"""
+        return state & self.bit[valveid] != 0
+
+    def idbits(self, state):
+        """Return a word with bit N set for every open valve N in the state word, used by the socket protocol"""
+        return sum(1 << valveid for valveid in self.ids if state & self.bit[valveid])
+
+    def buildpinbits(self, state):
+        """Build the output group bits for a state word valve by valve, used to fill the lookup tables"""
+        return sum(self.pinbit[valveid] for valveid in self.ids if state & self.bit[valveid])
+
+    def pinbits(self, state):
+        """Return the output group bits (bit n for channel n of the group) of a valve state word"""
+        bits = 0
+        for index, table in enumerate(self.pintables):
+            bits |= table[state >> (index * 8) & 0xFF]
+        return bits
+
+    def changes(self, oldstate, newstate):
+        """
+        Lists the valves whose state differs between two state words.
+
+        Parameters:
+            oldstate (int): The state word the client last saw, None to list every valve.
+            newstate (int): The current state word.
+
+        Returns:
+            dict: {valve id: 'open' or 'closed'} for each valve that changed.
+        """
+        changed = self.allmask if oldstate is None else oldstate ^ newstate
+        return {valveid: status(newstate & self.bit[valveid]) for valveid in self.ids if changed & self.bit[valveid]}
+
+    def describe(self, state):
+        """
+        Returns the status of every valve in a state word, as served by /api/status.
+
+        Returns:
+            list[dict]: {'valve': id, 'status': 'open' or 'closed'} for each valve in table order.
+        """
+        return [{'valve': valveid, 'status': status(state & self.bit[valveid])} for valveid in self.ids]
+
+    def describepage(self, state):
+        """
+        Returns the status of every valve in a state word with its description, as shown on the
+        status page.
+
+        Returns:
+            list[dict]: {'id': id, 'description': str, 'status': 'open' or 'closed'} for each valve.
+        """
+        return [{'id': valveid, 'description': self.description[valveid], 'status': status(state & self.bit[valveid])}
+                for valveid in self.ids]
+
+
+def planbatch(table, operations, state):
+    """
+    Validates an ordered list of valve operations against the interlocks without touching hardware.
+
+    Each operation is applied in turn to a copy of the valve state word so that the exclusion
+    check for every step sees the state left by the steps before it. Only valve open/close and
+    closeallvalves operations are allowed in a batch.
+
+    Parameters:
+        table (ValveTable): The valve table giving the state bits and interlocks.
+        operations (list[dict]): Ordered list of {'item': ..., 'command': ...} operations.
+        state (int): The current valve state word.
+
+    Returns:
+        tuple: (steps, error) where steps is a list of (item, valveid) tuples ready to apply and
+        error is None, or steps is None and error is a message describing the first rejected step.
+    """
+    if not isinstance(operations, list) or len(operations) == 0:
+        return None, 'batch must be a non-empty list of operations'
+    steps = []
+    for index, operation in enumerate(operations):
+        try:
+            item = operation['item']
+            command = operation['command']
+        except (KeyError, TypeError):
+            return None, 'operation %s: badly formed json message' % index
+        if item == 'closeallvalves':
+            state = 0
+            steps.append(('closeallvalves', 0))
+            continue
+        try:
+            if item[:5] != 'valve':
+                return None, 'operation %s: %s is not allowed in a batch' % (index, item)
+            valveid = int(item[5:])
+        except (TypeError, ValueError):
+            return None, 'operation %s: incorrect json message' % index
+        if valveid not in table.bit:
+            return None, 'operation %s: bad valve number %s' % (index, valveid)
+        if command == 'open':
+            if not table.canopen(valveid, state):
+                return None, 'operation %s: cannot open valve %s as valve %s is open' % (
+                    index, valveid, ', '.join(str(other) for other in table.blockers(valveid, state)))
+            state |= table.bit[valveid]
+        elif command == 'close':
+            state &= ~table.bit[valveid]
+        else:
+            return None, 'operation %s: bad valve command %s' % (index, command)
+        steps.append((command, valveid))
+    return steps, None
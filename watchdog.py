@@ -0,0 +1,102 @@
+"""
+Watchdog for the GPIO owning process.
+
+A thread in the owner sends a probe through the hardware executor every 'watchdoginterval'
+seconds. The probe runs on the executor thread like any valve command and drives the ready pin:
+held high ('readypinmode' steady) or flipped on every probe (toggle), so external hardware sees
+a steady level or a pulse train only while commands are actually being executed. Only one probe
+is queued at a time. If no probe has completed for 'watchdogtimeout' seconds, because the
+executor is hung or its queue is stuck, the watchdog clears the ready pin itself, from its own
+thread, and sets it again once probes succeed.
+
+The time of the last completed probe (the heartbeat) and of the last successful hardware call
+are published in the shared state on every tick, so any worker can answer /healthz from memory.
+If the watchdog thread itself stops, the heartbeat stops advancing and /healthz reports it.
+"""
+
+from concurrent.futures import TimeoutError as CommandTimeout
+from threading import Thread, Event
+from time import time
+from logmanager import logger
+from executor import ExecutorBusy
+
+
+class Watchdog:
+    """
+    Probes the hardware executor and drives the ready pin.
+
+    Parameters:
+        interval (float): Seconds between probes.
+        timeout (float): Seconds without a completed probe after which the controller is stalled.
+        toggle (bool): True to flip the ready pin on every probe, False to hold it high.
+    """
+
+    def __init__(self, interval, timeout, toggle=False):
+        self.interval = interval
+        self.timeout = timeout
+        self.toggle = toggle
+        self.heartbeat = 0.0
+        """time() of the last probe that completed on the executor"""
+        self.stalled = False
+        self.level = 1
+        self.pending = None
+        """The Future of the probe sent to the executor, at most one is queued at a time"""
+        self.stopevent = Event()
+        self.thread = Thread(target=self.run, name='valve-watchdog', daemon=True)
+        self.executor = None
+        self.setready = None
+        self.publish = None
+
+    def start(self, executor, setready, publish):
+        """
+        Start the watchdog thread.
+
+        Parameters:
+            executor (HardwareExecutor): The executor the probes are sent through.
+            setready (callable): setready(level) writes the ready pin, run on the executor by the
+                probe and directly by the watchdog when the executor is stalled.
+            publish (callable): publish(heartbeat) records the heartbeat in the shared state.
+        """
+        self.executor, self.setready, self.publish = executor, setready, publish
+        self.heartbeat = time()
+        self.publish(self.heartbeat)
+        self.thread.start()
+
+    def probe(self, level):
+        """Runs on the executor thread, writes the ready pin and returns the time it ran"""
+        self.setready(level)
+        return time()
+
+    def tick(self):
+        """
+        Send one probe, or keep waiting for the last one if it has not run yet, and clear or
+        restore the ready pin as needed. Only one probe is ever queued, so a stall does not fill
+        the command queue with probes that would then all write the pin once it clears.
+        """
+        try:
+            if self.pending is None or self.pending.done():
+                if self.toggle:
+                    self.level ^= 1
+                self.pending = self.executor.submit(self.probe, self.level)
+            self.heartbeat = self.pending.result(self.timeout)
+        except (ExecutorBusy, CommandTimeout):
+            pass
+        except Exception:   # a failing pin write is a stall as well
+            logger.exception('Watchdog: ready pin probe failed')
+        stalled = time() - self.heartbeat > self.timeout
+        if stalled and not self.stalled:
+            logger.error('Watchdog: no hardware command has completed for %.1f seconds, ready pin cleared',
+                         time() - self.heartbeat)
+            self.setready(0)
+        elif self.stalled and not stalled:
+            logger.warning('Watchdog: hardware commands are completing again, ready pin restored')
+        self.stalled = stalled
+        self.publish(self.heartbeat)
+
+    def run(self):
+        """Watchdog thread loop"""
+        while not self.stopevent.wait(self.interval):
+            try:
+                self.tick()
+            except Exception:   # keep watching whatever happens
+                logger.exception('Watchdog: tick failed')
@@ -0,0 +1,168 @@
+"""
+Helpers shared by the Flask (app.py) and aiohttp (asyncapp.py) web applications.
+
+Everything here is independent of the web framework: reading a page of a log file, the CPU
+temperature and thread list shown on the pages, the ETag of the status page, the shared JSON
+status bodies, /api and batch message checking and the gauges of the /metrics endpoint. Importing this
+module starts nothing, each application starts its own background threads.
+"""
+
+from threading import enumerate as enumerate_threads, active_count
+from markupsafe import Markup
+from logmanager import logger, logqueue, loghandler
+from logreader import readlog, searchlog, parsetime
+from valvecontrol import valvestatus, statustag, statesnapshot, hwexecutor, latestsample
+from app_control import settings
+import metrics
+from statuscache import CoalescedStatus
+
+
+def read_log_from_file(file_path, args):
+    """
+    Reads one page of a log file, newest lines first.
+
+    The page size is taken from the 'lines' query parameter (default is the 'loglines'
+    setting, at most the 'maxloglines' setting) and the page position from the 'before' cursor
+    returned with the previous page. The file is read backwards from the cursor so only the
+    lines shown are loaded, and paging continues into the rotated backups of the file. If any of
+    the 'level', 'since', 'until' or 'q' filters are given only the matching lines are returned,
+    using the log's time index to read just the part of each file inside the time range.
+
+    Args:
+        file_path (str): The path to the file to be read.
+        args (MultiDict): The query parameters of the request.
+
+    Returns:
+        tuple: A list of strings holding the lines of the page in reversed order, and the
+        cursor for the next (older) page or None if there are no older lines.
+    """
+    count = min(max(1, args.get('lines', settings['loglines'], type=int)), settings['maxloglines'])
+    cursor = args.get('before')
+    level = args.get('level')
+    text = args.get('q')
+    start = parsetime(args.get('since'))
+    end = parsetime(args.get('until'))
+    if level or text or start or end:
+        return searchlog(file_path, count, level, text, start, end, cursor)
+    return readlog(file_path, count, cursor)
+
+
+def read_cpu_temperature():
+    """
+    Returns the CPU temperature from the latest telemetry sample.
+
+    The temperature is sampled in the background by the telemetry sampler of the process that
+    owns the GPIO, so no file is read when a page is rendered.
+
+    Returns:
+        float: The CPU temperature in degrees Celsius, rounded to one decimal place, or None
+        if the temperature file could not be read or there is no sample yet.
+    """
+    sample = latestsample()
+    return None if sample is None else sample.temperature
+
+
+def read_throttled():
+    """Returns the firmware throttle flags from the latest telemetry sample, None if there is none"""
+    sample = latestsample()
+    return None if sample is None else sample.throttled
+
+
+metrics.Gauge('valvecontroller_cpu_temperature_celsius', 'CPU temperature', read_cpu_temperature)
+metrics.Gauge('valvecontroller_threads', 'Number of active threads', active_count)
+metrics.Gauge('valvecontroller_throttled_flags', 'Raspberry Pi firmware throttle flags', read_throttled)
+metrics.Gauge('valvecontroller_log_queue_depth', 'Records waiting to be written to the log file', logqueue.qsize)
+metrics.Gauge('valvecontroller_command_queue_depth', 'Hardware commands waiting for the executor thread',
+              hwexecutor.queue.qsize)
+metrics.Gauge('valvecontroller_log_records_dropped', 'Log records dropped because the log queue was full',
+              lambda: loghandler.dropped)
+
+
+def threadlister():
+    """
+    Generates a list of threads currently running in the application.
+
+    This function retrieves all active threads in the process, collecting their
+    names and native thread IDs, and returns the result as a list. Each thread's
+    information is represented as a sublist containing the thread's name and ID.
+
+    Returns:
+        list: A list of sublists where each sublist contains a thread's name
+            and native thread ID.
+    """
+    appthreads = []
+    for appthread in enumerate_threads():
+        appthreads.append([appthread.name, appthread.native_id])
+    return appthreads
+
+
+THREADROWS = Markup('<!--threads-->')
+"""Stands in for the thread rows in the cached render of the status page, see withthreads"""
+
+
+def withthreads(html, renderthreads):
+    """
+    Fills the thread rows into a cached render of the status page.
+
+    The thread list is particular to the worker process answering and changes without the
+    valves changing, so it is left out of the cached page and of its ETag and rendered for
+    every response.
+
+    Args:
+        html (str): The status page rendered with threadrows=THREADROWS.
+        renderthreads (callable): Renders the threads.html template for a thread list.
+    """
+    return html.replace(THREADROWS, renderthreads(threadlister()), 1)
+
+
+def statuspagetag():
+    """
+    Builds the (weak) ETag of the status page from the state version, the drift mask, the tag of
+    the valve table in force (a checksum of the valve descriptions) and the CPU temperature
+    bucket (the 'temperaturebucket' setting in degrees), which between them change whenever the
+    page needs to be rendered again. All of them are the same in every worker process, so a
+    client sent to another worker still gets a 304. The tag is weak as the thread rows (see
+    withthreads) are not covered by it.
+
+    Returns:
+        tuple: (etag, state word, cputemperature), the state word being the one the tag describes.
+    """
+    version, state, driftmask, maptag = statustag()
+    cputemperature = read_cpu_temperature()
+    bucket = -1 if cputemperature is None else cputemperature // settings['temperaturebucket']
+    return 'v%s-d%s-m%s-t%d' % (version, driftmask, maptag, bucket), state, cputemperature
+
+
+statusbodies = CoalescedStatus(settings['statuswindow'], statesnapshot, valvestatus)
+"""The pre-serialised JSON status shared by concurrent status requests"""
+
+
+def apimessage(message):
+    """
+    Returns the item and command of an /api message, {"item": str, "command": str, ...}.
+
+    Returns:
+        tuple: (item, command), or None (logged and counted as bad_json) if the message is badly formed.
+    """
+    if not isinstance(message, dict) or not isinstance(message.get('item'), str) or \
+            not isinstance(message.get('command'), str):
+        logger.warning('API: Badly formed json message')
+        metrics.commands.inc('bad_json')
+        return None
+    return message['item'], message['command']
+
+
+def batchoperations(message):
+    """
+    Returns the operations of a /api/batch message, a list or {"operations": list}.
+
+    Returns:
+        list: The operations, or None (logged and counted as bad_json) if the message is badly formed.
+    """
+    if isinstance(message, dict):
+        message = message.get('operations')
+    if not isinstance(message, list):
+        logger.warning('API: Badly formed batch message')
+        metrics.commands.inc('bad_json')
+        return None
+    return message